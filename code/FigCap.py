@@ -20,103 +20,429 @@ Start from 19/10/2017
 
 import os
 import json
-from pprint import pprint
 import renderer
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
+from layout_cache import LayoutCache
+import metrics as pipeline_metrics
+from crop_writer import CropWriter
+from results import ResultSink
+from manifest import Manifest
 from xpdf_process import figures_captions_list
-import subprocess
-import os
+from tools import LOCAL_TOOLS
+import shutil
 import time
+import argparse
+import multiprocessing
+import signal
+import traceback
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+INPUT_PATH = '/eecis/shatkay/homes/pengyuan/Documents/RESEARCH/PDFigCapX/code/sample_data_for_Juan'
+OUTPUT_PATH = '/eecis/shatkay/homes/pengyuan/Documents/RESEARCH/PDFigCapX/code/sample_data_for_Juan'
+PDFTOHTML = '/usa/pengyuan/Documents/RESEARCH/PDFigCapX/xpdf-tools-linux-4.00/bin64/pdftohtml'
+RENDER_DPI = 300
+# pdftohtml background png resolution when the Ghostscript render is shared
+SINGLE_RENDER_HTML_DPI = 20
+CACHE_PRUNE_EVERY = 100
+
+
+def list_pdfs(input_path):
+    return sorted(pdf for pdf in os.listdir(input_path)
+                  if pdf.endswith('.pdf') and (not pdf.startswith('._')))
+
+
+def process_pdf(input_path, pdf, output_path, dpi=RENDER_DPI, single_render=False, cache_dir=None,
+                detection_scale=1, metrics=None, page_workers=1, write_json=True, checkpoint=None,
+                crop_options=None, embedded_images=False, tools=None):
+    # Run the whole pipeline for one pdf and save its figures, captions and json
+    # single_render: render the pdf once with Ghostscript and use that raster for both
+    # figure detection and cropping; pdftohtml then only writes thumbnail pngs
+    # cache_dir: layout cache keyed on the pdf content, instead of output_path/xpdf/<name>
+    # detection_scale: 1, 2 or 4, find graphics on a page raster reduced by this factor
+    # metrics: metrics.Metrics to record stage times and counters in
+    # page_workers: number of pages of this pdf detected in parallel threads
+    # write_json: pprint the result and save it as <name>/<name>.json; off when a ResultSink collects it
+    # checkpoint: manifest.Checkpoint of this pdf, marked as each stage completes; the pdftohtml
+    # output is reused only if the manifest says an earlier run completed it
+    # crop_options: crop_writer.CropWriter settings: image_format, quality, optimize, threads, archive
+    # embedded_images: read the images embedded in the pdf and their placement; they are figure
+    # candidates, and a figure that is one JPEG image is saved as that file without a render
+    # tools: tools.Tools that runs pdftohtml and Ghostscript (default: here, as child processes)
+    if metrics is None:
+        metrics = pipeline_metrics.NULL_METRICS
+    data = new_data(pdf)
+    pages = renderer.LazyPages(input_path + '/' + pdf, dpi, tools=tools)
+    try:
+        figures, info, native = detect_figures(input_path, pdf, output_path + '/xpdf/', pages, single_render,
+                                               cache_dir, detection_scale, metrics, page_workers, checkpoint,
+                                               embedded_images, tools)
+        with metrics.stage('render'):
+            pages.render(figure_pages(figures, native))
+        mark(checkpoint, 'rendered')
+        data[pdf]['fig_no'] = info.fig_no_est
+        with metrics.stage('save_figures'):
+            save_figures(data, pdf, output_path, figures, info, pages, crop_options, native)
+    finally:
+        pages.close()
+
+    if write_json:
+        save_json(data, pdf, output_path)
+        mark(checkpoint, 'written')
+    return data
+
+
+def detect_figures(input_path, pdf, xpdf_path, pages, single_render=False, cache_dir=None, detection_scale=1,
+                   metrics=pipeline_metrics.NULL_METRICS, page_workers=1, checkpoint=None, embedded_images=False,
+                   tools=None):
+    # The steps of process_pdf before the figure pages are rendered: pdftohtml (into xpdf_path),
+    # the embedded images and figure detection; the options are those of process_pdf.
+    # pages: renderer.LazyPages of the pdf, rendered whole first with single_render
+    # returns figures, info and native, {(page_no, order_no): (bytes, extension)} of the figures
+    # that are one embedded image (see save_figures), None without embedded_images
+    if tools is None:
+        tools = LOCAL_TOOLS
+    pdftohtml_args = []
+    if single_render:
+        pdftohtml_args = ['-r', str(SINGLE_RENDER_HTML_DPI)]
+    cache_entry = None
+    with metrics.stage('pdftohtml'):
+        if cache_dir is not None:
+            cache_entry = LayoutCache(cache_dir).entry(input_path+'/'+pdf, PDFTOHTML, pdftohtml_args, tools)
+        else:
+            if checkpoint is not None and not checkpoint.reached('parsed'):
+                # possibly cut short, or from another version of the pdf
+                shutil.rmtree(xpdf_path+pdf[:-4], ignore_errors=True)
+            if not os.path.isdir(xpdf_path+pdf[:-4]):
+                tools.pdftohtml(PDFTOHTML, input_path+'/'+pdf, xpdf_path+pdf[:-4], pdftohtml_args)
+    mark(checkpoint, 'parsed')
+
+    images = None
+    if embedded_images:
+        with metrics.stage('embedded_images'):
+            images = read_embedded_images(input_path + '/' + pdf)
+    page_images = None
+    if single_render:
+        with metrics.stage('render'):
+            pages.render()
+        page_images = pages
+    figures, info = figures_captions_list(input_path, pdf, xpdf_path, page_images, cache_entry, detection_scale,
+                                          metrics, page_workers, images and images.pages)
+    mark(checkpoint, 'detected')
+    native = None
+    if images is not None:
+        from pdf_images import native_figures
+        native = native_figures(figures, images, info)
+        metrics.count('native_figures', len(native))
+    return figures, info, native
+
+
+def mark(checkpoint, state):
+    if checkpoint is not None:
+        checkpoint.mark(state)
+
+
+def figure_pages(figures, native=None):
+    # Pages with a figure to crop; figures in native (see save_figures) need no render
+    native = native or {}
+    return [int(figure[4:-4]) for figure in figures
+            if any((int(figure[4:-4]), order_no) not in native for order_no in range(1, len(figures[figure]) + 1))]
+
+
+def read_embedded_images(pdf_path):
+    # pdf_images.PdfImages of the pdf (no images if it cannot be parsed), None if it cannot be opened;
+    # detection then uses the raster alone
+    import pdf_images
+    try:
+        return pdf_images.PdfImages(pdf_path)
+    except EnvironmentError:
+        return None
+
+
+def save_json(data, pdf, output_path):
+    from pprint import pprint
+    pprint(data)
+    json_file = output_path + '/' + pdf[:-4] + '/' + pdf[:-4] + '.json'
+    with open(json_file, 'w') as outfile:
+        json.dump(data, outfile)
 
-if __name__ == "__main__":
 
-    input_path = '/eecis/shatkay/homes/pengyuan/Documents/RESEARCH/PDFigCapX/code/sample_data_for_Juan'
-    output_path = '/eecis/shatkay/homes/pengyuan/Documents/RESEARCH/PDFigCapX/code/sample_data_for_Juan'
-    xpdf_path = output_path +'/xpdf/'  
-    log_file = output_path + '/log.text'
-    f_log = open(log_file, 'w') 
-    if not os.path.isdir(xpdf_path):
-        os.mkdir(xpdf_path)
-# Read each files in the input path
-    for pdf in os.listdir(input_path):
-        if pdf.endswith('.pdf') and (not pdf.startswith('._')):
-            data = {}
-            print input_path+pdf
-            images = renderer.render_pdf(input_path + '/' + pdf)
-            data[pdf] = {}
-            data[pdf]['figures'] = []
-            data[pdf]['pages_annotated'] = []
-            pdf_flag = 0
-            try:
-                if not os.path.isdir(xpdf_path+pdf[:-4]):
-                    std_out = subprocess.check_output(["/usa/pengyuan/Documents/RESEARCH/PDFigCapX/xpdf-tools-linux-4.00/bin64/pdftohtml", input_path+'/'+pdf, xpdf_path+pdf[:-4]+'/'])
-            except:
-                print "\nWrong "+pdf+"\n"
-                f_log.write(pdf+'\n')
-                pdf_flag = 1
-
-            if pdf_flag == 0:
-                flag = 0
-                wrong_count = 0
-                while flag==0 and wrong_count<5:
-                    try:
-                        figures, info = figures_captions_list(input_path, pdf, xpdf_path)
-                        flag = 1
-
-                    except:
-                        wrong_count = wrong_count +1
-                        time.sleep(5)
-                        print pdf
-                        info['fig_no_est']=0
-                        figures = []
-                        print "------\nChrome Error\n----------\n"
-        
-                data[pdf]['fig_no'] = info['fig_no_est']
-
-                output_file_path = output_path +'/' + pdf[:-4]
-                if not os.path.isdir(output_file_path):
-                    os.mkdir(output_file_path)      
-
-                for figure in figures:
-                    page_no = int(figure[:-4][4:])
-                    page_fig= images[page_no -1]
-                    rendered_size = page_fig.size
-
-                    bboxes = figures[figure]
-                    order_no = 0
-                    for bbox in bboxes:
-                        order_no = order_no + 1
-                        png_ratio = float(rendered_size[1])/info['page_height']
-                        print(png_ratio)
-
-                        if len(bbox[1])>0:
-                            data[pdf]['figures'].append({'page': page_no,
-                                          'region_bb': bbox[0],
+def new_data(pdf):
+    data = {}
+    data[pdf] = {}
+    data[pdf]['figures'] = []
+    data[pdf]['pages_annotated'] = []
+    return data
+
+
+def save_figures(data, pdf, output_path, figures, info, pages, crop_options=None, native=None):
+    # Crop each figure from its page render; the caller renders the pages (figure_pages) beforehand
+    # crop_options: CropWriter settings (image_format, quality, optimize, threads, archive)
+    # native: {(page_no, order_no): (bytes, extension)} saved as they are instead of cropped
+    output_file_path = output_path +'/' + pdf[:-4]
+    if not os.path.isdir(output_file_path):
+        os.mkdir(output_file_path)
+    native = native or {}
+    writer = CropWriter(output_file_path, pdf[:-4], **(crop_options or {}))
+    for figure in figures:
+        if len(figures[figure]) == 0:
+            continue
+        page_no = int(figure[:-4][4:])
+        page_fig = None
+
+        bboxes = figures[figure]
+        order_no = 0
+        for bbox in bboxes:
+            order_no = order_no + 1
+
+            if len(bbox[1])>0:
+                data[pdf]['figures'].append({'page': page_no,
+                              'region_bb': bbox[0],
+                             'figure_type': 'Figure',
+                            'page_width': info.page_width,
+                            'page_height': info.page_height,
+                            'caption_bb': bbox[1][0],
+                            'caption_text': bbox[1][1]
+                             })
+                caption_bb, caption_text = bbox[1][0], bbox[1][1]
+            else:
+                data[pdf]['figures'].append({'page': page_no,
+                                         'region_bb': bbox[0],
                                          'figure_type': 'Figure',
-                                        'page_width': info['page_width'],
-                                        'page_height': info['page_height'],
-                                        'caption_bb': bbox[1][0],
-                                        'caption_text': bbox[1][1]
+                                         'page_width': info.page_width,
+                                         'page_height': info.page_height,
+                                         'caption_bb': [],
+                                         'caption_text': []
                                          })
-                            with open(output_file_path+'/'+str(page_no)+'_'+str(order_no)+'.txt', 'w') as capoutput:
-                                capoutput.write(str(bbox[1][1]))
-                                capoutput.close
-                        else:
-                            data[pdf]['figures'].append({'page': page_no,
-                                                     'region_bb': bbox[0],
-                                                     'figure_type': 'Figure',
-                                                     'page_width': info['page_width'],
-                                                     'page_height': info['page_height'],
-                                                     'caption_bb': [],
-                                                     'caption_text': []
-                                                     })
-                        fig_extracted = page_fig.crop([int(bbox[0][0]*png_ratio), int(bbox[0][1]*png_ratio), 
-                                        int((bbox[0][0]+bbox[0][2])*png_ratio), int((bbox[0][1]+bbox[0][3])*png_ratio)])
-                        fig_extracted.save(output_file_path+'/'+str(page_no)+'_'+str(order_no)+'.jpg')
-
-                pprint(data)
-                json_file = output_file_path+'/'+ pdf[:-4]+'.json'
-                with open(json_file, 'w') as outfile:
-                    json.dump(data, outfile)
+                caption_bb, caption_text = None, None
+            if (page_no, order_no) in native:
+                content, extension = native[(page_no, order_no)]
+                writer.add_encoded(page_no, order_no, content, extension, bbox[0], caption_bb, caption_text)
+                continue
+            if page_fig is None:
+                page_fig = pages[page_no]
+                png_ratio = renderer.crop_ratio(page_fig.size, info)
+            fig_extracted = renderer.crop_region(page_fig, bbox[0], png_ratio)
+            writer.add(page_no, order_no, fig_extracted, bbox[0], caption_bb, caption_text)
+
+    writer.close()
+
+
+def batch_worker(input_path, pdf, output_path, results, options, instrument=False, stream=False, checkpoint=None):
+    # Own process group, so a timeout also kills pdftohtml/gs started by this pdf
+    if hasattr(os, 'setsid'):
+        os.setsid()
+    start = time.time()
+    record = {'pdf': pdf}
+    metrics = None
+    if instrument:
+        metrics = pipeline_metrics.Metrics(pdf)
+    try:
+        data = process_pdf(input_path, pdf, output_path, metrics=metrics, write_json=not stream,
+                           checkpoint=checkpoint, **options)
+        record['status'] = 'ok'
+        record['fig_no'] = data[pdf]['fig_no']
+        record['figures'] = len(data[pdf]['figures'])
+        if stream:
+            record['result'] = data[pdf]
+    except Exception as e:
+        record['status'] = 'error'
+        record['error'] = repr(e)
+        record['traceback'] = traceback.format_exc()
+        if checkpoint is not None:
+            checkpoint.fail(record['error'])
+    record['seconds'] = time.time() - start
+    if metrics is not None:
+        record['metrics'] = metrics.finish()
+    results.put(record)
+
+
+def kill_worker(process):
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.terminate()
+    except OSError:
+        pass
+    process.join()
+
 
+def batch_results(input_path, output_path, pdfs=None, processes=None, timeout=600, instrument=False, stream=False,
+                  manifest=None, **options):
+    # Run every pdf in its own worker process, at most `processes` at a time.
+    # Yields one record per pdf as soon as it finishes, fails or times out.
+    # instrument: add the stage times and counters of each pdf as record['metrics']
+    # stream: send the result of each pdf back as record['result'] instead of writing its json file
+    # manifest: manifest.Manifest the workers checkpoint each pdf in; timeouts and crashes are logged to it here
+    # options are passed on to process_pdf
+    if pdfs is None:
+        pdfs = list_pdfs(input_path)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if not os.path.isdir(output_path + '/xpdf/'):
+        os.mkdir(output_path + '/xpdf/')
+    results = multiprocessing.Queue()
+    pending = list(pdfs)
+    running = {}
+    while pending or running:
+        while pending and len(running) < processes:
+            pdf = pending.pop(0)
+            checkpoint = None
+            if manifest is not None:
+                checkpoint = manifest.checkpoint(pdf, input_path + '/' + pdf)
+            worker = multiprocessing.Process(target=batch_worker, args=(input_path, pdf, output_path, results, options,
+                                                                          instrument, stream, checkpoint))
+            worker.daemon = True
+            worker.start()
+            running[pdf] = (worker, time.time())
+        # Every record already sent counts as finished before any timeout is checked
+        try:
+            record = results.get(timeout=0.5)
+            while True:
+                if record['pdf'] in running:
+                    running.pop(record['pdf'])[0].join()
+                    yield record
+                record = results.get_nowait()
+        except queue.Empty:
+            pass
+        now = time.time()
+        for pdf in list(running):
+            worker, start = running[pdf]
+            if now - start > timeout:
+                kill_worker(worker)
+                del running[pdf]
+                record = {'pdf': pdf, 'status': 'timeout', 'seconds': now - start,
+                          'error': 'No result after %d seconds' % timeout}
+            elif not worker.is_alive() and worker.exitcode != 0:
+                del running[pdf]
+                record = {'pdf': pdf, 'status': 'crashed', 'seconds': now - start,
+                          'error': 'Worker exited with code %s' % worker.exitcode}
+            else:
+                continue
+            if manifest is not None:
+                manifest.update(pdf, error=record['error'])
+            yield record
+
+
+def run_batch(input_path, output_path, processes=None, timeout=600, log_file=None,
+              cache_max_bytes=None, metrics_file=None, instrument=False, results_file=None, manifest_file=None,
+              batch=None, **options):
+    # Failures go to a json-lines log, one record per pdf
+    # cache_max_bytes: prune the layout cache (options['cache_dir']) to this size; while the batch
+    # runs only entries it has not used are evicted, the rest once it is done
+    # instrument: emit the metrics record of every pdf to the metrics hooks
+    # metrics_file: json-lines metrics sink, implies instrument
+    # results_file: append the result of every pdf to this json-lines file (.gz to compress)
+    # instead of a json file per pdf; pdfs already in it are skipped
+    # manifest_file: checkpoint manifest; pdfs it has as written with unchanged content are skipped,
+    # the others are retried
+    # batch: runs the pdfs and yields their records, called like batch_results (the default);
+    # tool_runner passes its own
+    if batch is None:
+        batch = batch_results
+    if log_file is None:
+        log_file = output_path + '/log.jsonl'
+    cache = None
+    if options.get('cache_dir') is not None and cache_max_bytes is not None:
+        cache = LayoutCache(options['cache_dir'], cache_max_bytes)
+    sink = None
+    if metrics_file is not None:
+        sink = pipeline_metrics.jsonl_sink(metrics_file)
+        pipeline_metrics.add_hook(sink)
+        instrument = True
+    pdfs = list_pdfs(input_path)
+    result_sink = None
+    if results_file is not None:
+        result_sink = ResultSink(results_file)
+        pdfs = [pdf for pdf in pdfs if pdf not in result_sink.done]
+    manifest = None
+    if manifest_file is not None:
+        manifest = Manifest(manifest_file)
+        manifest.compact()
+        pdfs = manifest.pending(input_path, pdfs)
+    summary = {}
+    run_start = time.time()
+    try:
+        with open(log_file, 'a') as f_log:
+            for record in batch(input_path, output_path, pdfs, processes, timeout, instrument,
+                                result_sink is not None, manifest, **options):
+                summary[record['status']] = summary.get(record['status'], 0) + 1
+                print('%s %s %.1fs' % (record['status'], record['pdf'], record['seconds']))
+                if 'result' in record:
+                    result_sink.write(record['pdf'], record.pop('result'))
+                    if manifest is not None:
+                        manifest.update(record['pdf'], state='written', error=None)
+                if record['status'] != 'ok':
+                    f_log.write(json.dumps(record) + '\n')
+                    f_log.flush()
+                if 'metrics' in record:
+                    pipeline_metrics.emit(record['metrics'])
+                if cache is not None and sum(summary.values()) % CACHE_PRUNE_EVERY == 0:
+                    cache.prune(keep_since=run_start)
+    finally:
+        if sink is not None:
+            pipeline_metrics.remove_hook(sink)
+        if result_sink is not None:
+            result_sink.close()
+    if cache is not None:
+        cache.prune()
+    return summary
+
+
+def argument_parser(description='Extract figures and captions from every pdf in a folder'):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--input_path', default=INPUT_PATH)
+    parser.add_argument('--output_path', default=OUTPUT_PATH)
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+                        help='Number of documents processed in parallel')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='Wall-clock seconds allowed per document')
+    parser.add_argument('--log_file', default=None,
+                        help='Json-lines failure log (default: output_path/log.jsonl)')
+    parser.add_argument('--dpi', type=int, default=RENDER_DPI,
+                        help='Resolution of the page render the figures are cropped from')
+    parser.add_argument('--single_render', action='store_true',
+                        help='Detect figures on the same Ghostscript render they are cropped from')
+    parser.add_argument('--cache_dir', default=None,
+                        help='Layout cache keyed on pdf content and pdftohtml version')
+    parser.add_argument('--cache_max_bytes', type=int, default=None,
+                        help='Evict least recently used cache entries above this size')
+    parser.add_argument('--detection_scale', type=int, choices=[1, 2, 4], default=1,
+                        help='Detect graphics on a page raster reduced by this factor')
+    parser.add_argument('--page_workers', type=int, default=1,
+                        help='Pages of one document detected in parallel threads')
+    parser.add_argument('--metrics_file', default=None,
+                        help='Json-lines file for the stage times and counters of every document')
+    parser.add_argument('--results_file', default=None,
+                        help='Append every result to this json-lines file (.gz compressed) instead of a json '
+                             'file per document; documents already in it are skipped')
+    parser.add_argument('--manifest_file', default=None,
+                        help='Checkpoint manifest; a re-run skips the documents it has finished and retries the rest')
+    parser.add_argument('--crop_format', choices=['JPEG', 'PNG', 'WEBP'], default='JPEG',
+                        help='Image format of the figure crops')
+    parser.add_argument('--crop_quality', type=int, default=None, help='JPEG/WebP quality (default: PIL default)')
+    parser.add_argument('--crop_optimize', action='store_true', help='Spend more time for smaller crops')
+    parser.add_argument('--crop_threads', type=int, default=1, help='Crops encoded in parallel threads')
+    parser.add_argument('--crop_archive', choices=['zip', 'tar'], default=None,
+                        help='Write the crops, captions and a manifest of each document into one archive')
+    parser.add_argument('--embedded_images', action='store_true',
+                        help='Use the images embedded in the pdf as figure candidates and save JPEG figures as is')
+    return parser
+
+
+def run_arguments(args, batch=None):
+    # run_batch with the options of argument_parser
+    crop_options = {'image_format': args.crop_format, 'quality': args.crop_quality, 'optimize': args.crop_optimize,
+                    'threads': args.crop_threads, 'archive': args.crop_archive}
+    return run_batch(args.input_path, args.output_path, args.processes, args.timeout, args.log_file,
+                     args.cache_max_bytes, args.metrics_file, results_file=args.results_file,
+                     manifest_file=args.manifest_file, batch=batch, dpi=args.dpi,
+                     single_render=args.single_render, cache_dir=args.cache_dir, detection_scale=args.detection_scale,
+                     page_workers=args.page_workers, crop_options=crop_options,
+                     embedded_images=args.embedded_images)
+
+
+if __name__ == "__main__":
+    print(run_arguments(argument_parser().parse_args()))
@@ -0,0 +1,313 @@
+'''
+benchmark runs the figure and caption detection over a corpus, times every
+stage and scores the result against the ground truth of the GXD-200 or
+PMC-200 dataset (data/GT_GXD200.json, data/GT_PMC200.json), so a change can
+be judged on speed and accuracy together.
+
+Usage:
+    python benchmark.py run --input_path PDFS --output_path OUT --gt ../data/GT_PMC200.json [--report REPORT]
+    python benchmark.py compare BASE_REPORT NEW_REPORT [--tolerance 0.05] [--f1_tolerance 0.005]
+    python benchmark.py startup [--repeat 5] [--modules xpdf_process FigCap extract]
+
+run writes a json report: the metrics record of every document (stage seconds,
+counters, pages, figures) and a summary (docs/sec, pages/sec, seconds per stage,
+peak RSS, figure and caption precision/recall/F1 at the IoU threshold).
+compare prints both summaries and exits with 1 if the new run regressed.
+startup times a cold import of each module in a fresh interpreter, the cost every
+worker process pays before its first document, with the RSS it leaves and any of
+the optional heavy packages (matplotlib, scipy, selenium) it pulled in.
+'''
+import os
+import sys
+import json
+import platform
+import resource
+import argparse
+import subprocess
+import traceback
+from FigCap import PDFTOHTML, list_pdfs
+from metrics import Metrics
+from box_ops import box_iou
+from xpdf_process import figures_captions_list
+from tools import LOCAL_TOOLS
+
+STAGES = ('pdftohtml', 'pdf_info', 'box_detection', 'fig_cap_matching', 'evaluation', 'check_region')
+IOU_THRESHOLD = 0.5
+STARTUP_MODULES = ('xpdf_process', 'FigCap', 'extract')
+HEAVY_MODULES = ('matplotlib', 'scipy', 'selenium')
+# Run in a fresh interpreter; prints one json line
+STARTUP_PROBE = '''
+import sys, time, json, resource
+start = time.time()
+import %s
+seconds = time.time() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024.0 ** 2 if sys.platform == 'darwin' else 1024.0)
+print(json.dumps({'seconds': seconds, 'rss_mb': rss, 'heavy': [m for m in %r if m in sys.modules]}))
+'''
+
+
+def load_ground_truth(gt_file):
+    # {pdf name: [figure]} from either format:
+    # GXD: {'123.pdf': [{'figures': [...]}]}, PMC: {'PMC123': {'figures': [...]}}
+    with open(gt_file) as f:
+        gt = json.load(f)
+    ground_truth = {}
+    for name in gt:
+        docs = gt[name]
+        if not isinstance(docs, list):
+            docs = [docs]
+        pdf = name if name.endswith('.pdf') else name + '.pdf'
+        ground_truth[pdf] = []
+        for doc in docs:
+            for figure in doc['figures']:
+                ground_truth[pdf].append({'page': int(figure['page']),
+                                          'region_bb': [float(x) for x in figure['region_bb']],
+                                          'caption_bb': [float(x) for x in figure['caption_bb']],
+                                          'page_width': float(figure['page_width']),
+                                          'page_height': float(figure['page_height'])})
+    return ground_truth
+
+
+def peak_rss_mb():
+    # Peak resident memory of this process and of the finished pdftohtml children
+    scale = 1.0 / 1024 ** 2 if platform.system() == 'Darwin' else 1.0 / 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+def run_document(input_path, pdf, xpdf_path, detection_scale=1):
+    # figures_captions_list with its stage times and counters recorded
+    metrics = Metrics(pdf)
+    html_file_path = xpdf_path + pdf[:-4]
+    with metrics.stage('pdftohtml'):
+        if not os.path.isdir(html_file_path):
+            LOCAL_TOOLS.pdftohtml(PDFTOHTML, input_path + '/' + pdf, html_file_path)
+    figures, info = figures_captions_list(input_path, pdf, xpdf_path, detection_scale=detection_scale,
+                                          metrics=metrics)
+    record = metrics.finish()
+    for stage in STAGES:
+        record['stages'].setdefault(stage, 0.0)
+    record['pages'] = info.page_no
+    record['page_width'] = info.page_width
+    record['page_height'] = info.page_height
+    record['figures'] = []
+    for page in figures:
+        for figure in figures[page]:
+            caption_bb = figure[1][0] if len(figure[1]) > 0 else []
+            record['figures'].append({'page': int(page[4:-4]), 'region_bb': figure[0], 'caption_bb': caption_bb})
+    return record
+
+
+def match_count(predicted, truth, threshold):
+    # One-to-one matches of the boxes of one page, best IoU first
+    pairs = []
+    for i, p_box in enumerate(predicted):
+        for j, t_box in enumerate(truth):
+            iou = box_iou(p_box, t_box)
+            if iou >= threshold:
+                pairs.append((iou, i, j))
+    used_p = set()
+    used_t = set()
+    for iou, i, j in sorted(pairs, reverse=True):
+        if i not in used_p and j not in used_t:
+            used_p.add(i)
+            used_t.add(j)
+    return len(used_p)
+
+
+def unique_boxes(boxes):
+    # Subfigures share one caption, count it once; empty or zero area boxes are no caption
+    found = []
+    for box in boxes:
+        if len(box) == 4 and box[2] > 0 and box[3] > 0 and list(box) not in found:
+            found.append(list(box))
+    return found
+
+
+def score(records, ground_truth, iou_threshold=IOU_THRESHOLD):
+    # Figure and caption precision/recall/F1 over the documents that ran and have ground truth
+    counts = {'figure': [0, 0, 0], 'caption': [0, 0, 0]}  # matched, predicted, true
+    for record in records:
+        if record['status'] != 'ok' or record['pdf'] not in ground_truth:
+            continue
+        truth = ground_truth[record['pdf']]
+        pages = set([figure['page'] for figure in truth] + [figure['page'] for figure in record['figures']])
+        for page in pages:
+            page_truth = [figure for figure in truth if figure['page'] == page]
+            page_predicted = [figure for figure in record['figures'] if figure['page'] == page]
+            # Predictions are in pdftohtml coordinates, the ground truth in its own page size
+            sx = sy = 1.0
+            if page_truth:
+                sx = page_truth[0]['page_width'] / record['page_width']
+                sy = page_truth[0]['page_height'] / record['page_height']
+            for kind, key in (('figure', 'region_bb'), ('caption', 'caption_bb')):
+                t_boxes = [figure[key] for figure in page_truth]
+                p_boxes = [[figure[key][0] * sx, figure[key][1] * sy, figure[key][2] * sx, figure[key][3] * sy]
+                           for figure in page_predicted if len(figure[key]) == 4]
+                if kind == 'caption':
+                    t_boxes = unique_boxes(t_boxes)
+                    p_boxes = unique_boxes(p_boxes)
+                counts[kind][0] = counts[kind][0] + match_count(p_boxes, t_boxes, iou_threshold)
+                counts[kind][1] = counts[kind][1] + len(p_boxes)
+                counts[kind][2] = counts[kind][2] + len(t_boxes)
+    accuracy = {}
+    for kind in counts:
+        matched, predicted, true = counts[kind]
+        precision = float(matched) / predicted if predicted else 0.0
+        recall = float(matched) / true if true else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+        accuracy[kind] = {'precision': precision, 'recall': recall, 'f1': f1,
+                          'matched': matched, 'predicted': predicted, 'true': true}
+    return accuracy
+
+
+def summarize(records, ground_truth, iou_threshold=IOU_THRESHOLD):
+    done = [record for record in records if record['status'] == 'ok']
+    seconds = sum(record['seconds'] for record in done)
+    pages = sum(record['pages'] for record in done)
+    stages = dict((stage, sum(record['stages'][stage] for record in done)) for stage in STAGES)
+    rss_self, rss_children = peak_rss_mb()
+    return {'docs': len(done),
+            'failed': len(records) - len(done),
+            'pages': pages,
+            'seconds': seconds,
+            'docs_per_sec': len(done) / seconds if seconds > 0 else 0.0,
+            'pages_per_sec': pages / seconds if seconds > 0 else 0.0,
+            'stage_seconds': stages,
+            'peak_rss_mb': rss_self,
+            'peak_child_rss_mb': rss_children,
+            'iou_threshold': iou_threshold,
+            'accuracy': score(records, ground_truth, iou_threshold)}
+
+
+def run(input_path, output_path, gt_file, xpdf_path=None, iou_threshold=IOU_THRESHOLD, detection_scale=1,
+        pdfs=None):
+    ground_truth = load_ground_truth(gt_file)
+    if xpdf_path is None:
+        xpdf_path = output_path + '/xpdf/'
+    if not os.path.isdir(xpdf_path):
+        os.makedirs(xpdf_path)
+    if pdfs is None:
+        pdfs = list_pdfs(input_path)
+    records = []
+    for pdf in pdfs:
+        try:
+            record = run_document(input_path, pdf, xpdf_path, detection_scale)
+            record['status'] = 'ok'
+        except Exception as e:
+            record = {'pdf': pdf, 'status': 'error', 'error': repr(e), 'traceback': traceback.format_exc()}
+        records.append(record)
+        if record['status'] == 'ok':
+            print('%s %d pages %.2fs' % (pdf, record['pages'], record['seconds']))
+        else:
+            print('%s %s' % (pdf, record['error']))
+    return {'summary': summarize(records, ground_truth, iou_threshold),
+            'options': {'detection_scale': detection_scale, 'gt': os.path.basename(gt_file)},
+            'documents': records}
+
+
+def startup(modules=STARTUP_MODULES, repeat=5):
+    # {module: {'seconds': median, 'min_seconds', 'rss_mb', 'heavy': [...]}} of cold imports
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    report = {}
+    for module in modules:
+        runs = []
+        for i in range(repeat):
+            output = subprocess.check_output([sys.executable, '-c', STARTUP_PROBE % (module, HEAVY_MODULES)],
+                                             cwd=code_dir)
+            runs.append(json.loads(output.decode('utf-8').strip().split('\n')[-1]))
+        seconds = sorted(run['seconds'] for run in runs)
+        report[module] = {'seconds': seconds[len(seconds) // 2], 'min_seconds': seconds[0],
+                          'rss_mb': max(run['rss_mb'] for run in runs), 'heavy': runs[-1]['heavy']}
+    return report
+
+
+def compare(base, new, tolerance=0.05, f1_tolerance=0.005):
+    # Regressions of new against base: throughput or memory worse than tolerance (relative),
+    # precision/recall/F1 lower by more than f1_tolerance (absolute)
+    regressions = []
+    for key in ('docs_per_sec', 'pages_per_sec'):
+        if new[key] < base[key] * (1 - tolerance):
+            regressions.append('%s %.3f -> %.3f' % (key, base[key], new[key]))
+    for stage in STAGES:
+        # per document, so runs over corpora of different size still compare
+        before = base['stage_seconds'][stage] / max(base['docs'], 1)
+        after = new['stage_seconds'][stage] / max(new['docs'], 1)
+        if after > before * (1 + tolerance) and after - before > 0.001:
+            regressions.append('%s %.4fs -> %.4fs per document' % (stage, before, after))
+    if new['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+        regressions.append('peak_rss_mb %.1f -> %.1f' % (base['peak_rss_mb'], new['peak_rss_mb']))
+    for kind in ('figure', 'caption'):
+        for key in ('precision', 'recall', 'f1'):
+            if new['accuracy'][kind][key] < base['accuracy'][kind][key] - f1_tolerance:
+                regressions.append('%s %s %.4f -> %.4f' % (kind, key, base['accuracy'][kind][key],
+                                                         new['accuracy'][kind][key]))
+    return regressions
+
+
+def print_summary(name, summary):
+    print('%s: %d docs (%d failed), %d pages, %.1fs, %.2f docs/sec, %.2f pages/sec, peak RSS %.0f MB'
+          % (name, summary['docs'], summary['failed'], summary['pages'], summary['seconds'],
+             summary['docs_per_sec'], summary['pages_per_sec'], summary['peak_rss_mb']))
+    for stage in STAGES:
+        print('    %-18s %8.2fs' % (stage, summary['stage_seconds'][stage]))
+    for kind in ('figure', 'caption'):
+        accuracy = summary['accuracy'][kind]
+        print('    %-8s P %.3f  R %.3f  F1 %.3f  (IoU >= %.2f)' % (kind, accuracy['precision'], accuracy['recall'],
+                                                               accuracy['f1'], summary['iou_threshold']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark figure and caption extraction against ground truth')
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help='Run the pipeline over a corpus and write a report')
+    run_parser.add_argument('--input_path', required=True)
+    run_parser.add_argument('--output_path', required=True)
+    run_parser.add_argument('--gt', required=True, help='GT_GXD200.json or GT_PMC200.json')
+    run_parser.add_argument('--xpdf_path', default=None,
+                            help='pdftohtml output to reuse (default: output_path/xpdf/)')
+    run_parser.add_argument('--report', default=None, help='Report file (default: output_path/benchmark.json)')
+    run_parser.add_argument('--iou', type=float, default=IOU_THRESHOLD)
+    run_parser.add_argument('--detection_scale', type=int, choices=[1, 2, 4], default=1)
+    compare_parser = commands.add_parser('compare', help='Flag regressions of a report against a base report')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--tolerance', type=float, default=0.05,
+                                help='Allowed relative loss of speed or memory')
+    compare_parser.add_argument('--f1_tolerance', type=float, default=0.005,
+                                help='Allowed absolute loss of precision, recall or F1')
+    startup_parser = commands.add_parser('startup', help='Time cold imports of the pipeline modules')
+    startup_parser.add_argument('--modules', nargs='+', default=list(STARTUP_MODULES))
+    startup_parser.add_argument('--repeat', type=int, default=5)
+    startup_parser.add_argument('--report', default=None, help='Also write the timings to this json file')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        report = run(args.input_path, args.output_path, args.gt, args.xpdf_path, args.iou, args.detection_scale)
+        report_file = args.report or args.output_path + '/benchmark.json'
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=1)
+        print_summary(report_file, report['summary'])
+    elif args.command == 'compare':
+        with open(args.base) as f:
+            base = json.load(f)['summary']
+        with open(args.new) as f:
+            new = json.load(f)['summary']
+        print_summary(args.base, base)
+        print_summary(args.new, new)
+        regressions = compare(base, new, args.tolerance, args.f1_tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        sys.exit(1 if regressions else 0)
+    elif args.command == 'startup':
+        report = startup(args.modules, args.repeat)
+        for module in args.modules:
+            timing = report[module]
+            print('%-14s %6.3fs (min %.3fs)  RSS %5.0f MB  heavy: %s' % (module, timing['seconds'], timing['min_seconds'],
+                                                                        timing['rss_mb'],
+                                                                        ', '.join(timing['heavy']) or '-'))
+        if args.report is not None:
+            with open(args.report, 'w') as f:
+                json.dump(report, f, indent=1)
+    else:
+        parser.print_help()
@@ -0,0 +1,33 @@
+'''
+box_index is a uniform grid over [x, y, w, h] boxes, to find the boxes that may
+overlap a query box without comparing it against every box of the page.
+'''
+import math
+
+
+class BoxGrid(object):
+
+    def __init__(self, boxes, cell_size=64):
+        self.boxes = boxes
+        self.cell_size = float(cell_size)
+        self.cells = {}
+        for i, box in enumerate(boxes):
+            for cell in self.box_cells(box):
+                self.cells.setdefault(cell, []).append(i)
+
+    def box_cells(self, box):
+        x0 = int(math.floor(box[0] / self.cell_size))
+        y0 = int(math.floor(box[1] / self.cell_size))
+        x1 = int(math.floor((box[0] + box[2]) / self.cell_size))
+        y1 = int(math.floor((box[1] + box[3]) / self.cell_size))
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                yield (cx, cy)
+
+    def candidates(self, box):
+        # Indices (in input order) of every box touching box; a superset of the overlapping ones
+        found = set()
+        for cell in self.box_cells(box):
+            if cell in self.cells:
+                found.update(self.cells[cell])
+        return sorted(found)
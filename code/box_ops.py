@@ -0,0 +1,78 @@
+'''
+box_ops are batched versions of the [x, y, w, h] box functions in xpdf_process.
+They take N x 4 and M x 4 boxes and return N x M matrices, computed with the same
+arithmetic as the scalar functions so the results are exactly the same
+(box_union on integer boxes, as the pipeline's are; test_box_ops checks it):
+    overlap_ratio_matrix   overlap_ratio_based
+    bbox_distance_matrix   bbox_distance
+    box_union              merge_two_boxes over a group of boxes
+box_iou is the scalar intersection over union, shared by the benchmark and the
+embedded image matching.
+'''
+import numpy as np
+
+
+def as_boxes(boxes):
+    boxes = np.asarray(boxes)
+    if boxes.size == 0:
+        return np.zeros((0, 4), dtype=np.int64)
+    return boxes.reshape(-1, 4)
+
+
+def overlap_ratio_matrix(boxes1, boxes2):
+    # [i, j] = overlap_ratio_based(boxes1[i], boxes2[j]), overlap ratio based on boxes1
+    a = as_boxes(boxes1)[:, None, :]
+    b = as_boxes(boxes2)[None, :, :]
+    SI = np.maximum(0, np.minimum(a[..., 0] + a[..., 2], b[..., 0] + b[..., 2]) - np.maximum(a[..., 0], b[..., 0])) * \
+         np.maximum(0, np.minimum(a[..., 1] + a[..., 3], b[..., 1] + b[..., 3]) - np.maximum(a[..., 1], b[..., 1]))
+    box1_area = a[..., 2] * a[..., 3]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        overlap_ratio = np.where(box1_area == 0, 0.0, SI / np.where(box1_area == 0, 1, box1_area))
+    return overlap_ratio
+
+
+def bbox_distance_matrix(boxes1, boxes2):
+    # [i, j] = bbox_distance(boxes1[i], boxes2[j])
+    a = as_boxes(boxes1)[:, None, :]
+    b = as_boxes(boxes2)[None, :, :]
+    x1 = a[..., 0]
+    y1 = a[..., 1]
+    x1b = a[..., 0] + a[..., 2]
+    y1b = a[..., 1] + a[..., 3]
+    x2 = b[..., 0]
+    y2 = b[..., 1]
+    x2b = b[..., 0] + b[..., 2]
+    y2b = b[..., 1] + b[..., 3]
+    left = x2b < x1
+    right = x1b < x2
+    bottom = y2b < y1
+    top = y1b < y2
+    conditions = [top & left, left & bottom, bottom & right, right & top, left, right, bottom, top]
+    choices = [abs(x1 - x2b) + abs(y1b - y2),
+               abs(x1 - x2b) + abs(y1 - y2b),
+               abs(x1b - x2) + abs(y1 - y2b),
+               abs(x1b - x2) + abs(y1b - y2),
+               x1 - x2b, x2 - x1b, y1 - y2b, y2 - y1b]
+    conditions = [np.broadcast_to(c, left.shape) for c in conditions]
+    choices = [np.broadcast_to(c, left.shape) for c in choices]
+    return np.select(conditions, choices, 0)
+
+
+def box_union(boxes):
+    # Bounding box of all boxes, as a list like merge_two_boxes returns
+    b = as_boxes(boxes)
+    x0 = b[:, 0].min()
+    y0 = b[:, 1].min()
+    x1 = (b[:, 0] + b[:, 2]).max()
+    y1 = (b[:, 1] + b[:, 3]).max()
+    return [x0.item(), y0.item(), (x1 - x0).item(), (y1 - y0).item()]
+
+
+def box_iou(box1, box2):
+    # Intersection over union of two [x, y, w, h] boxes
+    iw = min(box1[0] + box1[2], box2[0] + box2[2]) - max(box1[0], box2[0])
+    ih = min(box1[1] + box1[3], box2[1] + box2[3]) - max(box1[1], box2[1])
+    if iw <= 0 or ih <= 0:
+        return 0.0
+    intersection = float(iw * ih)
+    return intersection / (box1[2] * box1[3] + box2[2] * box2[3] - intersection)
@@ -0,0 +1,152 @@
+'''
+crop_writer writes the figure crops and caption texts of one document.
+
+The crops are encoded on a thread pool (PIL releases the GIL while encoding) as
+JPEG, PNG or WebP with the given quality/optimize settings. They go either to
+single files in the document folder, as FigCap.py always wrote them:
+
+    <name>/2_1.jpg  <name>/2_1.txt  ...
+
+or, with archive='zip' or 'tar', into one <name>/<name>.zip (or .tar) holding
+the same files plus manifest.json, the list of its figures:
+
+    [{"file": "2_1.jpg", "caption_file": "2_1.txt", "page": 2, "order": 1,
+      "region_bb": [...], "caption_bb": [...], "caption_text": [...]}, ...]
+'''
+import io
+import os
+import json
+import time
+import tarfile
+import zipfile
+from multiprocessing.pool import ThreadPool
+
+FORMATS = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp'}
+ARCHIVES = ('zip', 'tar')
+
+
+def encode_options(image_format, quality=None, optimize=False):
+    # Keyword arguments of PIL Image.save for a format
+    options = {}
+    if quality is not None and image_format in ('JPEG', 'WEBP'):
+        options['quality'] = quality
+    if optimize and image_format in ('JPEG', 'PNG'):
+        options['optimize'] = True
+    if image_format == 'WEBP' and optimize:
+        options['method'] = 6
+    return options
+
+
+def encode_crop(image, image_format='JPEG', options=None):
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, **(options or {}))
+    return buffer.getvalue()
+
+
+def content_of(crop):
+    # Encoded bytes, or the pool result that will hold them
+    if isinstance(crop, bytes):
+        return crop
+    return crop.get()
+
+
+class CropWriter(object):
+
+    def __init__(self, output_dir, name, image_format='JPEG', quality=None, optimize=False, threads=1, archive=None):
+        # output_dir: the document folder; name: document name without .pdf, names the archive
+        # threads: crops encoded at a time; archive: None, 'zip' or 'tar'
+        image_format = image_format.upper()
+        if image_format not in FORMATS:
+            raise ValueError('Unknown crop format %s, use one of %s' % (image_format, ', '.join(sorted(FORMATS))))
+        if archive is not None and archive not in ARCHIVES:
+            raise ValueError('Unknown archive %s, use zip or tar' % archive)
+        self.output_dir = output_dir
+        self.name = name
+        self.image_format = image_format
+        self.options = encode_options(image_format, quality, optimize)
+        self.archive = archive
+        self.pool = ThreadPool(threads) if threads > 1 else None
+        self.pending = []
+        self.manifest = []
+
+    def add(self, page_no, order_no, image, region_bb, caption_bb=None, caption_text=None):
+        # Queue one crop; caption_text is written next to it if there is a caption
+        entry = self.entry(page_no, order_no, FORMATS[self.image_format], region_bb, caption_bb, caption_text)
+        if self.pool is not None:
+            self.pending.append((entry, self.pool.apply_async(encode_crop, (image, self.image_format, self.options))))
+        else:
+            self.pending.append((entry, encode_crop(image, self.image_format, self.options)))
+        if self.archive is None:
+            self.flush()
+
+    def add_encoded(self, page_no, order_no, content, extension, region_bb, caption_bb=None, caption_text=None):
+        # Queue an image file as it is, such as the JPEG embedded in the pdf
+        entry = self.entry(page_no, order_no, extension, region_bb, caption_bb, caption_text)
+        entry['native'] = True
+        self.pending.append((entry, content))
+        if self.archive is None:
+            self.flush()
+
+    def entry(self, page_no, order_no, extension, region_bb, caption_bb, caption_text):
+        base = str(page_no) + '_' + str(order_no)
+        entry = {'file': base + extension, 'page': page_no, 'order': order_no,
+                 'region_bb': region_bb, 'caption_bb': [], 'caption_text': []}
+        if caption_bb is not None:
+            entry['caption_bb'] = caption_bb
+            entry['caption_text'] = caption_text
+            entry['caption_file'] = base + '.txt'
+        self.manifest.append(entry)
+        return entry
+
+    def flush(self):
+        # Write the crops encoded so far as single files, in the order they were added
+        while self.pending and (isinstance(self.pending[0][1], bytes) or self.pending[0][1].ready()):
+            entry, crop = self.pending.pop(0)
+            self.write_file(entry, content_of(crop))
+
+    def write_file(self, entry, crop):
+        with open(os.path.join(self.output_dir, entry['file']), 'wb') as f:
+            f.write(crop)
+        if 'caption_file' in entry:
+            with open(os.path.join(self.output_dir, entry['caption_file']), 'w') as capoutput:
+                capoutput.write(str(entry['caption_text']))
+
+    def close(self):
+        # Wait for every crop; returns the archive path, or None for single files
+        pending, self.pending = self.pending, []
+        pending = [(entry, content_of(crop)) for entry, crop in pending]
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        if self.archive is None:
+            for entry, crop in pending:
+                self.write_file(entry, crop)
+            return None
+        files = []
+        for entry, crop in pending:
+            files.append((entry['file'], crop))
+            if 'caption_file' in entry:
+                files.append((entry['caption_file'], str(entry['caption_text']).encode('utf-8')))
+        files.append(('manifest.json', json.dumps(self.manifest).encode('utf-8')))
+        archive_file = os.path.join(self.output_dir, self.name + '.' + self.archive)
+        write_archive(archive_file, self.archive, files)
+        return archive_file
+
+
+def write_archive(archive_file, archive, files):
+    # files: [(name, bytes)]; written to a temp name first so a crash never leaves a partial archive
+    temp_file = archive_file + '.tmp'
+    if archive == 'zip':
+        # the crops are compressed already
+        with zipfile.ZipFile(temp_file, 'w', zipfile.ZIP_STORED) as f:
+            for name, content in files:
+                f.writestr(name, content)
+    else:
+        with tarfile.open(temp_file, 'w') as f:
+            now = time.time()
+            for name, content in files:
+                member = tarfile.TarInfo(name)
+                member.size = len(content)
+                member.mtime = now
+                f.addfile(member, io.BytesIO(content))
+    os.rename(temp_file, archive_file)
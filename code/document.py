@@ -0,0 +1,137 @@
+'''
+document is the page-keyed model of one pdf, built once by pdf_info from the
+html_info list, so every stage looks a page up directly instead of scanning
+html_info for a matching page number.
+
+document[3] or document.named('page3.png') -> Page
+    page_no
+    elements    TextElement(box, text) in html order, box an (x, y, w, h) tuple
+    size        (height, width) of the page image
+    word_boxes  element boxes widened by row_height on both sides
+    boxes       element boxes as one N x 4 array, int unless a box is fractional
+    find(box, start), next_long_line(start, y)
+                positions in elements, from indexes built on first use
+
+Layout is the frozen layout info of the pdf (what pdf_info used to return as the
+info dict): info.row_height, info.columns, ... Its list fields (columns, the
+*_bbox boxes, text_layout) are stored as tuples. Stages that learn something new
+about the layout return info._replace(...) instead of changing it.
+'''
+import bisect
+from collections import namedtuple
+import numpy as np
+
+# A caption line of a separate caption has more than this many characters
+LONG_LINE = 30
+
+
+def page_name(page_no):
+    return 'page%d.png' % page_no
+
+
+LAYOUT_FIELDS = ('filename', 'page_no', 'page_height', 'page_width', 'row_height', 'row_width',
+                 'text_layout', 'column_no', 'columns', 'left_bbox', 'right_bbox', 'top_bbox',
+                 'down_bbox', 'mess_up', 'graph_layout', 'fig_no_est', 'png_ratio')
+# Lists in the info dict (and in its json), tuples in Layout
+LAYOUT_SEQUENCES = ('text_layout', 'columns', 'left_bbox', 'right_bbox', 'top_bbox', 'down_bbox', 'graph_layout')
+
+
+class Layout(namedtuple('Layout', LAYOUT_FIELDS)):
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, info):
+        # Fields pdf_info does not know yet (fig_no_est, png_ratio) are None
+        fields = dict((field, info.get(field)) for field in cls._fields)
+        for field in LAYOUT_SEQUENCES:
+            if fields[field] is not None:
+                fields[field] = tuple(fields[field])
+        return cls(**fields)
+
+    def as_dict(self):
+        return dict(self._asdict())
+
+
+class TextElement(namedtuple('TextElement', ['box', 'text'])):
+    # One html text line; unpacks and indexes like the [[x, y, w, h], text] lists of html_info
+    __slots__ = ()
+
+
+class Page(object):
+    __slots__ = ('page_no', 'elements', 'size', 'word_boxes', 'boxes', 'box_positions', 'long_lines')
+
+    def __init__(self, page_no, elements, size, row_height=0):
+        self.page_no = page_no
+        self.elements = [TextElement(tuple(box), text) for box, text in elements]
+        self.size = tuple(size)
+        # int64 for pdftohtml's integer boxes, float64 if any coordinate is fractional (browser layout)
+        self.boxes = np.array([box for box, text in elements]).reshape(-1, 4)
+        self.word_boxes = [[max(box[0] - row_height, 0), box[1], box[2] + 2 * row_height, box[3]]
+                           for box, text in elements]
+        self.box_positions = None
+        self.long_lines = None
+
+    def index(self):
+        # Positions of each element box, and of the long lines, in html order
+        self.box_positions = {}
+        self.long_lines = []
+        for position, (box, text) in enumerate(self.elements):
+            self.box_positions.setdefault(tuple(box), []).append(position)
+            if len(text) > LONG_LINE:
+                self.long_lines.append(position)
+
+    def find(self, box, start=0):
+        # First position >= start of an element with this box, or None
+        if self.box_positions is None:
+            self.index()
+        positions = self.box_positions.get(tuple(box), [])
+        i = bisect.bisect_left(positions, start)
+        if i < len(positions):
+            return positions[i]
+        return None
+
+    def next_long_line(self, start, y):
+        # First position >= start of a long line below y, or None
+        if self.long_lines is None:
+            self.index()
+        for position in self.long_lines[bisect.bisect_left(self.long_lines, start):]:
+            if self.elements[position][0][1] > y:
+                return position
+        return None
+
+
+class Document(object):
+    __slots__ = ('html_info', 'pages', 'by_name')
+
+    def __init__(self, html_info, row_height=0):
+        self.html_info = html_info
+        self.pages = {}
+        self.by_name = {}
+        for page_no, elements, size in html_info:
+            page = Page(page_no, elements, size, row_height)
+            self.pages[page_no] = page
+            self.by_name[page_name(page_no)] = page
+
+    def __getitem__(self, page_no):
+        return self.pages[page_no]
+
+    def __contains__(self, page_no):
+        return page_no in self.pages
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __iter__(self):
+        # Pages in page number order
+        for page_no in sorted(self.pages):
+            yield self.pages[page_no]
+
+    def named(self, name):
+        # Page of a 'pageN.png' name, as used for the keys of the figure dicts
+        return self.by_name[name]
+
+    def get(self, page_no):
+        # Page, or an empty one for a page pdftohtml wrote no html for
+        if page_no in self.pages:
+            return self.pages[page_no]
+        return Page(page_no, [], (0, 0))
@@ -0,0 +1,120 @@
+'''
+extract is the library entry point: figures and captions of one pdf given as
+bytes or a file object, returned as typed results instead of files.
+
+    from extract import extract
+    result = extract(open('x.pdf', 'rb'), crop_format='JPEG')
+    for figure in result.figures:
+        figure.page, figure.region_bb, figure.caption_text, len(figure.crop)
+
+The pdf, the pdftohtml output and the page renders live in one scratch
+directory, on tmpfs (/dev/shm) when there is one, which is removed before
+extract returns. Crops are encoded in memory. result.as_dict() is the same
+record FigCap.py writes to <name>.json.
+'''
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+import renderer
+from FigCap import RENDER_DPI, detect_figures, figure_pages
+from metrics import NULL_METRICS
+from crop_writer import FORMATS, encode_crop
+
+SHM_DIR = '/dev/shm'
+
+
+class Figure(namedtuple('Figure', ['page', 'order', 'region_bb', 'caption_bb', 'caption_text', 'crop'])):
+    """
+        One figure: page number (1-based), order on the page, region and caption boxes in
+        page coordinates ([x, y, w, h], caption_bb [] without a caption), the caption
+        lines, and the crop encoded as crop_format (None unless asked for).
+    """
+    __slots__ = ()
+
+
+class Extraction(namedtuple('Extraction', ['pdf', 'fig_no', 'page_width', 'page_height', 'figures'])):
+    __slots__ = ()
+
+    def as_dict(self):
+        # The data[pdf] record of FigCap.process_pdf
+        return {'fig_no': self.fig_no,
+                'pages_annotated': [],
+                'figures': [{'page': figure.page,
+                             'region_bb': figure.region_bb,
+                             'figure_type': 'Figure',
+                             'page_width': self.page_width,
+                             'page_height': self.page_height,
+                             'caption_bb': figure.caption_bb,
+                             'caption_text': figure.caption_text} for figure in self.figures]}
+
+
+def scratch_dir(work_dir=None):
+    if work_dir is None and os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK):
+        work_dir = SHM_DIR
+    return tempfile.mkdtemp(prefix='pdfigcapx-', dir=work_dir)
+
+
+def extract(pdf, name='document.pdf', dpi=RENDER_DPI, crop_format=None, crop_options=None, detection_scale=1,
+            page_workers=1, metrics=NULL_METRICS, work_dir=None, single_render=False, embedded_images=False):
+    """
+        Figures and captions of a pdf given as bytes or a binary file object.
+        name: file name reported in the result, must end in .pdf
+        crop_format: PIL format ('JPEG', 'PNG', 'WEBP') to return figure crops in; None for no crops
+        crop_options: keyword arguments of PIL Image.save, such as quality
+        work_dir: where the scratch directory goes (default: /dev/shm if writable, else the temp dir)
+        single_render, embedded_images: as for FigCap.process_pdf; with embedded_images a JPEG
+        crop of a figure that is one embedded JPEG image is that image's own file
+    """
+    if hasattr(pdf, 'read'):
+        pdf = pdf.read()
+    name = os.path.basename(name)
+    work = scratch_dir(work_dir)
+    try:
+        pdf_path = os.path.join(work, name)
+        with open(pdf_path, 'wb') as f:
+            f.write(pdf)
+        xpdf_path = work + '/xpdf/'
+        os.mkdir(xpdf_path)
+        pages = renderer.LazyPages(pdf_path, dpi, output_dir=os.path.join(work, 'render'))
+        os.mkdir(pages.outputDir)
+        figures, info, native = detect_figures(work + '/', name, xpdf_path, pages, single_render,
+                                               detection_scale=detection_scale, metrics=metrics,
+                                               page_workers=page_workers, embedded_images=embedded_images)
+        # Embedded images are returned as they are only where they already are in crop_format
+        native = dict((key, image_file) for key, image_file in (native or {}).items()
+                      if image_file[1] == FORMATS.get(crop_format))
+        if crop_format is not None:
+            with metrics.stage('render'):
+                pages.render(figure_pages(figures, native))
+        else:
+            pages = None
+        with metrics.stage('save_figures'):
+            results = figure_results(figures, info, pages, crop_format, crop_options or {}, native)
+        return Extraction(name, info.fig_no_est, info.page_width, info.page_height, results)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def figure_results(figures, info, pages=None, crop_format=None, crop_options=None, native=None):
+    # Figure tuples in the order FigCap.save_figures writes them
+    # native: {(page_no, order_no): (bytes, extension)} returned as the crop instead of cropping
+    native = native or {}
+    results = []
+    for figure in figures:
+        page_no = int(figure[4:-4])
+        page_fig = None
+        for order_no, bbox in enumerate(figures[figure], 1):
+            crop = None
+            if (page_no, order_no) in native:
+                crop = native[(page_no, order_no)][0]
+            elif pages is not None:
+                if page_fig is None:
+                    page_fig = pages[page_no]
+                    png_ratio = renderer.crop_ratio(page_fig.size, info)
+                crop = encode_crop(renderer.crop_region(page_fig, bbox[0], png_ratio), crop_format, crop_options)
+            if len(bbox[1]) > 0:
+                results.append(Figure(page_no, order_no, bbox[0], bbox[1][0], bbox[1][1], crop))
+            else:
+                results.append(Figure(page_no, order_no, bbox[0], [], [], crop))
+    return results
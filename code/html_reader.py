@@ -0,0 +1,142 @@
+'''
+html_reader is to read the pdftohtml page html without a browser
+Each page html from xpdf looks like:
+<img id="background" style="position:absolute; left:0px; top:0px;" width="612" height="792" src="page1.png">
+<div class="txt" style="position:absolute; left:90px; top:79px;"><span id="f1" style="font-size:18px;...">Text</span></div>
+
+Positions come straight from the inline css. xpdf does not write the size of a
+text div, so width and height are estimated from the font size and the
+standard font metrics (Helvetica/Times/Courier, same widths as the
+Arial/Liberation fonts Chrome falls back to).
+'''
+import os
+import re
+from lxml import etree
+
+# Advance widths (1/1000 em) for printable ascii 32-126, from the standard AFM files
+HELVETICA_WIDTHS = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584]
+TIMES_WIDTHS = [
+    250, 333, 408, 500, 500, 833, 778, 180, 333, 333, 500, 564, 250, 333, 250, 278,
+    500, 500, 500, 500, 500, 500, 500, 500, 500, 500, 278, 278, 564, 564, 564, 444,
+    921, 722, 667, 667, 722, 611, 556, 722, 722, 333, 389, 722, 611, 889, 722, 722,
+    556, 722, 667, 556, 611, 722, 722, 944, 722, 722, 611, 333, 278, 333, 469, 500,
+    333, 444, 500, 444, 500, 444, 333, 500, 500, 278, 278, 500, 278, 778, 500, 500,
+    500, 500, 333, 389, 278, 500, 500, 722, 500, 500, 444, 480, 200, 480, 541]
+COURIER_WIDTH = 600
+BOLD_FACTOR = 1.05
+LINE_HEIGHT = 1.15  # css line-height: normal for the default fonts
+
+CSS_PROPERTY = re.compile(r'([\w-]+)\s*:\s*([^;]+)')
+CSS_RULE = re.compile(r'#([\w-]+)\s*\{([^}]*)\}')
+ROTATE = re.compile(r'rotate\(\s*(-?[\d.]+)deg\s*\)')
+
+
+def read_html_page(html_file):
+    # Same output as reading the page in Chrome: [page_no, text_boxes, img_size]
+    parser = etree.HTMLParser(encoding='utf-8')
+    tree = etree.parse(html_file, parser)
+    fonts = font_styles(tree)
+
+    img_size = (0, 0)
+    for img in tree.xpath('/html/body/img'):
+        style = parse_style(img.get('style'))
+        height = img.get('height') or style.get('height')
+        width = img.get('width') or style.get('width')
+        img_size = (int(round(css_length(height))), int(round(css_length(width))))
+        break
+
+    text_boxes = []
+    for element in tree.xpath('/html/body/div'):
+        text = element_text(element)
+        if len(text) > 0:
+            text_boxes.append([element_box(element, fonts), text])
+    page_no = int(os.path.basename(html_file)[4:-5])
+    return [page_no, text_boxes, img_size]
+
+
+def element_box(element, fonts):
+    style = parse_style(element.get('style'))
+    x = int(round(css_length(style.get('left'))))
+    y = int(round(css_length(style.get('top'))))
+    width = 0.0
+    height = 0.0
+    spans = element.xpath('.//span')
+    if not spans:
+        spans = [element]
+    for span in spans:
+        span_style = parse_style(span.get('style'))
+        font_size = css_length(span_style.get('font-size')) or 16.0
+        font = fonts.get(span.get('id'), {})
+        width = width + text_width(span_text(span), font_size, font)
+        height = max(height, LINE_HEIGHT * font_size)
+    if 'width' in style:
+        width = css_length(style['width'])
+    if 'height' in style:
+        height = css_length(style['height'])
+    rotate = ROTATE.search(style.get('transform', ''))
+    if rotate is not None and int(float(rotate.group(1))) % 180 != 0:
+        width, height = height, width
+    return [x, y, int(round(width)), int(round(height))]
+
+
+def text_width(text, font_size, font):
+    family = font.get('font-family', 'sans-serif').lower()
+    if 'mono' in family or 'courier' in family:
+        advance = COURIER_WIDTH * len(text)
+    else:
+        if ('serif' in family and 'sans' not in family) or 'times' in family:
+            widths = TIMES_WIDTHS
+        else:
+            widths = HELVETICA_WIDTHS
+        advance = 0
+        for char in text:
+            code = ord(char)
+            if 32 <= code <= 126:
+                advance = advance + widths[code - 32]
+            else:
+                advance = advance + widths[ord('n') - 32]
+    if font.get('font-weight', 'normal').strip() in ('bold', 'bolder', '700', '800', '900'):
+        advance = advance * BOLD_FACTOR
+    return advance * font_size / 1000.0
+
+
+def font_styles(tree):
+    # xpdf defines each font once in <style>: #f0 { font-family:serif; font-weight:bold; }
+    fonts = {}
+    for style in tree.xpath('//style'):
+        for name, body in CSS_RULE.findall(style.text or ''):
+            fonts[name] = parse_style(body)
+    return fonts
+
+
+def parse_style(style):
+    properties = {}
+    if style:
+        for name, value in CSS_PROPERTY.findall(style):
+            properties[name.strip().lower()] = value.strip()
+    return properties
+
+
+def css_length(value):
+    # '90.5px' -> 90.5
+    if value is None:
+        return 0.0
+    match = re.match(r'\s*(-?[\d.]+)', value)
+    if match is None:
+        return 0.0
+    return float(match.group(1))
+
+
+def span_text(span):
+    return ' '.join(''.join(span.itertext()).split())
+
+
+def element_text(element):
+    # Visible text as a browser reports it: whitespace collapsed and trimmed
+    return ' '.join(''.join(element.itertext()).replace(u'\xa0', u' ').split())
@@ -0,0 +1,207 @@
+'''
+layout_cache is a persistent cache of the per-document layout work:
+the pdftohtml output, the html_info read from it and the info dict from pdf_info.
+Entries are keyed on the sha256 of the pdf content plus the pdftohtml version and
+arguments, so a changed pdf with the same filename is never served stale results.
+
+cache_dir/ab/abcdef.../
+    html/            pdftohtml output (pageN.html, pageN.png)
+    html_info.json
+    info.json
+    meta.json        pdf name, size in bytes; its mtime is the last use (LRU)
+
+Usage: python layout_cache.py CACHE_DIR [--prune MAX_BYTES]
+'''
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import subprocess
+import argparse
+from tools import LOCAL_TOOLS
+
+# Bump when pdf_info/html_reader change what they store
+LAYOUT_VERSION = '1'
+tool_versions = {}
+
+
+def tool_version(tool):
+    # First line of `tool -v`; xpdf prints it on stderr and exits non-zero
+    if tool not in tool_versions:
+        try:
+            process = subprocess.Popen([tool, '-v'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = process.communicate()[0].decode('utf-8', 'replace').strip()
+            tool_versions[tool] = output.split('\n')[0]
+        except OSError:
+            tool_versions[tool] = 'missing'
+    return tool_versions[tool]
+
+
+def file_hash(pdf_path):
+    sha = hashlib.sha256()
+    with open(pdf_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def tree_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            size = size + os.path.getsize(os.path.join(root, name))
+    return size
+
+
+class LayoutCache(object):
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                pass
+
+    def key(self, pdf_path, tool, args=()):
+        variant = '\n'.join([LAYOUT_VERSION, tool_version(tool)] + list(args))
+        return file_hash(pdf_path)[:40] + hashlib.sha256(variant.encode('utf-8')).hexdigest()[:24]
+
+    def entry(self, pdf_path, tool, args=(), tools=None):
+        # Entry for this pdf content, running `tool [args] pdf html/` if it is not cached yet
+        # tools: tools.Tools that runs it (default: here, as a child process)
+        key = self.key(pdf_path, tool, args)
+        path = os.path.join(self.cache_dir, key[:2], key)
+        if not os.path.isdir(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    pass
+            # Build next to the final place and rename, so concurrent workers never see half an entry
+            build = tempfile.mkdtemp(prefix='.build-', dir=self.cache_dir)
+            try:
+                command = [tool] + list(args) + [pdf_path, os.path.join(build, 'html') + '/']
+                (tools or LOCAL_TOOLS).run('pdftohtml', command)
+                write_json(os.path.join(build, 'meta.json'),
+                           {'pdf': os.path.basename(pdf_path), 'size': tree_size(build), 'created': time.time()})
+                os.rename(build, path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+            finally:
+                shutil.rmtree(build, ignore_errors=True)
+        entry = CacheEntry(path)
+        entry.touch()
+        return entry
+
+    def entries(self):
+        # [(key, size, last_used, pdf)], least recently used first
+        found = []
+        for fan_out in os.listdir(self.cache_dir):
+            fan_path = os.path.join(self.cache_dir, fan_out)
+            if fan_out.startswith('.') or not os.path.isdir(fan_path):
+                continue
+            for key in os.listdir(fan_path):
+                meta_file = os.path.join(fan_path, key, 'meta.json')
+                try:
+                    meta = read_json(meta_file)
+                    found.append((key, meta['size'], os.path.getmtime(meta_file), meta['pdf']))
+                except (IOError, OSError, ValueError):
+                    pass
+        return sorted(found, key=lambda x: x[2])
+
+    def total_size(self):
+        return sum(entry[1] for entry in self.entries())
+
+    def prune(self, max_bytes=None, keep_since=None):
+        # Evict least recently used entries until the cache fits in max_bytes.
+        # keep_since: while a run is going on, its start time; entries used since then may
+        # be in use by a worker and are kept, even if the cache stays over max_bytes
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        if max_bytes is None:
+            return []
+        entries = self.entries()
+        total = sum(entry[1] for entry in entries)
+        evicted = []
+        for key, size, last_used, pdf in entries:
+            if total <= max_bytes:
+                break
+            path = os.path.join(self.cache_dir, key[:2], key)
+            if keep_since is not None and last_used_since(path, keep_since):
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total = total - size
+            evicted.append(key)
+        # Leftovers of builds killed half way
+        for name in os.listdir(self.cache_dir):
+            build = os.path.join(self.cache_dir, name)
+            if name.startswith('.build-') and time.time() - os.path.getmtime(build) > 24 * 3600:
+                shutil.rmtree(build, ignore_errors=True)
+        return evicted
+
+
+def last_used_since(path, since):
+    # Looked again right before eviction: a worker may have just taken the entry
+    try:
+        return os.path.getmtime(os.path.join(path, 'meta.json')) >= since
+    except OSError:
+        return False
+
+
+class CacheEntry(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.html_dir = os.path.join(path, 'html')
+
+    def load(self, name):
+        try:
+            return read_json(os.path.join(self.path, name + '.json'))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, name, obj):
+        write_json(os.path.join(self.path, name + '.json'), obj)
+        meta_file = os.path.join(self.path, 'meta.json')
+        meta = read_json(meta_file)
+        meta['size'] = tree_size(self.path)
+        write_json(meta_file, meta)
+
+    def touch(self):
+        try:
+            os.utime(os.path.join(self.path, 'meta.json'), None)
+        except OSError:
+            pass
+
+
+def read_json(file_name):
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def write_json(file_name, obj):
+    temp_file = '%s.%d.tmp' % (file_name, os.getpid())
+    with open(temp_file, 'w') as f:
+        json.dump(obj, f)
+    os.rename(temp_file, file_name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Inspect or prune a layout cache')
+    parser.add_argument('cache_dir')
+    parser.add_argument('--prune', type=int, default=None, metavar='MAX_BYTES',
+                        help='Evict least recently used entries until the cache fits')
+    args = parser.parse_args()
+    cache = LayoutCache(args.cache_dir)
+    if args.prune is not None:
+        print('evicted %d entries' % len(cache.prune(args.prune)))
+    entries = cache.entries()
+    print('%d entries, %d bytes' % (len(entries), sum(entry[1] for entry in entries)))
+    if entries:
+        print('least recently used: %s (%s)' % (entries[0][3], time.ctime(entries[0][2])))
+        print('most recently used: %s (%s)' % (entries[-1][3], time.ctime(entries[-1][2])))
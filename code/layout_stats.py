@@ -0,0 +1,91 @@
+'''
+layout_stats computes the text layout of a pdf from its long text lines
+(row height/width, columns, margin boxes) for pdf_info.
+
+Modes are counted with np.unique instead of list.count per value, and left
+points within 10px are merged with a sorted index instead of a nested scan,
+so a long document costs O(n log n) rather than O(n^2). Ties are broken in
+the same order as before, so the results are the same.
+'''
+import bisect
+import numpy as np
+
+# Left points this close belong to the same column
+COLUMN_MERGE = 10
+
+
+def value_counts(values):
+    # [(value, count)] most common first, ties in set(values) order
+    uniques, counts = np.unique(np.asarray(values), return_counts=True)
+    count_of = dict(zip(uniques.tolist(), counts.tolist()))
+    return sorted([(i, count_of[i]) for i in set(values)], key=lambda x: x[1], reverse=True)
+
+
+def merge_close_points(point_counts, distance=COLUMN_MERGE):
+    # Going from the most common point, each point takes over the counts of the
+    # remaining points within distance of it. Returns [(point, count)] most common first.
+    points = sorted(set(point for point, count in point_counts))
+    count_of = dict(point_counts)
+    alive = set(points)
+    merged = []
+    for point, count in point_counts:
+        if point not in alive:
+            continue
+        alive.discard(point)
+        for i in range(bisect.bisect_left(points, point - distance), len(points)):
+            other = points[i]
+            if other > point + distance:
+                break
+            if other in alive:
+                count = count + count_of[other]
+                alive.discard(other)
+        merged.append((point, count))
+    return sorted(merged, key=lambda x: x[1], reverse=True)
+
+
+def layout_statistics(left_point, right_point, top_point, row_width, row_height, page_width, page_height):
+    # Layout fields of info from the long lines of the checked pages
+    layout = {}
+    layout['row_height'] = value_counts(row_height)[0][0]
+    layout['row_width'] = value_counts(row_width)[0][0]
+    layout['text_layout'] = (max(0, min(top_point)),
+                             min(page_height, max(top_point)))
+
+    # Compute column no and position for each column
+    point_left = merge_close_points(value_counts(left_point))
+    columns = [0]
+    if float(point_left[0][1]) / len(left_point) > 0.75 \
+            or float(layout['row_width']) / page_width > 0.5:
+        column_no = 1
+        columns = [point_left[0][0]]
+    else:
+        column_no = 2
+        for i in range(1, len(point_left)):
+            if abs(point_left[i][0] - point_left[0][0]) > layout['row_width']:
+                columns = [min(point_left[i][0], point_left[0][0]),
+                           max(point_left[i][0], point_left[0][0])]
+                break
+    layout['column_no'] = column_no
+    layout['columns'] = columns
+
+    row_height = layout['row_height']
+    text_layout = layout['text_layout']
+    left_bar = min(left_point)
+    right_bar = max(right_point)
+    # pdf layout
+    if left_bar > 0 and left_bar < 20 * row_height:
+        layout['left_bbox'] = [0, 0, left_bar, page_height]
+        layout['right_bbox'] = [min(page_width - 2 * row_height, right_bar),
+                                0, page_width - min(page_width - 2 * row_height, right_bar), page_height]
+        if text_layout[0] < 15 * row_height and text_layout[1] > 15 * row_height:
+            layout['top_bbox'] = [0, 0, page_width, text_layout[0]]
+            layout['down_bbox'] = [0, text_layout[1], page_width, page_height - text_layout[1]]
+        else:
+            layout['top_bbox'] = [0, 0, page_width, row_height]
+            layout['down_bbox'] = [0, page_height - row_height, page_width, row_height]
+    else:
+        layout['left_bbox'] = [0, 0, row_height, page_height]
+        layout['right_bbox'] = [page_width - row_height, 0, row_height, page_height]
+        layout['top_bbox'] = [0, 0, page_width, row_height]
+        layout['down_bbox'] = [0, page_height - row_height, page_width, row_height]
+    return layout
@@ -0,0 +1,139 @@
+'''
+manifest is the checkpoint log of a corpus run, so a restarted run skips the
+documents it already finished and retries only the failed or unfinished ones.
+
+Every line is the new state of one pdf, the last line of a pdf wins:
+
+{"pdf": "x.pdf", "state": "detected", "error": null,
+ "hash": "9f2c...", "size": 1048576, "mtime": 1700000000.0}
+
+state is the last stage the pdf completed, in pipeline order:
+parsed (pdftohtml output), detected (figures_captions_list), rendered (the
+figure pages) and written (crops and json, or its record in the results file).
+error is set when the pdf failed after that stage. hash is the sha256 of the
+pdf, so a pdf changed under the same name starts over; it is only recomputed
+when the size or mtime of the file changed.
+
+Workers append their lines with a single O_APPEND write each, so any number of
+them can update the manifest without a lock. The parent reads it once when a
+run starts and compacts it to one line per pdf.
+'''
+import os
+import json
+import time
+from layout_cache import file_hash
+
+STATES = ('parsed', 'detected', 'rendered', 'written')
+
+
+def append_line(file_name, record):
+    line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+    fd = os.open(file_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def state_index(entry):
+    if entry is None or entry.get('state') not in STATES:
+        return -1
+    return STATES.index(entry['state'])
+
+
+def same_content(entry, pdf_path, stat=None):
+    # Size and mtime unchanged, or else the same sha256
+    if entry is None or entry.get('hash') is None:
+        return False
+    if stat is None:
+        stat = os.stat(pdf_path)
+    if entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime:
+        return True
+    return entry['hash'] == file_hash(pdf_path)
+
+
+class Manifest(object):
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.entries = {}
+        if os.path.isfile(file_name):
+            self.load()
+
+    def load(self):
+        with open(self.file_name, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # a line cut short by a crash
+                    continue
+                entry = self.entries.setdefault(record['pdf'], {})
+                entry.update(record)
+
+    def compact(self):
+        # Rewrite with one line per pdf; only while no worker is writing
+        temp_name = self.file_name + '.tmp'
+        with open(temp_name, 'wb') as f:
+            for pdf in sorted(self.entries):
+                f.write((json.dumps(self.entries[pdf], separators=(',', ':')) + '\n').encode('utf-8'))
+        os.rename(temp_name, self.file_name)
+
+    def update(self, pdf, **fields):
+        fields['pdf'] = pdf
+        fields['time'] = time.time()
+        append_line(self.file_name, fields)
+        self.entries.setdefault(pdf, {}).update(fields)
+
+    def done(self, pdf, pdf_path):
+        entry = self.entries.get(pdf)
+        return (state_index(entry) == len(STATES) - 1 and entry.get('error') is None
+                and same_content(entry, pdf_path))
+
+    def pending(self, input_path, pdfs):
+        return [pdf for pdf in pdfs if not self.done(pdf, input_path + '/' + pdf)]
+
+    def checkpoint(self, pdf, pdf_path):
+        return Checkpoint(self.file_name, pdf, pdf_path, self.entries.get(pdf))
+
+
+class Checkpoint(object):
+    """
+        The manifest of one pdf as seen by the worker processing it; small enough to pickle.
+        reached(state) tells if an earlier run already completed that stage on the same content.
+    """
+
+    def __init__(self, file_name, pdf, pdf_path, entry=None):
+        self.file_name = file_name
+        self.pdf = pdf
+        self.pdf_path = pdf_path
+        self.entry = entry
+        self.content = None
+        self.state = None
+
+    def content_fields(self):
+        if self.content is None:
+            stat = os.stat(self.pdf_path)
+            if same_content(self.entry, self.pdf_path, stat):
+                pdf_hash = self.entry['hash']
+            else:
+                pdf_hash = file_hash(self.pdf_path)
+                self.entry = None
+            self.content = {'hash': pdf_hash, 'size': stat.st_size, 'mtime': stat.st_mtime}
+        return self.content
+
+    def reached(self, state):
+        self.content_fields()
+        return state_index(self.entry) >= STATES.index(state)
+
+    def mark(self, state):
+        self.state = state
+        self.write(None)
+
+    def fail(self, error):
+        self.write(error)
+
+    def write(self, error):
+        record = {'pdf': self.pdf, 'state': self.state, 'error': error, 'time': time.time()}
+        record.update(self.content_fields())
+        append_line(self.file_name, record)
@@ -0,0 +1,84 @@
+'''
+metrics is the opt-in instrumentation of figures_captions_list: how long each
+stage took and counters of what it saw, as one record per document:
+
+{'pdf': 'x.pdf', 'seconds': 1.2,
+ 'stages': {'pdf_info': 0.1, 'box_detection': 0.9, ...},
+ 'counters': {'pages': 8, 'text_elements': 812, 'contours': 4051, ...}}
+
+Pass a Metrics to figures_captions_list (or process_pdf) to fill it; without
+one the stages use NULL_METRICS, which records nothing. emit() hands a finished
+record to every hook registered with add_hook (jsonl_sink, or a function sending
+it to a metrics service). FigCap.run_batch emits the records of its workers in
+the parent process, so hooks only need to be registered there.
+'''
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+hooks = []
+
+
+def add_hook(hook):
+    # hook(record) is called with every finished document record
+    hooks.append(hook)
+
+
+def remove_hook(hook):
+    hooks.remove(hook)
+
+
+def emit(record):
+    for hook in list(hooks):
+        hook(record)
+
+
+def jsonl_sink(file_name):
+    # Hook appending each record as one json line
+    def write(record):
+        with open(file_name, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    return write
+
+
+class Metrics(object):
+
+    def __init__(self, pdf=None):
+        self.record = {'pdf': pdf, 'stages': {}, 'counters': {}}
+        self.start = time.time()
+        # pages may be detected on several threads
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        stage_start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.record['stages'][name] = self.record['stages'].get(name, 0.0) + time.time() - stage_start
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.record['counters'][name] = self.record['counters'].get(name, 0) + int(n)
+
+    def finish(self):
+        self.record['seconds'] = time.time() - self.start
+        return self.record
+
+
+class NullMetrics(object):
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def count(self, name, n=1):
+        pass
+
+    def finish(self):
+        return None
+
+
+NULL_METRICS = NullMetrics()
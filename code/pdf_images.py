@@ -0,0 +1,593 @@
+'''
+pdf_images lists the images embedded in a pdf and where its pages place them,
+like `pdfimages -list` plus the placement boxes, without rendering anything.
+
+    images = PdfImages(pdf_path)
+    images.pages         {page_no: [EmbeddedImage, ...]}, 1-based page numbers
+    images.native(image) (bytes, '.jpg' or '.jp2') of a JPEG/JPEG 2000 image, else None
+    native_figures(figures, images, info)   detected figures that are one such image
+
+EmbeddedImage.bbox is [x, y, w, h] in points from the top left of the page's
+crop box; html_boxes converts it to the pdftohtml page coordinates of info.
+Images placed through form XObjects are followed, inline images are not
+listed, and rotated pages are left out.
+
+The reader is deliberately small: it finds the objects by scanning for
+"N G obj" (later definitions win, object streams included) rather than
+trusting the xref table, stepping over stream data, and only decodes Flate
+(with PNG predictors), ASCIIHex and ASCII85 streams. `pdfimages -list` would
+give the images but not where they are drawn, which is what detection needs.
+Encrypted, unreadable or oversized files (MAX_PDF_BYTES, MAX_OBJECTS,
+MAX_STREAM_BYTES) list no images, with the reason in images.error, and
+detection falls back to the raster alone. Python 3 only.
+'''
+import re
+import zlib
+import base64
+from collections import namedtuple
+import numpy as np
+from box_ops import box_iou
+
+REGULAR = rb'[^ \t\r\n\x0c\x00()<>\[\]{}/%]'
+SPACE = re.compile(rb'(?:[ \t\r\n\x0c\x00]+|%[^\r\n]*)*')
+REGULAR_TOKEN = re.compile(REGULAR + rb'+')
+NAME = re.compile(REGULAR + rb'*')
+NUMBER = re.compile(rb'[+-]?(?:\d+\.?\d*|\.\d+)$')
+REF = re.compile(rb'\s+(\d+)\s+R(?!' + REGULAR + rb')')
+# "N G obj" at the start of a token, or a trailer dictionary
+OBJ_OR_TRAILER = re.compile(rb'(?<![^ \t\r\n\x0c\x00])(?:(\d+)\s+(\d+)\s+obj\b|trailer\b)')
+LITERAL_SPECIAL = re.compile(rb'[()\\]')
+CONTENT_TOKEN = re.compile(REGULAR + rb'+|/' + REGULAR + rb'*|\(|<<|>>|<[^>]*>|[\[\]{}]|%[^\r\n]*')
+INLINE_IMAGE_END = re.compile(rb'[ \t\r\n\x0c\x00]EI(?=[ \t\r\n\x0c\x00]|$)')
+ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f',
+           b'(': b'(', b')': b')', b'\\': b'\\'}
+NATIVE_FILTERS = {'DCTDecode': '.jpg', 'JPXDecode': '.jp2'}
+IDENTITY = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+FORM_DEPTH = 8
+# A figure box matching an image this well is written as the image itself
+NATIVE_IOU = 0.9
+# Larger files, more objects or longer decoded streams are not read
+MAX_PDF_BYTES = 256 * 1024 * 1024
+MAX_OBJECTS = 1000000
+MAX_STREAM_BYTES = 64 * 1024 * 1024
+
+
+class PdfError(Exception):
+    pass
+
+
+class Name(str):
+    pass
+
+
+class Operator(str):
+    pass
+
+
+Ref = namedtuple('Ref', ['num', 'gen'])
+
+
+class Stream(object):
+    __slots__ = ('dict', 'raw')
+
+    def __init__(self, stream_dict, raw):
+        self.dict = stream_dict
+        self.raw = raw
+
+
+class EmbeddedImage(namedtuple('EmbeddedImage', ['page', 'name', 'ref', 'width', 'height', 'filter', 'bbox',
+                                                 'page_size'])):
+    """
+        One placement of an image XObject: page number, resource name, object reference,
+        pixel size, its single stream filter (None if none or several), [x, y, w, h] in
+        points from the top left of the page and the (width, height) of the page in points.
+    """
+    __slots__ = ()
+
+
+def parse_object(data, pos):
+    # (object, position after it) of the object starting at pos
+    pos = SPACE.match(data, pos).end()
+    c = data[pos:pos + 1]
+    if c == b'/':
+        end = NAME.match(data, pos + 1).end()
+        return Name(decode_name(data[pos + 1:end])), end
+    if c == b'(':
+        return parse_literal(data, pos + 1)
+    if c == b'<':
+        if data[pos + 1:pos + 2] == b'<':
+            return parse_dict(data, pos + 2)
+        end = data.find(b'>', pos)
+        if end < 0:
+            raise PdfError('Unterminated hex string')
+        digits = re.sub(rb'[^0-9a-fA-F]', b'', data[pos + 1:end])
+        if len(digits) % 2:
+            digits = digits + b'0'
+        return bytes.fromhex(digits.decode('ascii')), end + 1
+    if c == b'[':
+        array = []
+        pos = pos + 1
+        while True:
+            pos = SPACE.match(data, pos).end()
+            if data[pos:pos + 1] == b']':
+                return array, pos + 1
+            if pos >= len(data):
+                raise PdfError('Unterminated array')
+            value, pos = parse_object(data, pos)
+            array.append(value)
+    m = REGULAR_TOKEN.match(data, pos)
+    if m is None:
+        raise PdfError('Unexpected %r at %d' % (c, pos))
+    token = m.group()
+    if NUMBER.match(token):
+        if b'.' not in token:
+            ref = REF.match(data, m.end())
+            if ref is not None:
+                return Ref(int(token), int(ref.group(1))), ref.end()
+            return int(token), m.end()
+        return float(token), m.end()
+    if token == b'true':
+        return True, m.end()
+    if token == b'false':
+        return False, m.end()
+    if token == b'null':
+        return None, m.end()
+    return Operator(token.decode('latin-1')), m.end()
+
+
+def parse_dict(data, pos):
+    # pos is after '<<'
+    result = {}
+    while True:
+        pos = SPACE.match(data, pos).end()
+        if data[pos:pos + 2] == b'>>':
+            return result, pos + 2
+        key, pos = parse_object(data, pos)
+        if not isinstance(key, Name):
+            raise PdfError('Dictionary key %r is not a name' % (key,))
+        result[key], pos = parse_object(data, pos)
+
+
+def parse_literal(data, pos):
+    # pos is after '('; balanced parentheses and backslash escapes
+    depth = 1
+    out = []
+    while True:
+        m = LITERAL_SPECIAL.search(data, pos)
+        if m is None:
+            raise PdfError('Unterminated string')
+        out.append(data[pos:m.start()])
+        c = m.group()
+        pos = m.end()
+        if c == b'\\':
+            e = data[pos:pos + 1]
+            if e in ESCAPES:
+                out.append(ESCAPES[e])
+                pos = pos + 1
+            elif e == b'\r' or e == b'\n':
+                # line continuation
+                pos = pos + (2 if data[pos:pos + 2] == b'\r\n' else 1)
+            elif e.isdigit():
+                octal = re.match(rb'[0-7]{1,3}', data[pos:pos + 3])
+                if octal is None:
+                    out.append(e)
+                    pos = pos + 1
+                else:
+                    out.append(bytes([int(octal.group(), 8) & 0xff]))
+                    pos = pos + len(octal.group())
+            else:
+                out.append(e)
+                pos = pos + 1
+        elif c == b'(':
+            depth = depth + 1
+            out.append(c)
+        else:
+            depth = depth - 1
+            if depth == 0:
+                return b''.join(out), pos
+            out.append(c)
+
+
+def decode_name(raw):
+    if b'#' in raw:
+        raw = re.sub(rb'#([0-9a-fA-F]{2})', lambda m: bytes([int(m.group(1), 16)]), raw)
+    return raw.decode('latin-1')
+
+
+def skip_literal(data, pos):
+    return parse_literal(data, pos)[1]
+
+
+def read_stream(data, stream_dict, pos):
+    # pos is after the 'stream' keyword; returns the Stream and the position after endstream
+    if data[pos:pos + 2] == b'\r\n':
+        pos = pos + 2
+    elif data[pos:pos + 1] in (b'\n', b'\r'):
+        pos = pos + 1
+    length = stream_dict.get('Length')
+    if isinstance(length, int) and length >= 0:
+        after = SPACE.match(data, pos + length).end()
+        if data.startswith(b'endstream', after):
+            return Stream(stream_dict, data[pos:pos + length]), after + 9
+    # Length is a reference or wrong: the data runs up to endstream
+    end = data.find(b'endstream', pos)
+    if end < 0:
+        raise PdfError('Unterminated stream')
+    raw = data[pos:end]
+    if raw.endswith(b'\r\n'):
+        raw = raw[:-2]
+    elif raw.endswith(b'\n') or raw.endswith(b'\r'):
+        raw = raw[:-1]
+    return Stream(stream_dict, raw), end + 9
+
+
+def png_unpredict(data, colors, bits, columns):
+    # Undo the PNG row filters (Predictor 10-15): a filter type byte before each row.
+    # None, Up and Sub rows are whole-row array operations (Sub is a running sum over the
+    # pixels); Average and Paeth rows, each byte depending on the one before, go byte by byte.
+    bpp = max(1, colors * bits // 8)
+    row_size = (colors * bits * columns + 7) // 8
+    rows = len(data) // (row_size + 1)
+    table = np.frombuffer(data, np.uint8, rows * (row_size + 1)).reshape(rows, row_size + 1)
+    kinds = table[:, 0]
+    if (kinds > 4).any():
+        raise PdfError('Unknown PNG filter %d' % kinds[kinds > 4][0])
+    out = table[:, 1:].copy()
+    if (kinds == 2).all():
+        # Xref and object streams: every row is Up
+        return np.cumsum(out, axis=0, dtype=np.uint8).tobytes()
+    previous = np.zeros(row_size, np.uint8)
+    for r in range(rows):
+        kind = kinds[r]
+        if kind == 1:
+            padded = np.zeros(-(-row_size // bpp) * bpp, np.uint8)
+            padded[:row_size] = out[r]
+            out[r] = np.cumsum(padded.reshape(-1, bpp), axis=0, dtype=np.uint8).ravel()[:row_size]
+        elif kind == 2:
+            out[r] += previous
+        elif kind > 2:
+            out[r] = unfilter_row(kind, bytearray(out[r]), bytearray(previous), bpp)
+        previous = out[r]
+    return out.tobytes()
+
+
+def unfilter_row(kind, row, previous, bpp):
+    # One Average (3) or Paeth (4) row
+    for i in range(len(row)):
+        left = row[i - bpp] if i >= bpp else 0
+        up = previous[i]
+        if kind == 3:
+            row[i] = (row[i] + (left + up) // 2) & 0xff
+        else:
+            up_left = previous[i - bpp] if i >= bpp else 0
+            p = left + up - up_left
+            pa, pb, pc = abs(p - left), abs(p - up), abs(p - up_left)
+            row[i] = (row[i] + (left if pa <= pb and pa <= pc else up if pb <= pc else up_left)) & 0xff
+    return row
+
+
+def multiply(m1, m2):
+    # m1 x m2 of pdf matrices [a b c d e f]
+    a1, b1, c1, d1, e1, f1 = m1
+    a2, b2, c2, d2, e2, f2 = m2
+    return (a1 * a2 + b1 * c2, a1 * b2 + b1 * d2,
+            c1 * a2 + d1 * c2, c1 * b2 + d1 * d2,
+            e1 * a2 + f1 * c2 + e2, e1 * b2 + f1 * d2 + f2)
+
+
+def unit_square_box(ctm):
+    # [x0, y0, x1, y1] of the unit square an image is drawn in, mapped by ctm
+    a, b, c, d, e, f = ctm
+    xs = [e, a + e, c + e, a + c + e]
+    ys = [f, b + f, d + f, b + d + f]
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+def number(value):
+    # value as a float; PdfError if it is not a number
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise PdfError('%r is not a number' % (value,))
+    return float(value)
+
+
+def count(value):
+    # value if it is a positive integer, else PdfError
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise PdfError('%r is not a positive integer' % (value,))
+    return value
+
+
+class PdfImages(object):
+
+    def __init__(self, pdf_path):
+        with open(pdf_path, 'rb') as f:
+            data = f.read(MAX_PDF_BYTES + 1)
+        self.objects = {}
+        self.pages = {}
+        self.error = None
+        self.encrypted = False
+        try:
+            if len(data) > MAX_PDF_BYTES:
+                raise PdfError('Pdf over %d bytes' % MAX_PDF_BYTES)
+            self.read(data)
+        except (PdfError, zlib.error, RecursionError) as e:
+            self.pages = {}
+            self.error = str(e) or e.__class__.__name__
+
+    def read(self, data):
+        self.scan(data)
+        if self.encrypted:
+            raise PdfError('Encrypted pdf')
+        for page_no, page in enumerate(self.page_list(), 1):
+            try:
+                self.pages[page_no] = self.page_images(page_no, page)
+            except (PdfError, zlib.error):
+                self.pages[page_no] = []
+
+    def scan(self, data):
+        # Objects and trailers outside stream data; the data of a stream that is read is skipped
+        pos = 0
+        while True:
+            m = OBJ_OR_TRAILER.search(data, pos)
+            if m is None:
+                break
+            try:
+                obj, end = parse_object(data, m.end())
+                if m.group(1) is not None:
+                    after = SPACE.match(data, end).end()
+                    if isinstance(obj, dict) and data.startswith(b'stream', after):
+                        obj, end = read_stream(data, obj, after + 6)
+            except (PdfError, RecursionError):
+                pos = m.end()
+                continue
+            pos = end
+            if m.group(1) is None:
+                # trailer << ... >>
+                if isinstance(obj, dict) and 'Encrypt' in obj:
+                    self.encrypted = True
+                continue
+            self.add_object(int(m.group(1)), obj)
+            if isinstance(obj, Stream) and obj.dict.get('Type') == 'XRef' and 'Encrypt' in obj.dict:
+                self.encrypted = True
+            if isinstance(obj, Stream) and obj.dict.get('Type') == 'ObjStm':
+                self.expand_object_stream(obj)
+
+    def add_object(self, num, obj):
+        if num not in self.objects and len(self.objects) >= MAX_OBJECTS:
+            raise PdfError('Pdf over %d objects' % MAX_OBJECTS)
+        self.objects[num] = obj
+
+    def expand_object_stream(self, stream):
+        try:
+            data = self.decode(stream)
+        except (PdfError, zlib.error):
+            return
+        first = self.resolve(stream.dict.get('First'))
+        if isinstance(first, bool) or not isinstance(first, int) or first < 0:
+            return
+        header = data[:first].split()
+        if not all(n.isdigit() for n in header):
+            return
+        header = [int(n) for n in header]
+        for i in range(0, len(header) - 1, 2):
+            try:
+                obj = parse_object(data, first + header[i + 1])[0]
+            except (PdfError, RecursionError):
+                continue
+            self.add_object(header[i], obj)
+
+    def resolve(self, obj, depth=0):
+        while isinstance(obj, Ref):
+            obj = self.objects.get(obj.num)
+            depth = depth + 1
+            if depth > 32:
+                raise PdfError('Reference loop')
+        return obj
+
+    def get(self, obj_dict, key, default=None):
+        if not isinstance(obj_dict, dict):
+            return default
+        value = self.resolve(obj_dict.get(key))
+        return default if value is None else value
+
+    def filters(self, stream):
+        filters = self.resolve(stream.dict.get('Filter'))
+        if filters is None:
+            return []
+        if not isinstance(filters, list):
+            filters = [filters]
+        return [self.resolve(f) for f in filters]
+
+    def decode(self, stream):
+        data = stream.raw
+        parms = self.resolve(stream.dict.get('DecodeParms'))
+        for i, name in enumerate(self.filters(stream)):
+            parm = self.resolve(parms[i]) if isinstance(parms, list) and i < len(parms) else parms
+            predictor = count(self.get(parm, 'Predictor', 1))
+            if predictor > 1 and (predictor < 10 or name not in ('FlateDecode', 'Fl')):
+                raise PdfError('Predictor %d is not supported' % predictor)
+            if name in ('FlateDecode', 'Fl'):
+                inflate = zlib.decompressobj()
+                data = inflate.decompress(data, MAX_STREAM_BYTES)
+                if inflate.unconsumed_tail:
+                    raise PdfError('Stream over %d bytes' % MAX_STREAM_BYTES)
+                if predictor > 1:
+                    data = png_unpredict(data, count(self.get(parm, 'Colors', 1)),
+                                         count(self.get(parm, 'BitsPerComponent', 8)),
+                                         count(self.get(parm, 'Columns', 1)))
+            elif name in ('ASCIIHexDecode', 'AHx'):
+                digits = re.sub(rb'[^0-9a-fA-F]', b'', data.split(b'>')[0])
+                data = bytes.fromhex((digits + b'0' * (len(digits) % 2)).decode('ascii'))
+            elif name in ('ASCII85Decode', 'A85'):
+                try:
+                    data = base64.a85decode(re.sub(rb'\s', b'', data).split(b'~>')[0].lstrip(b'<~'))
+                except ValueError as e:
+                    raise PdfError('Bad ASCII85 data: %s' % e)
+            else:
+                raise PdfError('Unsupported filter %s' % (name,))
+        return data
+
+    def page_list(self):
+        # Leaf page dicts in order, with the inherited attributes filled in
+        root = None
+        for obj in self.objects.values():
+            if isinstance(obj, dict) and obj.get('Type') == 'Catalog':
+                root = obj
+        if root is None:
+            raise PdfError('No catalog')
+        pages = []
+        seen = set()
+
+        def walk(node, inherited):
+            node = self.resolve(node)
+            if not isinstance(node, dict) or id(node) in seen:
+                return
+            seen.add(id(node))
+            attributes = dict(inherited)
+            for key in ('Resources', 'MediaBox', 'CropBox', 'Rotate'):
+                if key in node:
+                    attributes[key] = self.resolve(node[key])
+            kids = self.get(node, 'Kids')
+            if node.get('Type') == 'Pages' or (kids is not None and node.get('Type') != 'Page'):
+                if not isinstance(kids, list):
+                    raise PdfError('Kids is not an array')
+                for kid in kids:
+                    walk(kid, attributes)
+            else:
+                page = dict(node)
+                page.update(attributes)
+                pages.append(page)
+
+        walk(root.get('Pages'), {})
+        return pages
+
+    def page_images(self, page_no, page):
+        if number(self.get(page, 'Rotate', 0)) % 360 != 0:
+            return []
+        box = self.get(page, 'CropBox') or self.get(page, 'MediaBox')
+        if not isinstance(box, list) or len(box) != 4:
+            return []
+        box = [number(self.resolve(v)) for v in box]
+        x0, y0, x1, y1 = min(box[0], box[2]), min(box[1], box[3]), max(box[0], box[2]), max(box[1], box[3])
+        placements = []
+        contents = self.get(page, 'Contents')
+        if not isinstance(contents, list):
+            contents = [contents]
+        data = b'\n'.join(self.decode(stream) for stream in (self.resolve(c) for c in contents)
+                          if isinstance(stream, Stream))
+        self.walk_content(data, self.get(page, 'Resources', {}), IDENTITY, placements, 0)
+        images = []
+        for name, ref, image, ctm in placements:
+            left, bottom, right, top = unit_square_box(ctm)
+            left, bottom, right, top = max(left, x0), max(bottom, y0), min(right, x1), min(top, y1)
+            if right <= left or top <= bottom:
+                continue
+            filters = self.filters(image)
+            images.append(EmbeddedImage(page_no, name, ref, self.get(image.dict, 'Width'),
+                                        self.get(image.dict, 'Height'), filters[0] if len(filters) == 1 else None,
+                                        [left - x0, y1 - top, right - left, top - bottom], (x1 - x0, y1 - y0)))
+        return images
+
+    def walk_content(self, data, resources, ctm, placements, depth):
+        # Follow q/Q/cm and record every image drawn by Do, into form XObjects too
+        stack = []
+        operands = []
+        pos = 0
+        while True:
+            m = CONTENT_TOKEN.search(data, pos)
+            if m is None:
+                return
+            token = m.group()
+            pos = m.end()
+            c = token[:1]
+            if c == b'(':
+                pos = skip_literal(data, pos)
+                operands.append(None)
+            elif c == b'/':
+                operands.append(Name(decode_name(token[1:])))
+            elif c == b'%':
+                continue
+            elif c in b'<>[]{}':
+                operands.append(None)
+            elif NUMBER.match(token):
+                operands.append(float(token))
+            else:
+                if token == b'q':
+                    stack.append(ctm)
+                elif token == b'Q':
+                    if stack:
+                        ctm = stack.pop()
+                elif token == b'cm':
+                    if len(operands) >= 6 and all(isinstance(v, float) for v in operands[-6:]):
+                        ctm = multiply(tuple(operands[-6:]), ctm)
+                elif token == b'Do':
+                    if operands and isinstance(operands[-1], Name):
+                        self.draw(operands[-1], resources, ctm, placements, depth)
+                elif token == b'BI':
+                    start = data.find(b'ID', pos)
+                    end = INLINE_IMAGE_END.search(data, start + 2) if start >= 0 else None
+                    if end is None:
+                        return
+                    pos = end.end()
+                operands = []
+
+    def draw(self, name, resources, ctm, placements, depth):
+        xobjects = self.get(resources, 'XObject')
+        ref = xobjects.get(name) if isinstance(xobjects, dict) else None
+        xobject = self.resolve(ref)
+        if not isinstance(xobject, Stream):
+            return
+        subtype = self.get(xobject.dict, 'Subtype')
+        if subtype == 'Image':
+            if not self.get(xobject.dict, 'ImageMask', False):
+                placements.append((name, ref, xobject, ctm))
+        elif subtype == 'Form' and depth < FORM_DEPTH:
+            matrix = self.get(xobject.dict, 'Matrix')
+            form_ctm = ctm
+            if isinstance(matrix, list) and len(matrix) == 6:
+                form_ctm = multiply(tuple(number(self.resolve(v)) for v in matrix), ctm)
+            try:
+                data = self.decode(xobject)
+            except (PdfError, zlib.error):
+                return
+            self.walk_content(data, self.get(xobject.dict, 'Resources', resources), form_ctm, placements,
+                              depth + 1)
+
+    def native(self, image):
+        # The image file stored in the pdf, if it is one as it stands:
+        # a plain JPEG or JPEG 2000 stream without masks or remapped colors
+        stream = self.resolve(image.ref)
+        if image.filter not in NATIVE_FILTERS or not isinstance(stream, Stream):
+            return None
+        for key in ('SMask', 'Mask', 'Decode'):
+            if key in stream.dict:
+                return None
+        return stream.raw, NATIVE_FILTERS[image.filter]
+
+
+def html_boxes(images, info):
+    # [x, y, w, h] of the images in the pdftohtml page coordinates of info
+    boxes = []
+    for image in images:
+        sx = info.page_width / image.page_size[0]
+        sy = info.page_height / image.page_size[1]
+        x, y, w, h = image.bbox
+        boxes.append([int(round(x * sx)), int(round(y * sy)), int(round(w * sx)), int(round(h * sy))])
+    return boxes
+
+
+def native_figures(figures, images, info, min_iou=NATIVE_IOU):
+    # {(page_no, order_no): (bytes, extension)} of the figures that are one embedded image
+    # stored as a file (images.native); they can be written as they are instead of cropped
+    native = {}
+    for figure in figures:
+        page_no = int(figure[4:-4])
+        page_images = images.pages.get(page_no, [])
+        boxes = html_boxes(page_images, info)
+        for order_no, bbox in enumerate(figures[figure], 1):
+            ious = [box_iou(bbox[0], box) for box in boxes]
+            if ious and max(ious) >= min_iou:
+                image_file = images.native(page_images[ious.index(max(ious))])
+                if image_file is not None:
+                    native[(page_no, order_no)] = image_file
+    return native
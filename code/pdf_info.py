@@ -1,23 +1,34 @@
 '''
 pdf_info is to get the basic infomation from pdfs
-info={
+info (a document.Layout)={
 filename, height, width, page_no, figure_est_no, layout_bbox, text_mask
 }
 '''
-from selenium import webdriver
 from multiprocessing import Pool, TimeoutError
 import time
 import os
 import json
 import numpy as np
-import matplotlib.pyplot as plt
 import sys
 import cv2
+from html_reader import read_html_page
+from document import Document, Layout
+from layout_stats import layout_statistics
 
     # Column width, middle gap, Maximum Figure number will be helpful
-def pdf_info(html_file_path, pdf):
+def pdf_info(html_file_path, pdf, use_browser=False, cache_entry=None):
     # Get the pdf info by parsing html
-    
+    # use_browser: lay out the html in Chrome instead of reading the inline css
+    # cache_entry: layout_cache entry to reuse/store html_info and info for this pdf content
+    # returns the frozen Layout info and the page-keyed Document of html_info
+    cached_html_info = None
+    if cache_entry is not None:
+        info = cache_entry.load('info')
+        cached_html_info = cache_entry.load('html_info')
+        if info is not None and cached_html_info is not None:
+            info['filename'] = pdf
+            return Layout.from_dict(info), Document(cached_html_info, info['row_height'])
+
     info = {}
 # obtain file name
     info['filename'] = pdf
@@ -33,10 +44,22 @@ def pdf_info(html_file_path, pdf):
     list_of_htmls = []
     html_info = []
     html_info_json = html_file_path+'/' + pdf[:-4] + '.json'
-    if os.path.isfile(html_info_json):
+    if cached_html_info is not None:
+        html_info = cached_html_info
+    elif cache_entry is None and os.path.isfile(html_info_json):
         with open(html_info_json) as json_data:
             html_info = json.load(json_data)
+    elif not use_browser:
+        for page_id in range(page_no):
+            page = for_counting[page_id]
+            html_info.append(read_html_page(html_file_path + '/' + page[:-4] + '.html'))
+        if cache_entry is not None:
+            cache_entry.save('html_info', html_info)
+        else:
+            with open(html_info_json, 'w') as outfile:
+                json.dump(html_info, outfile)
     else:
+        from selenium import webdriver
         browser = webdriver.Chrome('/usa/pengyuan/Documents/RESEARCH/PDFigCapX/chromedriver/chromedriver')
         for page_id in range(page_no):
             page = for_counting[page_id]
@@ -54,8 +77,11 @@ def pdf_info(html_file_path, pdf):
             html_info.append([int(os.path.basename(html_file)[4:-5]), text_boxes, img_size])
         browser.quit()
             #html_info.append(read_each_html(html_file))
-        with open(html_file_path+'/' + pdf[:-4] + '.json', 'w') as outfile:
-            json.dump(html_info, outfile)
+        if cache_entry is not None:
+            cache_entry.save('html_info', html_info)
+        else:
+            with open(html_file_path+'/' + pdf[:-4] + '.json', 'w') as outfile:
+                json.dump(html_info, outfile)
     #multithread = Pool(4)
     #html_info = multithread.map(read_each_html, list_of_htmls)
     #multithread.close()
@@ -63,8 +89,6 @@ def pdf_info(html_file_path, pdf):
 # obtain text layout
     row_width = []
     row_height = []
-    column_no = 1
-    columns = [0]
     left_point = []
     top_point = []
     right_point = []
@@ -86,68 +110,8 @@ def pdf_info(html_file_path, pdf):
                     left_point.append(element[0][0])
                     right_point.append(element[0][0]+element[0][2])
                     top_point.append(element[0][1])
-    point_left = sorted([(i, left_point.count(i)) for i in set(
-        left_point)], key=lambda x: x[1], reverse=True)
-    width_row = sorted([(i, row_width.count(i)) for i in set(
-        row_width)], key=lambda x: x[1], reverse=True)
-    height_row = sorted([(i, row_height.count(i)) for i in set(
-        row_height)], key=lambda x: x[1], reverse=True)
-    info['row_height'] = height_row[0][0]
-    info['row_width'] = width_row[0][0]
-    info['text_layout'] = (max(0, min(top_point)),
-                           min(info['page_height'],max(top_point)))
-
-    # Compute column no and position for each column
-    i = 0
-    while i < len(point_left):
-        j = i + 1
-        while j < len(point_left):
-            if abs(point_left[i][0] - point_left[j][0]) <= 10:
-                point_left[i] = (point_left[i][0], point_left[i][1] +
-                                 point_left[j][1])
-                del point_left[j]
-            else:
-                j = j + 1
-        i = i + 1
-    point_left = sorted(point_left, key=lambda x: x[1], reverse=True)
-
-    if float(point_left[0][1]) / len(left_point) > 0.75 \
-            or float(info['row_width']) / info['page_width'] > 0.5:
-        column_no = 1
-        columns = [point_left[0][0]]
-    else:  # float(point_left[1][1]) / len(left_point) > 0.2:  # Need to
-        # correct, it may cause numbe below 0
-        column_no = 2  # int(float((info['page_width'] - 2*point_left[0][0]))/info['row_width'])
-
-        for i in range(1, len(point_left)):
-            if abs(point_left[i][0] - point_left[0][0]) > info['row_width']:
-                columns = [min(point_left[i][0], point_left[0][0]),
-                           max(point_left[i][0], point_left[0][0])]
-                break
-
-    info['column_no'] = column_no
-    info['columns'] = columns
-
-    left_bar = min(left_point)
-    right_bar = max(right_point)
-    # pdf layout
-    if left_bar > 0 and left_bar < 20 * info['row_height']:
-        info['left_bbox'] = [0, 0, left_bar, info['page_height']]
-        info['right_bbox'] = [min(info['page_width'] - 2 * info['row_height'],right_bar),
-                              0, info['page_width'] - min(info['page_width'] - 2 * info['row_height'],right_bar), info['page_height']]
-        if info['text_layout'][0] < 15 * info['row_height'] and info['text_layout'][1] > 15 * info['row_height']:
-            info['top_bbox'] = [0, 0, info['page_width'], info['text_layout'][0]]
-            info['down_bbox'] = [0, info['text_layout'][1], info['page_width'],
-                                 info['page_height'] - info['text_layout'][1]]
-        else:
-            info['top_bbox'] = [0, 0, info['page_width'], info['row_height']]
-            info['down_bbox'] = [0, info['page_height'] - info['row_height'], info['page_width'],
-                                 info['row_height']]
-    else:
-        info['left_bbox'] = [0, 0, info['row_height'], info['page_height']]
-        info['right_bbox'] = [info['page_width'] - info['row_height'], 0, info['row_height'], info['page_height']]
-        info['top_bbox'] = [0, 0, info['page_width'], info['row_height']]
-        info['down_bbox'] = [0, info['page_height'] - info['row_height'], info['page_width'], info['row_height']]
+    info.update(layout_statistics(left_point, right_point, top_point, row_width, row_height,
+                                  info['page_width'], info['page_height']))
 
     #print info['left_bbox']
     #print info['right_bbox']
@@ -155,8 +119,10 @@ def pdf_info(html_file_path, pdf):
     #print info['down_bbox']
     info['mess_up'] = False
     info['graph_layout'] = info['text_layout']
+    if cache_entry is not None:
+        cache_entry.save('info', info)
 
-    return info, html_info
+    return Layout.from_dict(info), Document(html_info, info['row_height'])
 '''
            
 
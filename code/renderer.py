@@ -1,8 +1,12 @@
 import shutil
 import os, sys, re
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from PIL import Image
 import numpy as np
 import tempfile
+from tools import LOCAL_TOOLS
 
 #output_dpi = str(72)
 
@@ -34,10 +38,9 @@ def render_pdf(filename, customize_dpi):
             imagemagickPath + ' -density ' + rasterDensity + ' -resample ' + output_dpi + ' -set colorspace RGB ' +
             filename + ' ' + os.path.join(outputDir, 'image.png'))
     else:
-        os.system(
-            # 'convert -density ' + rasterDensity + ' -resample ' + output_dpi + ' -set colorspace RGB ' + filename + ' ' + outputDir + 'image.png')
-            #'convert -density ' + output_dpi + ' -resample ' + output_dpi + ' -set colorspace RGB ' + filename + ' ' + outputDir + 'image.png')
-            'gs -q -sDEVICE=png16m -o ' + os.path.join(outputDir, 'file-%02d.png') + ' -r' + output_dpi + ' ' + filename)
+        # 'convert -density ' + rasterDensity + ' -resample ' + output_dpi + ' -set colorspace RGB ' + filename + ' ' + outputDir + 'image.png')
+        #'convert -density ' + output_dpi + ' -resample ' + output_dpi + ' -set colorspace RGB ' + filename + ' ' + outputDir + 'image.png')
+        ghostscript(filename, os.path.join(outputDir, 'file-%02d.png'), output_dpi)
 
     files = [f for f in os.listdir(outputDir) if os.path.isfile(os.path.join(outputDir, f)) and not f.startswith('.')]
     files = natural_sort(files)
@@ -51,6 +54,184 @@ def render_pdf(filename, customize_dpi):
     return images
 
 
+class LazyPages(object):
+    """
+        Page-indexed lazy render of a pdf: pages[n] (1-based) renders page n with Ghostscript
+        on first access and decodes it to a PIL RGB image. Rendered pngs stay in a temp dir
+        until close(); at most cache_size decoded pages are kept in memory.
+        output_dir: use pngs already rendered there (page-N.png) instead of a temp dir;
+        it is left in place by close().
+        tools: tools.Tools that runs Ghostscript (default: here, as a child process).
+    """
+
+    def __init__(self, filename, customize_dpi, cache_size=2, output_dir=None, tools=None):
+        self.filename = filename
+        self.tools = tools or LOCAL_TOOLS
+        self.output_dpi = str(customize_dpi)
+        self.cache_size = cache_size
+        self.own_dir = output_dir is None
+        self.outputDir = tempfile.mkdtemp() if output_dir is None else output_dir
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __getitem__(self, page_no):
+        # Safe to call from several threads; pages are decoded outside the lock
+        with self.lock:
+            if page_no in self.cache:
+                image = self.cache.pop(page_no)
+                self.cache[page_no] = image
+                return image
+            path = self.page_file(page_no)
+            if not os.path.isfile(path):
+                self.render([page_no])
+        if not os.path.isfile(path):
+            raise KeyError(page_no)
+        image = Image.open(path).convert('RGB')
+        image.load()
+        with self.lock:
+            self.cache[page_no] = image
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return image
+
+    def render(self, pages=None, processes=1):
+        # Render pages to png without decoding them, all pages in one Ghostscript pass if None.
+        # Otherwise one Ghostscript call per run of consecutive pages, `processes` calls at a time.
+        if pages is None:
+            self.tools.run('gs', ghostscript_command(self.filename, os.path.join(self.outputDir, 'page-%d.png'),
+                                                     self.output_dpi))
+            return
+        ranges = self.missing_ranges(pages)
+        if processes > 1 and len(ranges) > 1:
+            pool = ThreadPool(min(processes, len(ranges)))
+            pool.map(self.render_range, ranges)
+            pool.close()
+            pool.join()
+        else:
+            for page_range in ranges:
+                self.render_range(page_range)
+
+    def missing_ranges(self, pages):
+        # Runs of consecutive pages that are not rendered yet
+        return page_ranges([page_no for page_no in pages if not os.path.isfile(self.page_file(page_no))])
+
+    def render_range(self, page_range):
+        self.tools.run('gs', ghostscript_command(self.filename, self.range_output(page_range), self.output_dpi,
+                                                 page_range[0], page_range[1]))
+        self.collect_range(page_range)
+
+    def range_output(self, page_range):
+        first_page, last_page = page_range
+        if first_page == last_page:
+            return self.page_file(first_page)
+        # Ghostscript numbers output files from 1 whatever the first page is
+        return os.path.join(self.outputDir, 'range%d-%%d.png' % first_page)
+
+    def collect_range(self, page_range):
+        # Rename the files of a multi-page Ghostscript call to page-N.png
+        first_page, last_page = page_range
+        if first_page == last_page:
+            return
+        pattern = self.range_output(page_range)
+        for page_no in range(first_page, last_page + 1):
+            range_file = pattern % (page_no - first_page + 1)
+            if os.path.isfile(range_file):
+                os.rename(range_file, self.page_file(page_no))
+
+    def page_file(self, page_no):
+        return os.path.join(self.outputDir, 'page-%d.png' % page_no)
+
+    def close(self):
+        self.cache.clear()
+        if self.own_dir:
+            shutil.rmtree(self.outputDir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_pages(filename, customize_dpi, pages=None):
+    """
+        Yields (page_no, image) one page at a time, for the given pages or every page.
+        Only the current page is held in memory.
+    """
+    with LazyPages(filename, customize_dpi, cache_size=1) as lazy_pages:
+        if pages is None:
+            lazy_pages.render()
+            pages = natural_sort(os.listdir(lazy_pages.outputDir))
+            pages = [int(f[5:-4]) for f in pages if f.startswith('page-') and f.endswith('.png')]
+        for page_no in pages:
+            yield page_no, lazy_pages[page_no]
+
+
+def render_pages(filename, customize_dpi, pages, processes=1):
+    """
+        Renders only the given pages (1-based) and returns {page_no: PIL image}.
+        Consecutive pages share one Ghostscript call; `processes` calls run in parallel.
+    """
+    with LazyPages(filename, customize_dpi, cache_size=1) as lazy_pages:
+        lazy_pages.render(pages, processes)
+        images = {}
+        for page_no in pages:
+            try:
+                images[page_no] = lazy_pages[page_no]
+            except KeyError:
+                pass
+    return images
+
+
+def page_ranges(pages):
+    # [1, 2, 3, 7, 9, 10] -> [(1, 3), (7, 7), (9, 10)]
+    ranges = []
+    for page_no in sorted(set(pages)):
+        if ranges and page_no == ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], page_no)
+        else:
+            ranges.append((page_no, page_no))
+    return ranges
+
+
+def ghostscript(filename, output_file, output_dpi, first_page=None, last_page=None):
+    # CalledProcessError if Ghostscript fails
+    LOCAL_TOOLS.run('gs', ghostscript_command(filename, output_file, output_dpi, first_page, last_page))
+
+
+def ghostscript_command(filename, output_file, output_dpi, first_page=None, last_page=None):
+    command = ['gs', '-q', '-dBATCH', '-dNOPAUSE', '-sDEVICE=png16m', '-r' + str(output_dpi)]
+    if first_page is not None:
+        command.append('-dFirstPage=%d' % first_page)
+    if last_page is not None:
+        command.append('-dLastPage=%d' % last_page)
+    command.extend(['-o', output_file, filename])
+    return command
+
+
+def page_ratio(image_shape, info):
+    """
+        Scale from page coordinates (the pdftohtml html px in info) to raster pixels,
+        for an image of shape (rows, cols). Used by figure detection; crops use crop_ratio.
+    """
+    if image_shape[0] > image_shape[1]:
+        return float(image_shape[0]) / info.page_height
+    else:
+        return float(image_shape[0]) / info.page_width
+
+
+def crop_ratio(image_size, info):
+    # Scale from page coordinates to a page render of PIL size (width, height), for cropping.
+    # Always by height, whatever the page orientation; page_ratio is the detection one.
+    return float(image_size[1]) / info.page_height
+
+
+def crop_region(image, region_bb, ratio):
+    # Crop a figure region (page coordinates [x, y, w, h]) from a page render scaled by ratio
+    return image.crop([int(region_bb[0]*ratio), int(region_bb[1]*ratio),
+                       int((region_bb[0]+region_bb[2])*ratio), int((region_bb[1]+region_bb[3])*ratio)])
+
+
 def natural_sort(l): # this is taken from stack overflow.
     """
         This function will sort strings with numeric values in natural ascending order, 
@@ -0,0 +1,102 @@
+'''
+results is the streaming output of a corpus run: one compact json line per
+document appended to a single file, instead of a pprint and a json file in
+every output folder.
+
+{"pdf": "x.pdf", "fig_no": 3, "figures": [...], "pages_annotated": []}
+
+A file name ending in .gz is written gzip compressed. Each record is flushed
+as it is written, so a crashed run leaves every finished record readable;
+ResultSink drops a torn last record when it reopens the file and done() lists
+the pdfs that need not run again. iter_results reads a file one record at a
+time.
+
+FigCap.run_batch writes the sink in the parent process, from the records its
+workers send back, so there is a single writer whatever the number of workers.
+'''
+import io
+import os
+import json
+import gzip
+import zlib
+import threading
+
+
+def open_results(file_name, mode):
+    # mode 'r', 'w' or 'a'; text lines in both cases
+    if file_name.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(file_name, mode + 'b'), encoding='utf-8')
+    return io.open(file_name, mode, encoding='utf-8')
+
+
+def iter_results(file_name):
+    """
+        Yields the records of a results file in the order they were written.
+        A record cut short by a crash at the end of the file is skipped.
+    """
+    with open_results(file_name, 'r') as f:
+        try:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                yield record
+        except (EOFError, zlib.error):
+            return
+
+
+class ResultSink(object):
+
+    def __init__(self, file_name):
+        # Appends to file_name, keeping the complete records already there
+        self.file_name = file_name
+        self.done = set()
+        if os.path.isfile(file_name):
+            self.recover()
+        self.f = open_results(file_name, 'a')
+        self.lock = threading.Lock()
+
+    def recover(self):
+        # Collect the pdfs already written; rewrite the file if it ends in a torn record,
+        # or in a complete one without its newline that the next write would run into
+        records = 0
+        for record in iter_results(self.file_name):
+            self.done.add(record.get('pdf'))
+            records += 1
+        with open_results(self.file_name, 'r') as f:
+            try:
+                lines = 0
+                line = u'\n'
+                for line in f:
+                    lines += 1
+                torn = lines != records or not line.endswith(u'\n')
+            except (EOFError, zlib.error):
+                torn = True
+        if torn:
+            temp_name = self.file_name + '.tmp'
+            if self.file_name.endswith('.gz'):
+                temp_name = self.file_name[:-3] + '.tmp.gz'
+            with open_results(temp_name, 'w') as f:
+                for record in iter_results(self.file_name):
+                    f.write(json.dumps(record, separators=(',', ':')) + u'\n')
+            os.rename(temp_name, self.file_name)
+
+    def write(self, pdf, result):
+        # result: data[pdf] of process_pdf
+        record = {'pdf': pdf}
+        record.update(result)
+        line = json.dumps(record, separators=(',', ':'))
+        with self.lock:
+            self.f.write(line + u'\n')
+            self.f.flush()
+            self.done.add(pdf)
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,297 @@
+'''
+service is a long-running local HTTP extraction service over extract.extract.
+A fork server imports the pipeline once when the service starts and forks a
+process for each request, so a request only pays for its own document.
+
+    POST /extract?name=x.pdf[&crops=JPEG][&quality=85][&detection_scale=2]
+         body: the pdf bytes
+         200: {"pdf": "x.pdf", "fig_no": 3, "figures": [...], "pages_annotated": []}
+              figures are the records of FigCap.py, with "crop" (base64) if crops was given
+         400: bad options;  413: the pdf is over max_bytes
+         503: the queue is full, retry later;  504: no result in time;  500: extraction failed
+    GET  /health
+         200: {"workers": 4, "pending": 1, "max_pending": 12}
+
+At most workers extractions run at a time and queue_size more wait for one;
+the other requests are turned away with 503 at once rather than piling up. An
+extraction still running when its request times out (504) is killed with the
+pdftohtml and gs it started, and its place is given back once it is gone.
+
+Usage: python service.py [--host 127.0.0.1] [--port 8350] [--socket PATH] [--workers N]
+       [--queue_size N] [--timeout S] [--dpi DPI] [--max_bytes N]
+'''
+import os
+import sys
+import json
+import time
+import base64
+import signal
+import socket
+import argparse
+import threading
+import multiprocessing
+from crop_writer import FORMATS
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+DEFAULT_PORT = 8350
+# FigCap.RENDER_DPI and the keys of xpdf_process.DILATION_SIZE; only the jobs import the pipeline
+RENDER_DPI = 300
+DETECTION_SCALES = (1, 2, 4)
+MAX_DPI = 1200
+MAX_PDF_BYTES = 200 * 1024 * 1024
+extract = None
+
+
+def warm():
+    # Import the pipeline (cv2, lxml, numpy, ...); run once by the fork server
+    global extract
+    from extract import extract
+
+
+def job_context():
+    # Jobs are forked by a fork server with the pipeline imported, not from this threaded server
+    if hasattr(multiprocessing, 'get_context') and 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['extract'])
+        return context
+    return multiprocessing
+
+
+def job_main(sender, pdf, name, options):
+    # Body of a job process; its own process group, so killing it also kills pdftohtml and gs
+    if hasattr(os, 'setsid'):
+        os.setsid()
+    warm()
+    sender.send(extract_request(pdf, name, options))
+    sender.close()
+
+
+def stop_job(job):
+    # Kill the job unless it has exited, and reap it
+    if job.exitcode is None:
+        try:
+            os.killpg(job.pid, signal.SIGKILL)
+        except (AttributeError, OSError):
+            # no process groups here, or the job has not called setsid yet
+            job.terminate()
+    job.join()
+
+
+def extract_request(pdf, name, options):
+    # (http status, json record) of one request, run in its job
+    try:
+        result = extract(pdf, name, **options)
+    except Exception as e:
+        return 500, {'error': repr(e)}
+    record = result.as_dict()
+    record['pdf'] = result.pdf
+    for figure, figure_record in zip(result.figures, record['figures']):
+        if figure.crop is not None:
+            figure_record['crop'] = base64.b64encode(figure.crop).decode('ascii')
+    return 200, record
+
+
+class ExtractionService(object):
+
+    def __init__(self, workers=None, queue_size=None, timeout=600, dpi=RENDER_DPI, max_bytes=MAX_PDF_BYTES):
+        workers = workers or multiprocessing.cpu_count()
+        self.workers = workers
+        self.max_pending = workers + (queue_size if queue_size is not None else 2 * workers)
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        self.running = threading.BoundedSemaphore(workers)
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.timeout = timeout
+        self.dpi = dpi
+        self.max_bytes = max_bytes
+        self.context = job_context()
+        # Start the fork server now, so the first request does not pay for the imports
+        job = self.context.Process(target=warm)
+        job.start()
+        job.join()
+
+    def submit(self, pdf, name, options):
+        # Returns (http status, json record); never blocks on a full queue
+        if not self.slots.acquire(False):
+            return 503, {'error': 'Queue full (%d requests pending)' % self.max_pending}
+        with self.lock:
+            self.pending += 1
+        options.setdefault('dpi', self.dpi)
+        deadline = time.time() + self.timeout
+        try:
+            if not acquire_until(self.running, deadline):
+                return 504, {'error': 'No worker free after %d seconds' % self.timeout}
+            try:
+                return self.run_job(pdf, name, options, deadline)
+            finally:
+                self.running.release()
+        finally:
+            # Only once the job is gone
+            with self.lock:
+                self.pending -= 1
+            self.slots.release()
+
+    def run_job(self, pdf, name, options, deadline):
+        # extract_request in a job process of its own, killed if it has no result by the deadline
+        receiver, sender = self.context.Pipe(duplex=False)
+        job = self.context.Process(target=job_main, args=(sender, pdf, name, options))
+        job.start()
+        sender.close()
+        try:
+            if not receiver.poll(max(deadline - time.time(), 0)):
+                return 504, {'error': 'No result after %d seconds' % self.timeout}
+            try:
+                return receiver.recv()
+            except EOFError:
+                job.join()
+                return 500, {'error': 'Extraction process exited with code %s' % job.exitcode}
+        finally:
+            receiver.close()
+            stop_job(job)
+
+    def health(self):
+        return {'workers': self.workers, 'pending': self.pending, 'max_pending': self.max_pending}
+
+    def close(self):
+        # Every job ends with its request; nothing is left to stop
+        pass
+
+
+def acquire_until(semaphore, deadline):
+    if sys.version_info[0] < 3:
+        # no timeout on Python 2; the deadline is checked while the job runs
+        return semaphore.acquire()
+    return semaphore.acquire(True, max(deadline - time.time(), 0))
+
+
+def request_options(query):
+    # Query string of POST /extract -> (name, extract keyword arguments)
+    name = query.get('name', ['document.pdf'])[0]
+    if not name.endswith('.pdf'):
+        name = name + '.pdf'
+    options = {}
+    if 'crops' in query:
+        options['crop_format'] = query['crops'][0].upper()
+        if options['crop_format'] not in FORMATS:
+            raise ValueError('crops must be one of %s' % ', '.join(sorted(FORMATS)))
+        if 'quality' in query:
+            options['crop_options'] = {'quality': int(query['quality'][0])}
+            if not 0 <= options['crop_options']['quality'] <= 100:
+                raise ValueError('quality must be between 0 and 100')
+    if 'detection_scale' in query:
+        options['detection_scale'] = int(query['detection_scale'][0])
+        if options['detection_scale'] not in DETECTION_SCALES:
+            raise ValueError('detection_scale must be one of %s' % ', '.join(map(str, DETECTION_SCALES)))
+    if 'dpi' in query:
+        options['dpi'] = int(query['dpi'][0])
+        if not 0 < options['dpi'] <= MAX_DPI:
+            raise ValueError('dpi must be between 1 and %d' % MAX_DPI)
+    return name, options
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    # self.server.service is the ExtractionService
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            self.send_json(200, self.server.service.health())
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/extract':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        try:
+            name, options = request_options(parse_qs(url.query))
+        except ValueError as e:
+            self.send_json(400, {'error': repr(e)})
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = 0
+        if length <= 0:
+            self.send_json(400, {'error': 'Send the pdf as the request body'})
+            return
+        if length > self.server.service.max_bytes:
+            # The body is not read, so this connection cannot take another request
+            self.close_connection = True
+            self.send_json(413, {'error': 'Pdf over %d bytes' % self.server.service.max_bytes})
+            return
+        pdf = self.rfile.read(length)
+        status, record = self.server.service.submit(pdf, name, options)
+        self.send_json(status, record)
+
+    def send_json(self, status, record):
+        body = json.dumps(record).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 503:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+
+class ServiceServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class UnixServiceServer(ServiceServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        self.socket.bind(self.server_address)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def serve(service, host='127.0.0.1', port=DEFAULT_PORT, socket_path=None):
+    if socket_path is not None:
+        server = UnixServiceServer(socket_path, ServiceHandler)
+    else:
+        server = ServiceServer((host, port), ServiceHandler)
+    server.service = service
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local figure and caption extraction service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--socket', default=None, help='Listen on this Unix socket instead of host:port')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='Worker processes kept warm')
+    parser.add_argument('--queue_size', type=int, default=None,
+                        help='Requests waiting for a worker before new ones get 503 (default: twice the workers)')
+    parser.add_argument('--timeout', type=float, default=600, help='Seconds a request waits for its result')
+    parser.add_argument('--dpi', type=int, default=RENDER_DPI, help='Resolution of the page render crops come from')
+    parser.add_argument('--max_bytes', type=int, default=MAX_PDF_BYTES, help='Largest pdf accepted (413 above)')
+    args = parser.parse_args()
+    service = ExtractionService(args.workers, args.queue_size, args.timeout, args.dpi, args.max_bytes)
+    server = serve(service, args.host, args.port, args.socket)
+    print('Serving on %s' % (args.socket or '%s:%d' % (args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
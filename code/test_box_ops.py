@@ -0,0 +1,104 @@
+'''
+Checks that the batched box_ops kernels give exactly what the scalar functions
+of xpdf_process give, on random boxes.
+
+Usage: python -m pytest code/test_box_ops.py  (or python -m unittest test_box_ops from code/)
+'''
+import random
+import unittest
+from functools import reduce
+from collections import namedtuple
+from box_ops import overlap_ratio_matrix, bbox_distance_matrix, box_union
+from document import Page
+from xpdf_process import overlap_ratio_based, bbox_distance, merge_two_boxes, merge_text_elements
+
+TRIALS = 200
+
+Info = namedtuple('Info', ['row_height'])
+
+
+def random_box(rng, integer=True):
+    # Some boxes have no area, some are far from the others
+    if integer:
+        return [rng.randint(-50, 600), rng.randint(-50, 800), rng.choice([0, rng.randint(0, 300)]),
+                rng.choice([0, rng.randint(0, 300)])]
+    return [rng.uniform(-50, 600), rng.uniform(-50, 800), rng.choice([0.0, rng.uniform(0, 300)]),
+            rng.uniform(0, 300)]
+
+
+def random_boxes(rng, integer=True):
+    return [random_box(rng, integer) for i in range(rng.randint(1, 12))]
+
+
+def scalar_merge_text_elements(new_fig, figcap, fig, elements, info):
+    # The loops merge_text_elements replaced: elements inside figcap, then elements near fig
+    for box, text in elements:
+        if overlap_ratio_based(box, figcap) > 0.05:
+            new_fig = merge_two_boxes(new_fig, box)
+    for box, text in elements:
+        if bbox_distance(box, fig) < info.row_height / 4:
+            new_fig = merge_two_boxes(new_fig, box)
+    return new_fig
+
+
+class BoxOpsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(0)
+
+    def test_overlap_ratio_matrix(self):
+        for trial in range(TRIALS):
+            integer = trial % 2 == 0
+            boxes1 = random_boxes(self.rng, integer)
+            boxes2 = random_boxes(self.rng, integer)
+            matrix = overlap_ratio_matrix(boxes1, boxes2)
+            self.assertEqual(matrix.shape, (len(boxes1), len(boxes2)))
+            for i, box1 in enumerate(boxes1):
+                for j, box2 in enumerate(boxes2):
+                    self.assertEqual(matrix[i, j], overlap_ratio_based(box1, box2))
+
+    def test_bbox_distance_matrix(self):
+        for trial in range(TRIALS):
+            integer = trial % 2 == 0
+            boxes1 = random_boxes(self.rng, integer)
+            boxes2 = random_boxes(self.rng, integer)
+            matrix = bbox_distance_matrix(boxes1, boxes2)
+            for i, box1 in enumerate(boxes1):
+                for j, box2 in enumerate(boxes2):
+                    self.assertEqual(matrix[i, j], bbox_distance(box1, box2))
+
+    def test_box_union(self):
+        # The pipeline boxes are integers; on floats the chained merge rounds x + w at each step
+        for trial in range(TRIALS):
+            boxes = random_boxes(self.rng)
+            self.assertEqual(box_union(boxes), reduce(merge_two_boxes, boxes))
+            boxes = random_boxes(self.rng, integer=False)
+            for union, merged in zip(box_union(boxes), reduce(merge_two_boxes, boxes)):
+                self.assertAlmostEqual(union, merged, places=9)
+
+    def test_page_boxes(self):
+        # Fractional boxes (browser layout, cached json) are kept as they are
+        for integer in (True, False):
+            boxes = random_boxes(self.rng, integer)
+            page = Page(1, [[box, 'text'] for box in boxes], (800, 600))
+            self.assertEqual(page.boxes.tolist(), boxes)
+            self.assertEqual(page.boxes.dtype.kind, 'i' if integer else 'f')
+
+    def test_merge_text_elements(self):
+        for trial in range(TRIALS):
+            integer = trial % 2 == 0
+            elements = [[box, 'text'] for box in random_boxes(self.rng, integer)]
+            page = Page(1, elements, (800, 600))
+            fig = random_box(self.rng, integer)
+            figcap = random_box(self.rng, integer)
+            info = Info(row_height=self.rng.choice([12, 13.5]))
+            self.assertEqual(merge_text_elements(list(fig), figcap, fig, page, info),
+                             scalar_merge_text_elements(list(fig), figcap, fig, elements, info))
+
+    def test_empty(self):
+        self.assertEqual(overlap_ratio_matrix([], [[0, 0, 10, 10]]).shape, (0, 1))
+        self.assertEqual(bbox_distance_matrix([[0, 0, 10, 10]], []).shape, (1, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
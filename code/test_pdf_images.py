@@ -0,0 +1,283 @@
+'''
+Checks pdf_images on small pdfs built here: classic xref tables, object and
+xref streams, Flate with PNG predictors, DCT passthrough, form XObjects and
+files it cannot read.
+
+Usage: python -m pytest code/test_pdf_images.py  (or python -m unittest test_pdf_images from code/)
+'''
+import io
+import os
+import zlib
+import random
+import shutil
+import tempfile
+import unittest
+from collections import namedtuple
+from PIL import Image
+import pdf_images
+from pdf_images import PdfImages, png_unpredict, native_figures
+
+PAGE = b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 600 800] /Resources 4 0 R /Contents 5 0 R >>'
+CATALOG = b'<< /Type /Catalog /Pages 2 0 R >>'
+PAGES = b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>'
+RESOURCES = b'<< /XObject << /Im1 6 0 R >> >>'
+# Image drawn 200 x 100 points, 50 from the left and 100 from the top of the page
+DRAW = b'q 200 0 0 100 50 600 cm /Im1 Do Q'
+
+Info = namedtuple('Info', ['page_width', 'page_height'])
+
+
+def stream(entries, data):
+    return b'<< ' + entries + b' /Length %d >>\nstream\n' % len(data) + data + b'\nendstream'
+
+
+def jpeg_bytes():
+    buffer = io.BytesIO()
+    Image.new('RGB', (40, 20), (200, 30, 30)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def png_predict(data, columns):
+    # PNG Up filter on every row, as writers use for Predictor 12
+    rows = [data[i:i + columns] for i in range(0, len(data), columns)]
+    previous = bytes(columns)
+    out = b''
+    for row in rows:
+        out += b'\x02' + bytes((b - p) & 0xff for b, p in zip(row, previous))
+        previous = row
+    return out
+
+
+def scalar_png_unpredict(data, colors, bits, columns):
+    # Byte at a time reference for png_unpredict
+    bpp = max(1, colors * bits // 8)
+    row_size = (colors * bits * columns + 7) // 8
+    out = bytearray()
+    previous = bytearray(row_size)
+    for pos in range(0, len(data) - row_size, row_size + 1):
+        kind = data[pos]
+        row = bytearray(data[pos + 1:pos + 1 + row_size])
+        for i in range(row_size):
+            left = row[i - bpp] if i >= bpp else 0
+            up = previous[i]
+            up_left = previous[i - bpp] if i >= bpp else 0
+            if kind == 1:
+                row[i] = (row[i] + left) & 0xff
+            elif kind == 2:
+                row[i] = (row[i] + up) & 0xff
+            elif kind == 3:
+                row[i] = (row[i] + (left + up) // 2) & 0xff
+            elif kind == 4:
+                p = left + up - up_left
+                pa, pb, pc = abs(p - left), abs(p - up), abs(p - up_left)
+                row[i] = (row[i] + (left if pa <= pb and pa <= pc else up if pb <= pc else up_left)) & 0xff
+        out.extend(row)
+        previous = row
+    return bytes(out)
+
+
+def classic_pdf(objects):
+    # objects: {number: body}; an xref table and a trailer like most writers produce
+    out = b'%PDF-1.4\n'
+    offsets = {}
+    for num in sorted(objects):
+        offsets[num] = len(out)
+        out += b'%d 0 obj\n' % num + objects[num] + b'\nendobj\n'
+    xref = len(out)
+    size = max(objects) + 1
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % size
+    for num in range(1, size):
+        out += b'%010d 00000 n \n' % offsets.get(num, 0)
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (size, xref)
+    return out
+
+
+def compressed_pdf(objects, packed, predictor=False):
+    # The objects in packed go into one object stream, and the file ends with an xref stream
+    bodies = b''
+    offsets = []
+    for num in packed:
+        offsets.append(len(bodies))
+        bodies += objects[num] + b'\n'
+    header = b' '.join(b'%d %d' % (num, offset) for num, offset in zip(packed, offsets)) + b'\n'
+    objstm = header + bodies
+    if predictor:
+        columns = 4
+        objstm = objstm + b' ' * (-len(objstm) % columns)
+        parms = b' /DecodeParms << /Predictor 12 /Columns %d >>' % columns
+        objstm_data = zlib.compress(png_predict(objstm, columns))
+    else:
+        parms = b''
+        objstm_data = zlib.compress(objstm)
+    loose = dict((num, body) for num, body in objects.items() if num not in packed)
+    stm_num = max(objects) + 1
+    loose[stm_num] = stream(b'/Type /ObjStm /N %d /First %d /Filter /FlateDecode' % (len(packed), len(header))
+                            + parms, objstm_data)
+    out = b'%PDF-1.5\n'
+    for num in sorted(loose):
+        out += b'%d 0 obj\n' % num + loose[num] + b'\nendobj\n'
+    xref = len(out)
+    rows = b''.join(b'\x01' + b'\x00' * 4 for num in range(stm_num + 1))
+    out += b'%d 0 obj\n' % (stm_num + 1) + stream(
+        b'/Type /XRef /Size %d /W [1 4 0] /Root 1 0 R /Filter /FlateDecode /DecodeParms << /Predictor 12 /Columns 5 >>'
+        % (stm_num + 2), zlib.compress(png_predict(rows, 5))) + b'\nendobj\n'
+    out += b'startxref\n%d\n%%%%EOF\n' % xref
+    return out
+
+
+def base_objects(image, content=DRAW, content_entries=b''):
+    return {1: CATALOG, 2: PAGES, 3: PAGE, 4: RESOURCES, 5: stream(content_entries, content), 6: image}
+
+
+def dct_image(entries=b''):
+    return stream(b'/Type /XObject /Subtype /Image /Width 40 /Height 20 /ColorSpace /DeviceRGB '
+                  b'/BitsPerComponent 8 /Filter /DCTDecode' + entries, jpeg_bytes())
+
+
+class PdfImagesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work)
+
+    def read(self, data):
+        pdf_path = os.path.join(self.work, 'test.pdf')
+        with open(pdf_path, 'wb') as f:
+            f.write(data)
+        return PdfImages(pdf_path)
+
+    def test_classic_xref(self):
+        images = self.read(classic_pdf(base_objects(dct_image())))
+        self.assertIsNone(images.error)
+        self.assertEqual(list(images.pages), [1])
+        image, = images.pages[1]
+        self.assertEqual((image.name, image.width, image.height, image.filter), ('Im1', 40, 20, 'DCTDecode'))
+        self.assertEqual(image.bbox, [50.0, 100.0, 200.0, 100.0])
+        self.assertEqual(image.page_size, (600.0, 800.0))
+
+    def test_object_and_xref_stream(self):
+        images = self.read(compressed_pdf(base_objects(dct_image()), [1, 2, 3, 4]))
+        self.assertIsNone(images.error)
+        self.assertEqual([image.bbox for image in images.pages[1]], [[50.0, 100.0, 200.0, 100.0]])
+
+    def test_object_stream_with_predictor(self):
+        images = self.read(compressed_pdf(base_objects(dct_image()), [1, 2, 3, 4], predictor=True))
+        self.assertIsNone(images.error)
+        self.assertEqual(len(images.pages[1]), 1)
+
+    def test_flate_content_with_predictor(self):
+        content = DRAW + b' ' * (-len(DRAW) % 8)
+        objects = base_objects(dct_image(), zlib.compress(png_predict(content, 8)),
+                               b'/Filter /FlateDecode /DecodeParms << /Predictor 12 /Columns 8 >>')
+        images = self.read(classic_pdf(objects))
+        self.assertEqual([image.bbox for image in images.pages[1]], [[50.0, 100.0, 200.0, 100.0]])
+
+    def test_flate_image_with_predictor(self):
+        # Listed with its filter, but only JPEG/JPEG 2000 are stored as files
+        pixels = bytes(range(40 * 3)) * 20
+        image = stream(b'/Type /XObject /Subtype /Image /Width 40 /Height 20 /ColorSpace /DeviceRGB '
+                       b'/BitsPerComponent 8 /Filter /FlateDecode '
+                       b'/DecodeParms << /Predictor 15 /Colors 3 /Columns 40 >>',
+                       zlib.compress(png_predict(pixels, 120)))
+        images = self.read(classic_pdf(base_objects(image)))
+        embedded, = images.pages[1]
+        self.assertEqual(embedded.filter, 'FlateDecode')
+        self.assertIsNone(images.native(embedded))
+
+    def test_png_unpredict(self):
+        data = bytes(range(256)) * 3
+        self.assertEqual(png_unpredict(png_predict(data, 16), 1, 8, 16), data)
+        # Sub filter, 3 bytes per pixel
+        row = bytes([10, 20, 30, 15, 25, 35])
+        self.assertEqual(png_unpredict(b'\x01' + bytes([10, 20, 30, 5, 5, 5]), 3, 8, 2), row)
+
+    def test_png_unpredict_filters(self):
+        rng = random.Random(3)
+        for colors, bits, columns in [(1, 8, 16), (3, 8, 7), (4, 8, 5), (1, 1, 13), (3, 16, 4)]:
+            row_size = (colors * bits * columns + 7) // 8
+            data = b''.join(bytes([rng.randrange(5)]) + bytes(rng.randrange(256) for i in range(row_size))
+                            for row in range(12))
+            self.assertEqual(png_unpredict(data + b'\x01\x02', colors, bits, columns),
+                             scalar_png_unpredict(data, colors, bits, columns), (colors, bits, columns))
+        with self.assertRaises(pdf_images.PdfError):
+            png_unpredict(b'\x05\x00', 1, 8, 1)
+
+    def test_dct_passthrough(self):
+        images = self.read(classic_pdf(base_objects(dct_image())))
+        self.assertEqual(images.native(images.pages[1][0]), (jpeg_bytes(), '.jpg'))
+
+    def test_masked_dct_not_native(self):
+        images = self.read(classic_pdf(base_objects(dct_image(b' /SMask 7 0 R'))))
+        self.assertIsNone(images.native(images.pages[1][0]))
+
+    def test_form_xobject(self):
+        objects = base_objects(dct_image(), b'q 1 0 0 1 10 -20 cm /Fm1 Do Q')
+        objects[4] = b'<< /XObject << /Fm1 7 0 R >> >>'
+        objects[7] = stream(b'/Type /XObject /Subtype /Form /BBox [0 0 600 800] /Matrix [1 0 0 1 5 0] '
+                            b'/Resources << /XObject << /Im1 6 0 R >> >>', DRAW)
+        images = self.read(classic_pdf(objects))
+        self.assertEqual([image.bbox for image in images.pages[1]], [[65.0, 120.0, 200.0, 100.0]])
+
+    def test_native_figures(self):
+        images = self.read(classic_pdf(base_objects(dct_image())))
+        info = Info(page_width=900, page_height=1200)
+        figures = {'page1.png': [[[75, 150, 300, 150], []], [[0, 900, 100, 100], []]]}
+        self.assertEqual(native_figures(figures, images, info), {(1, 1): (jpeg_bytes(), '.jpg')})
+
+    def test_encrypted(self):
+        objects = base_objects(dct_image())
+        data = classic_pdf(objects).replace(b'/Root 1 0 R', b'/Root 1 0 R /Encrypt << /Filter /Standard >>')
+        images = self.read(data)
+        self.assertEqual(images.pages, {})
+        self.assertEqual(images.error, 'Encrypted pdf')
+
+    def test_encrypt_in_stream_data(self):
+        # Only trailers and xref streams say a file is encrypted; stream data is not searched
+        objects = base_objects(dct_image(), DRAW + b'\n% /Encrypt << >> trailer << /Encrypt 9 0 R >>\n9 0 obj')
+        images = self.read(classic_pdf(objects))
+        self.assertIsNone(images.error)
+        self.assertEqual(len(images.pages[1]), 1)
+        data = compressed_pdf(base_objects(dct_image()), [1, 2, 3, 4]).replace(b'/Type /XRef',
+                                                                               b'/Type /XRef /Encrypt 9 0 R')
+        self.assertEqual(self.read(data).error, 'Encrypted pdf')
+
+    def test_limits(self):
+        data = classic_pdf(base_objects(dct_image()))
+        limits = pdf_images.MAX_PDF_BYTES, pdf_images.MAX_OBJECTS, pdf_images.MAX_STREAM_BYTES
+        try:
+            pdf_images.MAX_PDF_BYTES = len(data) - 1
+            self.assertEqual(self.read(data).error, 'Pdf over %d bytes' % (len(data) - 1))
+            pdf_images.MAX_PDF_BYTES = limits[0]
+            pdf_images.MAX_OBJECTS = 5
+            self.assertEqual(self.read(data).error, 'Pdf over 5 objects')
+            pdf_images.MAX_OBJECTS = limits[1]
+            pdf_images.MAX_STREAM_BYTES = 16
+            images = self.read(classic_pdf(base_objects(dct_image(), zlib.compress(DRAW), b'/Filter /FlateDecode')))
+            self.assertEqual(images.pages, {1: []})
+        finally:
+            pdf_images.MAX_PDF_BYTES, pdf_images.MAX_OBJECTS, pdf_images.MAX_STREAM_BYTES = limits
+
+    def test_malformed(self):
+        for data in [b'', b'not a pdf at all', classic_pdf(base_objects(dct_image()))[:300],
+                     classic_pdf(base_objects(dct_image())).replace(b'/Kids [3 0 R]', b'/Kids 7'),
+                     classic_pdf(base_objects(dct_image(), b'q 1 0 0 cm /Im1 Do (unterminated'))]:
+            images = self.read(data)
+            self.assertTrue(all(page_images == [] for page_images in images.pages.values()), data[:40])
+
+    def test_damaged(self):
+        # Damaged files list what can be read or set images.error; they never raise
+        rng = random.Random(7)
+        for data in [classic_pdf(base_objects(dct_image())),
+                     compressed_pdf(base_objects(dct_image()), [1, 2, 3, 4], predictor=True)]:
+            for trial in range(40):
+                damaged = bytearray(data)
+                for i in range(rng.randrange(1, 8)):
+                    damaged[rng.randrange(len(damaged))] = rng.choice(b'0123456789 /<>[]()R\x00\xff')
+                images = self.read(bytes(damaged))
+                self.assertIsInstance(images.pages, dict)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,266 @@
+'''
+tool_runner runs a corpus with asyncio driving the external tools (Python 3 only).
+
+Each document is processed by FigCap.batch_worker in a worker process of its own,
+so every FigCap option (cache, single render, manifest, results file, crop
+options, embedded images, metrics) works the same. The workers do not start
+pdftohtml and Ghostscript themselves: their tools.Tools sends each tool call to
+the event loop here, which runs it as an asyncio subprocess under the limit and
+timeout of that tool. A tool that runs over its time is killed with its whole
+process group. At most `processes` workers do python work at a time; a worker
+waiting for a tool gives its slot to another, so Ghostscript rendering one
+document overlaps pdftohtml and detection of the others.
+
+Workers are started by a fork server (spawned where there is none), never
+forked from this process, and killing or reaping them runs in a thread of the
+event loop.
+
+Usage: python tool_runner.py --input_path INPUT --output_path OUTPUT [--processes N]
+       [--pdftohtml_jobs N] [--gs_jobs N] [--documents N] [--tool_timeout S] [--timeout S]
+       [any other FigCap.py option]
+
+Results, the failure log and the manifest are the same as FigCap.py writes.
+'''
+import os
+import time
+import signal
+import asyncio
+import functools
+import threading
+import traceback
+import subprocess
+import multiprocessing
+import FigCap
+from tools import Tools, ToolTimeout
+
+
+class ToolRunner(object):
+
+    def __init__(self, workers=None, pdftohtml_jobs=None, gs_jobs=None, documents=None, tool_timeout=300):
+        # workers: worker processes doing python work at a time; *_jobs: tool processes at a time;
+        # documents: documents in flight (default: twice the workers, so tools and detection overlap)
+        workers = workers or multiprocessing.cpu_count()
+        self.limits = {'pdftohtml': asyncio.Semaphore(pdftohtml_jobs or workers),
+                       'gs': asyncio.Semaphore(gs_jobs or workers)}
+        self.cpu = asyncio.Semaphore(workers)
+        self.documents = asyncio.Semaphore(documents or 2 * workers)
+        self.tool_timeout = tool_timeout
+        self.context = worker_context()
+
+    async def run(self, tool, command, check=True, timeout=None):
+        # Run one tool process under the limit of its tool; returns its stdout
+        if timeout is None:
+            timeout = self.tool_timeout
+        async with self.limits[tool]:
+            process = await asyncio.create_subprocess_exec(*command, stdout=subprocess.PIPE,
+                                                           stderr=subprocess.PIPE, start_new_session=True)
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+            except asyncio.TimeoutError:
+                await kill_tool(process)
+                raise ToolTimeout('%s killed after %d seconds' % (tool, timeout))
+            except BaseException:
+                await kill_tool(process)
+                raise
+        if check and process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command, stdout)
+        return stdout
+
+    async def pdf_record(self, input_path, pdf, output_path, timeout, options, instrument=False, stream=False,
+                         checkpoint=None):
+        # The FigCap.batch_results record of one pdf: ok or error from its worker, timeout or crashed from here
+        async with self.documents:
+            loop = asyncio.get_running_loop()
+            start = time.time()
+            connection, worker_connection = self.context.Pipe()
+            worker = self.context.Process(target=document_worker,
+                                          args=(worker_connection, input_path, pdf, output_path, options, instrument,
+                                                stream, checkpoint))
+            try:
+                record = await asyncio.wait_for(self.serve(worker, connection, worker_connection), timeout)
+                if record is None:
+                    await loop.run_in_executor(None, worker.join)
+                    record = {'pdf': pdf, 'status': 'crashed', 'seconds': time.time() - start,
+                              'error': 'Worker exited with code %s' % worker.exitcode}
+            except asyncio.TimeoutError:
+                record = {'pdf': pdf, 'status': 'timeout', 'seconds': time.time() - start,
+                          'error': 'No result after %d seconds' % timeout}
+            except Exception as e:
+                record = {'pdf': pdf, 'status': 'error', 'seconds': time.time() - start, 'error': repr(e),
+                          'traceback': traceback.format_exc()}
+            finally:
+                connection.close()
+                worker_connection.close()
+                if worker.pid is not None:
+                    await loop.run_in_executor(None, stop_worker, worker)
+            return record
+
+    async def serve(self, worker, connection, worker_connection):
+        # Start the worker once a cpu slot is free and run the tools it asks for until it sends
+        # its record; the slot is given back while a tool runs. None if the worker exits without one.
+        await self.cpu.acquire()
+        holding = True
+        try:
+            start = asyncio.get_running_loop().run_in_executor(None, worker.start)
+            try:
+                await asyncio.shield(start)
+            except asyncio.CancelledError:
+                # let it start, so that pdf_record can stop it
+                await start
+                raise
+            worker_connection.close()
+            while True:
+                message = await receive(connection)
+                if message is None or message[0] == 'record':
+                    return message and message[1]
+                tool, command, check = message[1:]
+                self.cpu.release()
+                holding = False
+                try:
+                    reply = (True, await self.run(tool, command, check))
+                except (ToolTimeout, subprocess.CalledProcessError, OSError) as e:
+                    reply = (False, e)
+                await self.cpu.acquire()
+                holding = True
+                try:
+                    connection.send(reply)
+                except OSError:
+                    # the worker is gone; the next receive sees it
+                    pass
+        finally:
+            if holding:
+                self.cpu.release()
+
+
+class RemoteTools(Tools):
+    # Tools of a worker process: each tool runs in the parent, under its limits and timeout
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+
+    def run(self, tool, command, check=True):
+        with self.lock:
+            self.connection.send(('run', tool, command, check))
+            ok, result = self.connection.recv()
+        if not ok:
+            raise result
+        return result
+
+
+class RecordSender(object):
+    # The results queue of FigCap.batch_worker, over the connection to the parent
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def put(self, record):
+        self.connection.send(('record', record))
+
+
+def document_worker(connection, input_path, pdf, output_path, options, instrument, stream, checkpoint):
+    # Body of a worker process: FigCap.batch_worker with its tools run by the parent
+    options = dict(options, tools=RemoteTools(connection))
+    FigCap.batch_worker(input_path, pdf, output_path, RecordSender(connection), options, instrument, stream,
+                        checkpoint)
+    connection.close()
+
+
+def worker_context():
+    # A fork server starts the workers with the pipeline imported, as forking this
+    # process (an event loop with threads) is not safe
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['FigCap'])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+async def receive(connection):
+    # Next message of a worker, None once it has exited; waits on the event loop, not in a thread
+    loop = asyncio.get_running_loop()
+    readable = loop.create_future()
+    loop.add_reader(connection.fileno(), lambda: readable.done() or readable.set_result(None))
+    try:
+        await readable
+    finally:
+        loop.remove_reader(connection.fileno())
+    try:
+        return connection.recv()
+    except EOFError:
+        return None
+
+
+async def kill_tool(process):
+    # The tool and anything it started share its session
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    await process.wait()
+
+
+def stop_worker(worker):
+    # Kill the worker and its process group unless it has exited, and reap it
+    if worker.exitcode is None:
+        FigCap.kill_worker(worker)
+    worker.join()
+
+
+def batch_results(input_path, output_path, pdfs=None, processes=None, timeout=600, instrument=False, stream=False,
+                  manifest=None, pdftohtml_jobs=None, gs_jobs=None, documents=None, tool_timeout=300, **options):
+    # FigCap.batch_results with the tools run by an event loop here: same arguments, same records.
+    # FigCap.run_batch takes it as batch, with the tool limits bound by functools.partial.
+    # processes: worker processes doing python work at a time
+    if pdfs is None:
+        pdfs = FigCap.list_pdfs(input_path)
+    if not os.path.isdir(output_path + '/xpdf/'):
+        os.mkdir(output_path + '/xpdf/')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    runner = ToolRunner(processes, pdftohtml_jobs, gs_jobs, documents, tool_timeout)
+    tasks = set()
+    for pdf in pdfs:
+        checkpoint = None
+        if manifest is not None:
+            checkpoint = manifest.checkpoint(pdf, input_path + '/' + pdf)
+        tasks.add(loop.create_task(runner.pdf_record(input_path, pdf, output_path, timeout, options, instrument,
+                                                     stream, checkpoint)))
+    try:
+        while tasks:
+            done, tasks = loop.run_until_complete(asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED))
+            for task in done:
+                record = task.result()
+                if manifest is not None and record['status'] in ('timeout', 'crashed'):
+                    manifest.update(record['pdf'], error=record['error'])
+                yield record
+    finally:
+        # Stopped early: kill what is still running
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def run_corpus(input_path, output_path, workers=None, pdftohtml_jobs=None, gs_jobs=None, documents=None,
+               tool_timeout=300, timeout=600, log_file=None, **options):
+    # FigCap.run_batch with the tools run by an event loop; options as for run_batch
+    batch = functools.partial(batch_results, pdftohtml_jobs=pdftohtml_jobs, gs_jobs=gs_jobs, documents=documents,
+                              tool_timeout=tool_timeout)
+    return FigCap.run_batch(input_path, output_path, workers, timeout, log_file, batch=batch, **options)
+
+
+if __name__ == "__main__":
+    parser = FigCap.argument_parser('Extract figures and captions with asyncio driven pdftohtml and gs')
+    parser.add_argument('--pdftohtml_jobs', type=int, default=None, help='pdftohtml processes at a time')
+    parser.add_argument('--gs_jobs', type=int, default=None, help='Ghostscript processes at a time')
+    parser.add_argument('--documents', type=int, default=None,
+                        help='Documents in flight at a time (default: twice the processes)')
+    parser.add_argument('--tool_timeout', type=float, default=300,
+                        help='Seconds before a pdftohtml or gs process is killed')
+    args = parser.parse_args()
+    print(FigCap.run_arguments(args, functools.partial(batch_results, pdftohtml_jobs=args.pdftohtml_jobs,
+                                                       gs_jobs=args.gs_jobs, documents=args.documents,
+                                                       tool_timeout=args.tool_timeout)))
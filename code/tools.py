@@ -0,0 +1,42 @@
+'''
+tools runs the external programs of the pipeline (pdftohtml, Ghostscript).
+Every stage that needs one goes through a Tools object, so a driver can decide
+where and how the tools run: Tools runs them here as child processes, and
+tool_runner passes its workers a Tools that has them run by its event loop.
+
+    tools.run('gs', command)               stdout; CalledProcessError on a non-zero exit
+    tools.pdftohtml(PDFTOHTML, pdf, html_dir, args)
+'''
+import os
+import shutil
+import subprocess
+
+
+class ToolTimeout(Exception):
+    pass
+
+
+class Tools(object):
+
+    def run(self, tool, command, check=True):
+        # Run one tool process to the end and return its stdout. The tool stays in the
+        # process group of the caller, so a batch worker killed on timeout takes it along.
+        process = subprocess.Popen(command, stdout=subprocess.PIPE)
+        stdout = process.communicate()[0]
+        if check and process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command, stdout)
+        return stdout
+
+    def pdftohtml(self, pdftohtml, pdf_path, html_dir, args=()):
+        # Written to html_dir.part and renamed once complete, so a killed or failed
+        # pdftohtml never leaves a folder the next run would take as done
+        part_dir = html_dir + '.part'
+        shutil.rmtree(part_dir, ignore_errors=True)
+        try:
+            self.run('pdftohtml', [pdftohtml] + list(args) + [pdf_path, part_dir + '/'])
+            os.rename(part_dir, html_dir)
+        finally:
+            shutil.rmtree(part_dir, ignore_errors=True)
+
+
+LOCAL_TOOLS = Tools()
@@ -12,82 +12,123 @@ The main code for figure and caption extraction (figures_captions_list)
 
 '''
 
-import subprocess
 import os
 import numpy as np
-import matplotlib.pyplot as plt
-import sys
 import cv2
-import codecs
-import matplotlib.patches as patches
-import scipy.misc
 import re
-from lxml import etree
-from selenium import webdriver
 from pdf_info import pdf_info
-
-
-
-def figures_captions_list(input_path, pdf, output_path):
+import renderer
+from multiprocessing.pool import ThreadPool
+from box_index import BoxGrid
+from box_ops import overlap_ratio_matrix, bbox_distance_matrix, box_union, as_boxes
+from metrics import NULL_METRICS
+
+
+# Dilation kernel and reduced decode flag for each detection_scale
+DILATION_SIZE = {1: 5, 2: 3, 4: 2}
+REDUCED_GRAYSCALE = {2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4}
+# Resolution of pdftohtml's background pngs (its -r default); the dilation kernel is sized for it
+PDFTOHTML_DPI = 150
+# An embedded image takes over the raster boxes this much inside it
+IMAGE_OVERLAP = 0.9
+# Embedded images covering this share of the page are page scans, not figures
+FULL_PAGE_IMAGE = 0.6
+
+def figures_captions_list(input_path, pdf, output_path, page_images=None, cache_entry=None, detection_scale=1,
+                          metrics=NULL_METRICS, page_workers=1, embedded_images=None):
 # input: single pdf file
 # output: bounding box list of figures and captions
+# page_images: {page_no: PIL page render} to detect on instead of the pdftohtml pngs, such as
+# renderer.LazyPages; rendered at output_dpi (default PDFTOHTML_DPI)
+# cache_entry: layout_cache entry holding the pdftohtml output and layout of this pdf
+# detection_scale: 1, 2 or 4, detect graphics on a page raster reduced by this factor
+# metrics: metrics.Metrics to record stage times and counters in
+# page_workers: number of pages detected in parallel
+# embedded_images: {page_no: [pdf_images.EmbeddedImage]}, image placements used as figure candidates
     pdf_filename = input_path + pdf
     html_file_path = output_path + pdf[:-4]
+    if cache_entry is not None:
+        html_file_path = cache_entry.html_dir
 # 1. Read pdfs from input folder  (pdf_info)
-    info, html_boxes = pdf_info(html_file_path, pdf)
+    with metrics.stage('pdf_info'):
+        info, document = pdf_info(html_file_path, pdf, cache_entry=cache_entry)
+    metrics.count('pages', info.page_no)
+    metrics.count('text_elements', sum(len(page.elements) for page in document))
+    image_boxes = None
+    if embedded_images is not None:
+        from pdf_images import html_boxes
+        image_boxes = dict((page_no, html_boxes(embedded_images[page_no], info)) for page_no in embedded_images)
 #  2.1. graphical content detection
-    cap_box, fig_box, info, table_box, text_box = box_detection(html_file_path, info, html_boxes)
-    pre_figures, cap_regions = fig_cap_matching(cap_box, fig_box, info, table_box, text_box)
-    figures, captions = evaluation(pre_figures, cap_regions, html_file_path, info, html_boxes) # Remove figure_table and figure caption in one box
-    figures, captions = check_region(info, figures, captions)
+    with metrics.stage('box_detection'):
+        cap_box, fig_box, info, table_box, text_box = box_detection(html_file_path, info, document, page_images,
+                                                                    detection_scale, metrics, page_workers,
+                                                                    image_boxes)
+    with metrics.stage('fig_cap_matching'):
+        pre_figures, cap_regions = fig_cap_matching(cap_box, fig_box, info, table_box, text_box)
+    with metrics.stage('evaluation'):
+        figures, captions = evaluation(pre_figures, cap_regions, html_file_path, info, document, metrics) # Remove figure_table and figure caption in one box
+    with metrics.stage('check_region'):
+        figures, captions = check_region(info, figures, captions)
+    metrics.count('figures', sum(len(figures[page]) for page in figures))
     no_of_figures = sum([len(figures[x]) for x in figures])
     no_of_caps = sum([len(cap_box[x]) for x in cap_box])
     no_of_figs = sum([len(fig_box[x]) for x in fig_box])
-    #print info['filename']
-    #print info['mess_up']
-    #print info['fig_no_est']
+    #print info.filename
+    #print info.mess_up
+    #print info.fig_no_est
 
     #
     # print no_of_figures
     # if no_of_figures == no_of_caps:
     #     figures, cap_regions = same_no_caps_est(cap_box, fig_box, info, table_box, text_box)
     #
-    r = info['png_ratio']
-    # plt.close("all")
-    # for i in range(info['page_no']):
-    #     page = 'page' + str(i + 1) + '.png'
-    #     img = cv2.imread(html_file_path + '/' + page)
-    #     fig, ax = plt.subplots(1)
-    #     ax.imshow(img)
-    #     for each_caption in cap_box[page]:
-    #         rect = patches.Rectangle((each_caption[0]*r, each_caption[1]*r), each_caption[2]*r, each_caption[3]*r,
-    #                                  linewidth=1, edgecolor='g',
-    #                                  facecolor='none')
-    #         ax.add_patch(rect)
-    #
-    #     for each_fig in fig_box[page]:
-    #         #each_fig = each_fig[0]
-    #         rect = patches.Rectangle((each_fig[0]*r, each_fig[1]*r), each_fig[2]*r, each_fig[3]*r,
-    #                                  linewidth=2, edgecolor='b',
-    #                                  facecolor='none')
-    #         ax.add_patch(rect)
-    #     for each_cap_region in cap_regions[page]:
-    #         rect = patches.Rectangle((each_cap_region[1][0]*r, each_cap_region[1][1]*r), each_cap_region[1][2]*r, each_cap_region[1][3]*r,
-    #                                  linewidth=1, edgecolor='y',
-    #                                  facecolor='none')
-    #         ax.add_patch(rect)
-    #     for each_result in figures[page]:
-    #         each_result = each_result[0]
-    #         rect = patches.Rectangle((each_result[0]*r, each_result[1]*r), each_result[2]*r, each_result[3]*r,
-    #                                  linewidth=1, edgecolor='r',
-    #                                  facecolor='none')
-    #         ax.add_patch(rect)
-    #     plt.show()
+    # show_detection(html_file_path, info, cap_box, fig_box, cap_regions, figures)
     return figures, info
 
 
-
-def box_detection(html_file_path, info, html_boxes):
+def show_detection(html_file_path, info, cap_box, fig_box, cap_regions, figures):
+    # Debug view of every page: captions green, graphics blue, caption regions yellow, figures red.
+    # matplotlib is only needed here and is imported on first use.
+    import matplotlib.pyplot as plt
+    import matplotlib.patches as patches
+    r = info.png_ratio
+    plt.close("all")
+    for i in range(info.page_no):
+        page = 'page' + str(i + 1) + '.png'
+        img = cv2.imread(html_file_path + '/' + page)
+        fig, ax = plt.subplots(1)
+        ax.imshow(img)
+        for each_caption in cap_box[page]:
+            rect = patches.Rectangle((each_caption[0]*r, each_caption[1]*r), each_caption[2]*r, each_caption[3]*r,
+                                     linewidth=1, edgecolor='g',
+                                     facecolor='none')
+            ax.add_patch(rect)
+
+        for each_fig in fig_box[page]:
+            rect = patches.Rectangle((each_fig[0]*r, each_fig[1]*r), each_fig[2]*r, each_fig[3]*r,
+                                     linewidth=2, edgecolor='b',
+                                     facecolor='none')
+            ax.add_patch(rect)
+        for each_cap_region in cap_regions[page]:
+            rect = patches.Rectangle((each_cap_region[1][0]*r, each_cap_region[1][1]*r), each_cap_region[1][2]*r,
+                                     each_cap_region[1][3]*r,
+                                     linewidth=1, edgecolor='y',
+                                     facecolor='none')
+            ax.add_patch(rect)
+        for each_result in figures[page]:
+            each_result = each_result[0]
+            rect = patches.Rectangle((each_result[0]*r, each_result[1]*r), each_result[2]*r, each_result[3]*r,
+                                     linewidth=1, edgecolor='r',
+                                     facecolor='none')
+            ax.add_patch(rect)
+        plt.show()
+
+
+
+def box_detection(html_file_path, info, document, page_images=None, detection_scale=1, metrics=NULL_METRICS,
+                  page_workers=1, image_boxes=None):
+    # page_workers: detect that many pages at a time on threads (cv2 and numpy release the GIL)
+    # image_boxes: {page_no: [x, y, w, h] of the embedded images}, candidates besides the raster regions
     fig_box = {}
     cap_box = {}
     word_box = {}
@@ -95,162 +136,220 @@ def box_detection(html_file_path, info, html_boxes):
     table_box={}
     #browser = webdriver.Chrome('/home/pengyuan/Documents/FC_extraction/chromedriver')
 
-    for page in sorted(os.listdir(html_file_path)):
-        if page.endswith('.png') and page.startswith('page'):
-        
-            page_no = int(page[4:-4])
-            img = cv2.imread(html_file_path + '/' + page)
-            # plt.imshow(img)
-            png_size = img.shape
-            if png_size[0] > png_size[1]:
-                png_ratio = float(png_size[0]) / info['page_height']
-            else:
-                png_ratio = float(png_size[0]) / info['page_width']
-
-            # Read each page html find "Fig"
-            # f = codecs.open(html_file_path + '/' + page[:-4] + '.html', 'r')
-            # text = f.readline()
-            # html_file = 'file://' + html_file_path + '/' + page[:-4] + '.html'
-            # browser.get(html_file)
-
-            text = ''
-            text_box = []
-            page_word_box = []
-            table_cap_box = []
-            div_no = 1
-            for page_html in html_boxes:
-                if page_html[0] == page_no:
-                    text_elements = page_html[1]
-
-            for e in text_elements:
-                text = e[1]
-                #if e.size['width'] > info['row_width']-100:
-                page_word_box.append([max(e[0][0]-info['row_height'], 0)
-                                        , e[0][1]
-                                        , e[0][2]+2*info['row_height'],
-                                     e[0][3]])
-                if text.startswith('Table') or text.startswith('table') or text.startswith('Box'):
-                    table_cap_box.append([e[0][0], e[0][1], e[0][2], e[0][3]])
-                if text.startswith('Fig') or text.startswith('fig') or text.startswith('FIG'):
-                    #print text
-                    text_box.append([e[0][0], e[0][1], e[0][2], e[0][3]])
-                    cap_no_clue.append(text)
-                elif 'Fig' not in text and len(text) > 6:
-                    text = text[:6]
-                    idx1 = text.find('F')
-                    idx2 = text.find('i')
-                    idx3 = text.find('g')
-                    if idx1>= 0 and idx2>=0 and idx3>= 0 and idx2>idx1 and idx3>idx2:
-                        #print text
-                        text_box.append([e[0][0], e[0][1], e[0][2], e[0][3]])
-                    # rect = patches.Rectangle((e.location['x'] * png_ratio, e.location['y'] * png_ratio),
-                    #                          e.size['width'] * png_ratio,
-                    #                          e.size['height'] * png_ratio,
-                    #                          linewidth=1, edgecolor='b',
-                    #                          facecolor='none')
-                    # ax.add_patch(rect)
-
-
-            cap_box[page] = text_box
-            table_box[page] = table_cap_box
-            word_box[page] = page_word_box
-        
-            imgray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            ret, thresh = cv2.threshold(imgray, 240, 255, cv2.THRESH_BINARY_INV)
-            kernel = np.ones((5, 5), np.uint8)
-            dilation = cv2.dilate(thresh, kernel, iterations=1)
-            contours, hierarchy = cv2.findContours(dilation,cv2.RETR_TREE,cv2.CHAIN_APPROX_SIMPLE)
-            new_thresh = np.zeros(thresh.shape, dtype=np.uint8)
-      
-            for cnt in contours:
-                bbox = cv2.boundingRect(cnt)
-                p_bbox = [int(float(x) / png_ratio) for x in bbox]
-                box_image = 0
-                for caption_box in text_box:
-                    box_image = box_image + overlap_ratio_based(caption_box, p_bbox)
-                if box_image < 0.5:
-                    cv2.drawContours(new_thresh, [cnt], 0, 255, -1)
-
-            contours, hierarchy = cv2.findContours(new_thresh,
-                                                          cv2.RETR_EXTERNAL,
-                                                          cv2.CHAIN_APPROX_SIMPLE)
-
-            # scipy.misc.imsave('thresh.jpg', thresh)
-            potential_bbox = []
-            # fig, ax = plt.subplots(1)
-            # ax.imshow(img)
-            for cnt in contours:
-                bbox = cv2.boundingRect(cnt)
-                thresh_for_figure = info['row_height'] * png_ratio*1.5#/ 2  modified on 0318
-                if bbox[3] > thresh_for_figure and bbox[2] > thresh_for_figure:  # Important to set, FIg threshold
-
-                    p_bbox = [int(float(x) / png_ratio) for x in bbox]
-                    # Format checking, to filter box that at top, down, left or right
-                    ol_left = overlap_ratio_based(p_bbox, info['left_bbox'])
-                    ol_right = overlap_ratio_based(p_bbox, info['right_bbox'])
-                    # Add filter for first page top sign 0110
-                    if page == 'page1.png':
-                        ol_top = overlap_ratio_based(p_bbox, [0, 0, info['page_width'],
-                                                              info['page_height'] / 4])  # First page box
-                    else:
-                        ol_top = overlap_ratio_based(p_bbox, info['top_bbox'])
-
-                    ol_down = overlap_ratio_based(p_bbox, info['down_bbox'])
-                    ol_sum = 0
-                    ol_sum = ol_down + ol_left + ol_right + ol_top
-                    if ol_sum < 0.1:
-                        potential_bbox.append(p_bbox)
-                        # rect = patches.Rectangle((bbox[0], bbox[1]), bbox[2],bbox[3],
-                        #                         linewidth=1, edgecolor='r',
-                        #                        facecolor='none')
-                        # ax.add_patch(rect)
-
-            fig_box[page] = potential_bbox
-
-            # To check if the pdf is mess up
-            if len(potential_bbox) > 1:
-                obj_heights = np.array(potential_bbox)[:, 3]
-                no_of_all = len(obj_heights)
-                no_of_small = len([1 for obj_height in obj_heights if obj_height < 13 and obj_height > 4])
-                small_percent = float(no_of_small) / no_of_all
-                if no_of_all > 300 and small_percent > 0.8:
-                    info['mess_up'] = True
-
-            count = 0
-
-            if info['mess_up'] == False:# Need to set carefully
-                while count < len(potential_bbox):# ###Need to think about it.....
-                    flag = 0
-                    for each_text_box in page_word_box:# Remove fig box that cross the text box
-                        overlap = overlap_ratio_based(potential_bbox[count], each_text_box)
-                        if overlap > 0.3:
-                            flag = 1
-                            del potential_bbox[count]
-                            break
-                    if flag == 0:
-                        count = count +1
-            else:
-                while count < len(potential_bbox):# ###Need to think about it.....
-                    flag = 0
-                    if potential_bbox[count][3]>12:
-                        for each_text_box in page_word_box:# Remove fig box that cross the text box
-                            overlap = overlap_ratio_based(potential_bbox[count], each_text_box)
-                            if overlap > 0.1:
-                                flag = 1
-                                del potential_bbox[count]
-                                break
-                        if flag == 0:
-                            count = count +1
-                    else:
-                        del potential_bbox[count]
-
-
-            fig_box[page] = potential_bbox
-
-    info['fig_no_est'] = fig_no_estimation(cap_no_clue)
-    info['png_ratio'] = png_ratio
+    pages = [page for page in sorted(os.listdir(html_file_path)) if page.endswith('.png') and page.startswith('page')]
+    def detect(page):
+        page_image_boxes = None
+        if image_boxes is not None:
+            page_image_boxes = image_boxes.get(int(page[4:-4]), [])
+        return page_detection(html_file_path, page, info, document, page_images, detection_scale, metrics,
+                              page_image_boxes)
+    if page_workers > 1 and len(pages) > 1:
+        pool = ThreadPool(min(page_workers, len(pages)))
+        page_results = pool.map(detect, pages)
+        pool.close()
+        pool.join()
+    else:
+        page_results = [detect(page) for page in pages]
+
+    # Merged in listing order: once a page is found mess_up, the pages after it are filtered as mess_up
+    for page, page_result in zip(pages, page_results):
+        text_box, table_cap_box, page_clues, potential_bbox, page_mess_up, png_ratio = page_result
+        page_word_box = document.get(int(page[4:-4])).word_boxes
+        cap_box[page] = text_box
+        table_box[page] = table_cap_box
+        word_box[page] = page_word_box
+        cap_no_clue.extend(page_clues)
+        if page_mess_up:
+            info = info._replace(mess_up=True)
+            metrics.count('mess_up_pages')
+
+        # Remove fig box that cross the text box
+        word_index = BoxGrid(page_word_box)
+        if info.mess_up == False:# Need to set carefully
+            potential_bbox = [p_bbox for p_bbox in potential_bbox
+                              if not overlaps_any(p_bbox, page_word_box, word_index, 0.3)]
+        else:
+            potential_bbox = [p_bbox for p_bbox in potential_bbox
+                              if p_bbox[3] > 12 and not overlaps_any(p_bbox, page_word_box, word_index, 0.1)]
+
+
+        fig_box[page] = potential_bbox
+        metrics.count('figure_boxes', len(potential_bbox))
+
+    info = info._replace(fig_no_est=fig_no_estimation(cap_no_clue), png_ratio=png_ratio)
     return cap_box, fig_box, info, table_box, page_word_box
 
+def page_detection(html_file_path, page, info, document, page_images=None, detection_scale=1, metrics=NULL_METRICS,
+                   image_boxes=None):
+    # Everything box_detection finds on one page before the mess_up dependent word filter:
+    # caption boxes, table caption boxes, caption clues, candidate figure boxes,
+    # whether the page looks mess_up and the png_ratio of its raster
+    page_no = int(page[4:-4])
+    imgray = page_gray(html_file_path, page, page_images, detection_scale)
+    # plt.imshow(img)
+    # Ratio of the raster actually used, so thresholds and boxes follow the reduction
+    png_ratio = renderer.page_ratio(imgray.shape, info)
+
+    # Read each page html find "Fig"
+    # f = codecs.open(html_file_path + '/' + page[:-4] + '.html', 'r')
+    # text = f.readline()
+    # html_file = 'file://' + html_file_path + '/' + page[:-4] + '.html'
+    # browser.get(html_file)
+
+    text = ''
+    text_box = []
+    cap_no_clue = []
+    table_cap_box = []
+    div_no = 1
+    page_doc = document.get(page_no)
+    text_elements = page_doc.elements
+
+    for e in text_elements:
+        text = e[1]
+        #if e.size['width'] > info.row_width-100:
+        if text.startswith('Table') or text.startswith('table') or text.startswith('Box'):
+            table_cap_box.append([e[0][0], e[0][1], e[0][2], e[0][3]])
+        if text.startswith('Fig') or text.startswith('fig') or text.startswith('FIG'):
+            #print text
+            text_box.append([e[0][0], e[0][1], e[0][2], e[0][3]])
+            cap_no_clue.append(text)
+        elif 'Fig' not in text and len(text) > 6:
+            text = text[:6]
+            idx1 = text.find('F')
+            idx2 = text.find('i')
+            idx3 = text.find('g')
+            if idx1>= 0 and idx2>=0 and idx3>= 0 and idx2>idx1 and idx3>idx2:
+                #print text
+                text_box.append([e[0][0], e[0][1], e[0][2], e[0][3]])
+            # rect = patches.Rectangle((e.location['x'] * png_ratio, e.location['y'] * png_ratio),
+            #                          e.size['width'] * png_ratio,
+            #                          e.size['height'] * png_ratio,
+            #                          linewidth=1, edgecolor='b',
+            #                          facecolor='none')
+            # ax.add_patch(rect)
+
+
+    if page_images is not None:
+        imgray = strip_text(imgray, text_elements, png_ratio)
+    ret, thresh = cv2.threshold(imgray, 240, 255, cv2.THRESH_BINARY_INV)
+    kernel = np.ones((DILATION_SIZE[detection_scale], DILATION_SIZE[detection_scale]), np.uint8)
+    dilation = cv2.dilate(thresh, kernel, iterations=1)
+    regions = graphic_regions(dilation, text_box, png_ratio, metrics)
+    metrics.count('graphic_regions', len(regions))
+
+    # scipy.misc.imsave('thresh.jpg', thresh)
+    thresh_for_figure = info.row_height * png_ratio*1.5#/ 2  modified on 0318
+    regions = regions[(regions[:, 3] > thresh_for_figure) & (regions[:, 2] > thresh_for_figure)]  # Important to set, FIg threshold
+    p_bboxes = (regions / png_ratio).astype(int)
+    if image_boxes:
+        p_bboxes = with_image_boxes(p_bboxes, image_boxes, thresh_for_figure / png_ratio, info)
+        metrics.count('image_candidates', len(image_boxes))
+    # Format checking, to filter box that at top, down, left or right
+    # Add filter for first page top sign 0110
+    if page == 'page1.png':
+        top_bbox = [0, 0, info.page_width, info.page_height / 4]  # First page box
+    else:
+        top_bbox = info.top_bbox
+    ol = overlap_ratio_matrix(p_bboxes, [info.down_bbox, info.left_bbox, info.right_bbox, top_bbox])
+    ol_sum = ol[:, 0] + ol[:, 1] + ol[:, 2] + ol[:, 3]
+    potential_bbox = p_bboxes[ol_sum < 0.1].tolist()
+    metrics.count('candidate_boxes', len(potential_bbox))
+
+    # To check if the pdf is mess up
+    mess_up = False
+    if len(potential_bbox) > 1:
+        obj_heights = np.array(potential_bbox)[:, 3]
+        no_of_all = len(obj_heights)
+        no_of_small = len([1 for obj_height in obj_heights if obj_height < 13 and obj_height > 4])
+        small_percent = float(no_of_small) / no_of_all
+        if no_of_all > 300 and small_percent > 0.8:
+            mess_up = True
+
+    return text_box, table_cap_box, cap_no_clue, potential_bbox, mess_up, png_ratio
+
+def with_image_boxes(p_bboxes, image_boxes, min_size, info):
+    # Raster candidate boxes with the embedded images of the page: an image replaces the raster
+    # boxes lying inside it, so a bitmap figure gets its exact placement. Images about the size
+    # of the page (scanned pages) are left to the raster.
+    images = as_boxes(image_boxes)
+    page_area = info.page_width * info.page_height
+    images = images[(images[:, 2] > min_size) & (images[:, 3] > min_size) &
+                    (images[:, 2] * images[:, 3] < FULL_PAGE_IMAGE * page_area)]
+    if len(images) == 0:
+        return p_bboxes
+    kept = p_bboxes[~(overlap_ratio_matrix(p_bboxes, images) >= IMAGE_OVERLAP).any(axis=1)]
+    new_images = images[~(overlap_ratio_matrix(images, kept) >= IMAGE_OVERLAP).any(axis=1)]
+    return np.concatenate([kept, new_images]).astype(int)
+
+def graphic_regions(dilation, text_box, png_ratio, metrics=NULL_METRICS):
+    # Pixel [x, y, w, h] of the graphical regions of a page: the contours of the RETR_TREE
+    # hierarchy whose box does not hold a caption, filled, as external contour boxes.
+    # Only contours without a kept ancestor can show, and when those are all top level
+    # their boxes are read off the contour points without drawing anything.
+    contours, hierarchy = cv2.findContours(dilation, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    metrics.count('contours', len(contours))
+    if len(contours) == 0:
+        return np.zeros((0, 4), dtype=int)
+    # Bounding rects of all contours at once
+    lengths = np.array([len(cnt) for cnt in contours])
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    points = np.concatenate(contours).reshape(-1, 2)
+    x0 = np.minimum.reduceat(points[:, 0], starts)
+    y0 = np.minimum.reduceat(points[:, 1], starts)
+    x1 = np.maximum.reduceat(points[:, 0], starts)
+    y1 = np.maximum.reduceat(points[:, 1], starts)
+    rects = np.stack([x0, y0, x1 - x0 + 1, y1 - y0 + 1], axis=1).astype(int)
+    # Sum over captions of the caption part inside each contour box
+    box_image = overlap_ratio_matrix(text_box, (rects / png_ratio).astype(int)).sum(axis=0)
+    kept = box_image < 0.5
+    # A kept contour is hidden by the fill of any kept ancestor
+    parent = hierarchy[0][:, 3]
+    has_parent = parent >= 0
+    covered = np.zeros(len(contours), dtype=bool)
+    while True:
+        new_covered = has_parent & (kept[parent] | covered[parent])
+        if (new_covered == covered).all():
+            break
+        covered = new_covered
+    shown = kept & ~covered
+    if not (shown & has_parent).any():
+        # Only top level contours: their fills are separate components
+        return rects[shown]
+    # Some caption box was dropped and its inner contours kept; their fills may touch
+    new_thresh = np.zeros(dilation.shape, dtype=np.uint8)
+    for cnt_id in np.flatnonzero(shown):
+        cv2.drawContours(new_thresh, [contours[cnt_id]], 0, 255, -1)
+    contours, hierarchy = cv2.findContours(new_thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return np.array([cv2.boundingRect(cnt) for cnt in contours], dtype=int).reshape(-1, 4)
+
+def page_gray(html_file_path, page, page_images=None, detection_scale=1):
+    # Grayscale raster of one page, either pdftohtml's png or the shared render,
+    # reduced by detection_scale (the png is decoded straight at the reduced size).
+    # The shared render is first brought to pdftohtml's resolution, so the dilation
+    # kernel closes the same physical gaps as on pdftohtml's png.
+    if page_images is None:
+        if detection_scale == 1:
+            img = cv2.imread(html_file_path + '/' + page)
+            return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        return cv2.imread(html_file_path + '/' + page, REDUCED_GRAYSCALE[detection_scale])
+    img = np.asarray(page_images[int(page[4:-4])])
+    imgray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    scale = detection_scale * float(getattr(page_images, 'output_dpi', PDFTOHTML_DPI)) / PDFTOHTML_DPI
+    if scale == 1:
+        return imgray
+    return cv2.resize(imgray, (int(round(imgray.shape[1] / scale)), int(round(imgray.shape[0] / scale))),
+                      interpolation=cv2.INTER_AREA if scale > 1 else cv2.INTER_LINEAR)
+
+def strip_text(imgray, text_elements, png_ratio):
+    # White out the html text lines, as pdftohtml does for its background png
+    for e in text_elements:
+        x0 = max(int(e[0][0] * png_ratio), 0)
+        y0 = max(int(e[0][1] * png_ratio), 0)
+        x1 = int(np.ceil((e[0][0] + e[0][2]) * png_ratio))
+        y1 = int(np.ceil((e[0][1] + e[0][3]) * png_ratio))
+        imgray[y0:y1, x0:x1] = 255
+    return imgray
+
 def fig_no_estimation(fig_info):
     #print fig_info
     fig_no = 0
@@ -269,34 +368,20 @@ def fig_cap_matching(cap_box, fig_box, info, table_box, text_box):
     figures = {}
     captions = {}
     fig_size_thresh = 30
-    for i in range(info['page_no']):
+    for i in range(info.page_no):
         page = 'page' + str(i+1) + '.png'
         table_caps = table_box[page]
 
         p_captions = cap_box[page]
         p_figures = fig_box[page]
+        table_cap_boxes = []
         for table_cap in table_caps:# To remove the table
-            table_cap_box = [table_cap[0], table_cap[1]+table_cap[3], table_cap[2],4*info['row_height']]# Remove the table below
-            p_figure_id = 0
-            while p_figure_id < len(p_figures):
-                p_figure = p_figures[p_figure_id]
-
-                overlap = overlap_ratio_based(table_cap_box, p_figure)
-                if overlap >0.1:
-                    del p_figures[p_figure_id]
-                else:
-                    p_figure_id = p_figure_id + 1
-            table_cap_box = [table_cap[0], table_cap[1]-4 * info['row_height'], table_cap[2],
-                             4 * info['row_height']]  # Remove the table below
-            p_figure_id = 0
-            while p_figure_id < len(p_figures):
-                p_figure = p_figures[p_figure_id]
-
-                overlap = overlap_ratio_based(table_cap_box, p_figure)
-                if overlap > 0.1:
-                    del p_figures[p_figure_id]
-                else:
-                    p_figure_id = p_figure_id + 1
+            table_cap_boxes.append([table_cap[0], table_cap[1]+table_cap[3], table_cap[2],4*info.row_height])# Remove the table below
+            table_cap_boxes.append([table_cap[0], table_cap[1]-4 * info.row_height, table_cap[2],
+                                    4 * info.row_height])  # Remove the table above
+        if len(table_cap_boxes) > 0 and len(p_figures) > 0:
+            in_table = (overlap_ratio_matrix(table_cap_boxes, p_figures) > 0.1).any(axis=0)
+            p_figures[:] = [p_figure for p_figure, remove in zip(p_figures, in_table) if not remove]
 
 
         if len(p_figures) > 0 :
@@ -304,7 +389,7 @@ def fig_cap_matching(cap_box, fig_box, info, table_box, text_box):
                 if p_figures[0][2] > fig_size_thresh and p_figures[0][3] > fig_size_thresh:# size
                     if bbox_distance(p_figures[0], p_captions[0]) < 50: # distance
                         figures[page] = [[p_figures[0], p_captions[0]]]
-                        captions[page] = [[p_captions[0], [1, 1, info['page_width']-2, info['page_height']-2]]]
+                        captions[page] = [[p_captions[0], [1, 1, info.page_width-2, info.page_height-2]]]
                 if page not in figures.keys():
                     cap_regions = caption_regions(p_captions, p_figures, info)
                     captions[page] = cap_regions
@@ -326,10 +411,10 @@ def fig_cap_matching(cap_box, fig_box, info, table_box, text_box):
                 for p_object in p_figures:
                     sum_area = sum_area + p_object[2] * p_object[3]
 
-                page_width =info['page_width']-info['left_bbox'][2]-info['right_bbox'][2]
-                page_height = info['page_height']-info['top_bbox'][3]-info['down_bbox'][3]
+                page_width =info.page_width-info.left_bbox[2]-info.right_bbox[2]
+                page_height = info.page_height-info.top_bbox[3]-info.down_bbox[3]
                 if float(sum_area)/(page_width*page_height) > 0.2 and i>1:
-                    captions[page] = [[info['down_bbox'], [1, 1, info['page_width']-2, info['page_height']-2]]]
+                    captions[page] = [[info.down_bbox, [1, 1, info.page_width-2, info.page_height-2]]]
                     figures[page] = label_subfig(info, p_figures, captions[page], table_box)
         else:
             captions[page] = []
@@ -344,7 +429,7 @@ def same_no_caps_est(cap_box, fig_box, info, table_box, text_box):
     for page in cap_box:
         cap_regions[page] = []
         if len(cap_box[page]) == 1:
-            cap_regions[page].append([cap_box[page][0], [0, 0, info['page_width'], info['page_height']]])
+            cap_regions[page].append([cap_box[page][0], [0, 0, info.page_width, info.page_height]])
         if len(cap_box[page]) > 1:
             p_figures = fig_box[page]
             p_captions = cap_box[page]
@@ -364,51 +449,51 @@ def same_no_caps_est(cap_box, fig_box, info, table_box, text_box):
 def caption_regions(cap_box, fig_box, info):
     # sort captions by horizontal
     #print cap_box
-    #whole_page = [1, 1, info['page_width'], info['page_height']]
-    column_no = info['column_no']
-    columns = info['columns']
+    #whole_page = [1, 1, info.page_width, info.page_height]
+    column_no = info.column_no
+    columns = info.columns
     columns_point = [1] * column_no
     cap_regions = []
     if len(cap_box) == 1:
-        cap_regions.append([cap_box[0], [1, 1, info['page_width'] - 2*info['row_height'],info['page_height'] - 2*info['row_height']]])
+        cap_regions.append([cap_box[0], [1, 1, info.page_width - 2*info.row_height,info.page_height - 2*info.row_height]])
         # comment on 0318 for gxd
         '''
         if column_no == 1:
-            cap_regions.append([cap_box[0], [1, 1, info['page_width']-2, cap_box[0][1]]])
-            cap_regions.append([cap_box[0], [1, cap_box[0][1]+2*info['row_height'], info['page_width']-2, info['page_height']-cap_box[0][1]-3*info['row_height']]])
+            cap_regions.append([cap_box[0], [1, 1, info.page_width-2, cap_box[0][1]]])
+            cap_regions.append([cap_box[0], [1, cap_box[0][1]+2*info.row_height, info.page_width-2, info.page_height-cap_box[0][1]-3*info.row_height]])
         else:
-            if cap_box[0][2] > info['row_width'] + 50 or (cap_box[0][0] < info['page_width'] / 2 and
-                                                                (cap_box[0][0] + cap_box[0][2]) > info['page_width'] / 2):
-                cap_regions.append([cap_box[0], [1, 1, info['page_width'] - 2, cap_box[0][1]]])
-                cap_regions.append([cap_box[0], [1, cap_box[0][1] + 2 * info['row_height'], info['page_width'] - 2,
-                                                 info['page_height'] - cap_box[0][1] - 3 * info['row_height']]])
+            if cap_box[0][2] > info.row_width + 50 or (cap_box[0][0] < info.page_width / 2 and
+                                                                (cap_box[0][0] + cap_box[0][2]) > info.page_width / 2):
+                cap_regions.append([cap_box[0], [1, 1, info.page_width - 2, cap_box[0][1]]])
+                cap_regions.append([cap_box[0], [1, cap_box[0][1] + 2 * info.row_height, info.page_width - 2,
+                                                 info.page_height - cap_box[0][1] - 3 * info.row_height]])
             else:
-                if cap_box[0][0]< columns[0] + 100 or cap_box[0][0] < columns[0] + info['row_width'] -100:
-                    cap_regions.append([cap_box[0], [1, 1, columns[0] + info['row_width'], cap_box[0][1]]])
-                    cap_regions.append([cap_box[0], [1, cap_box[0][1] + 2 * info['row_height'], columns[0] + info['row_width'],
-                                                     info['page_height'] - cap_box[0][1] - 3 * info['row_height']]])
+                if cap_box[0][0]< columns[0] + 100 or cap_box[0][0] < columns[0] + info.row_width -100:
+                    cap_regions.append([cap_box[0], [1, 1, columns[0] + info.row_width, cap_box[0][1]]])
+                    cap_regions.append([cap_box[0], [1, cap_box[0][1] + 2 * info.row_height, columns[0] + info.row_width,
+                                                     info.page_height - cap_box[0][1] - 3 * info.row_height]])
                 else:
-                    cap_regions.append([cap_box[0], [min(cap_box[0][0], columns[0] + info['row_width']+50), 1, columns[0] + info['row_width'], cap_box[0][1]]])
-                    cap_regions.append([cap_box[0], [min(cap_box[0][0], columns[0] + info['row_width']+50), cap_box[0][1] + 2 * info['row_height'], columns[0] + info['row_width'],
-                                      info['page_height'] - cap_box[0][1] - 3 * info['row_height']]])
+                    cap_regions.append([cap_box[0], [min(cap_box[0][0], columns[0] + info.row_width+50), 1, columns[0] + info.row_width, cap_box[0][1]]])
+                    cap_regions.append([cap_box[0], [min(cap_box[0][0], columns[0] + info.row_width+50), cap_box[0][1] + 2 * info.row_height, columns[0] + info.row_width,
+                                      info.page_height - cap_box[0][1] - 3 * info.row_height]])
         '''
     elif len(cap_box) >1:
         if column_no ==1:
             cap_sorted = sorted(cap_box, key=lambda x: x[1])
             for cap_item in cap_sorted:
-                region = [1, columns_point[0], info['page_width']-2, cap_item[1] - columns_point[0]]
+                region = [1, columns_point[0], info.page_width-2, cap_item[1] - columns_point[0]]
                 cap_regions.append([cap_item, region])
                 columns_point[0] = cap_item[1]+cap_item[3]
-            cap_regions.append([cap_item, [1, columns_point[0], info['page_width']-2, info['page_height'] - columns_point[0]]])
+            cap_regions.append([cap_item, [1, columns_point[0], info.page_width-2, info.page_height - columns_point[0]]])
         else:
             cap_sorted = sorted(cap_box, key=lambda x: (x[1], x[0]))
             # caption parallel
             for cap_item in cap_sorted:
                 no_cross_fig = 1
-                if cap_item[2] > info['row_width']+50 or (cap_item[0] < info['page_width']/2 and
-                                                                  (cap_item[0]+cap_item[2])>info['page_width']/2):
+                if cap_item[2] > info.row_width+50 or (cap_item[0] < info.page_width/2 and
+                                                                  (cap_item[0]+cap_item[2])>info.page_width/2):
                     no_cross_fig = 0
-                    region = [1, max(columns_point), info['page_width']-2, cap_item[1] - max(columns_point)]
+                    region = [1, max(columns_point), info.page_width-2, cap_item[1] - max(columns_point)]
                     columns_point = [cap_item[1]+cap_item[3]] * column_no
                     cap_regions.append([cap_item, region])
                 else:
@@ -418,36 +503,36 @@ def caption_regions(cap_box, fig_box, info):
                     #     if (fig_item[1] < cap_y) & (fig_item[1] + fig_item[3] > cap_y):
                     #         no_cross_fig = 1
                     # for other_cap in cap_sorted:# Caption parallel
-                    #     if (abs(other_cap[1] - cap_y)<info['row_height']) & (abs(other_cap[0] - cap_x) > 5* info['row_height']):
+                    #     if (abs(other_cap[1] - cap_y)<info.row_height) & (abs(other_cap[0] - cap_x) > 5* info.row_height):
                     #         no_cross_fig = 1
                     # no_cross_fig = 1
-                    # if (cap_item[0] + cap_item[2] > columns[0]+ info['row_width']+100) and (cap_item[0] < columns[0]+ info['row_width'] - 50):
+                    # if (cap_item[0] + cap_item[2] > columns[0]+ info.row_width+100) and (cap_item[0] < columns[0]+ info.row_width - 50):
                     #     no_cross_fig = 0
                     #
                     # if no_cross_fig == 0:
-                    #     region = [1, max(columns_point), info['page_width']-2, cap_y - max(columns_point)]
+                    #     region = [1, max(columns_point), info.page_width-2, cap_y - max(columns_point)]
                     #     columns_point = [cap_item[1] + cap_item[3]] * column_no
                     #
                     if no_cross_fig== 1:
                         if cap_x < columns[0] + 100:
-                            region = [cap_x, columns_point[0], info['row_width'], cap_y - columns_point[0]]
+                            region = [cap_x, columns_point[0], info.row_width, cap_y - columns_point[0]]
                             columns_point[0] = cap_y + cap_item[3]
-                        elif cap_x < columns[0] + info['row_width'] -100:
-                            region = [1, columns_point[0], columns[0] + info['row_width'], cap_y - columns_point[0]]
+                        elif cap_x < columns[0] + info.row_width -100:
+                            region = [1, columns_point[0], columns[0] + info.row_width, cap_y - columns_point[0]]
                             columns_point[0] = cap_y + cap_item[3]
                         else:
-                            region = [min(cap_x, columns[0] + info['row_width']+50), columns_point[1], info['page_width'] - min(cap_x, columns[0] + info['row_width']+50), cap_y - columns_point[1]]
+                            region = [min(cap_x, columns[0] + info.row_width+50), columns_point[1], info.page_width - min(cap_x, columns[0] + info.row_width+50), cap_y - columns_point[1]]
                             columns_point[1] = cap_y + cap_item[3]
 
                     cap_regions.append([cap_item, region])
             # Added to cover all area, for image below captions
             if no_cross_fig ==0:
-                region = [1, max(columns_point), info['page_width'] - 2, info['page_height'] - max(columns_point)]
+                region = [1, max(columns_point), info.page_width - 2, info.page_height - max(columns_point)]
                 cap_regions.append([cap_item, region])
             else:
-                cap_regions.append([cap_item, [0, columns_point[0], info['page_width']/2, info['page_height']-columns_point[0]-1]])
-                cap_regions.append([cap_item, [info['page_width']/2, columns_point[1], info['page_width'] / 2,
-                                               info['page_height'] - columns_point[1] - 1]])
+                cap_regions.append([cap_item, [0, columns_point[0], info.page_width/2, info.page_height-columns_point[0]-1]])
+                cap_regions.append([cap_item, [info.page_width/2, columns_point[1], info.page_width / 2,
+                                               info.page_height - columns_point[1] - 1]])
     return cap_regions
 
 
@@ -462,15 +547,15 @@ def label_subfig(info, figures, cap_regions, table_box):
         labeled_figures[str(i)] = []
 
     # Changed order, it may affect
-    for figure in figures:
+    if len(figures) > 0 and len(cap_regions) > 0:
+        overlap = overlap_ratio_matrix(figures, [cap_region[1] for cap_region in cap_regions])
+        cover = overlap_ratio_matrix([cap_region[0] for cap_region in cap_regions], figures)# to check if the caption in in the figure
+        in_region = (overlap > 0.2) & (cover.T < 0.5)# The overlap need to set carefully
         for i in range(len(cap_regions)):
-            overlap = overlap_ratio_based(figure, cap_regions[i][1])
-            cover = overlap_ratio_based(cap_regions[i][0], figure)# to check if the caption in in the figure
-            if overlap > 0.2 and cover < 0.5:# The overlap need to set carefully
-                labeled_figures[str(i)].append(figure)
+            labeled_figures[str(i)] = [figures[j] for j in np.flatnonzero(in_region[:, i])]
 
         # check distance, to remove far objects
-        #if cap_regions[i][0][1] < info['down_bbox'][1]:
+        #if cap_regions[i][0][1] < info.down_bbox[1]:
         #    cap_box = [cap_regions[i][0]]
         #    fig_objects = labeled_figures[str(i)]
         #    for_tr_graph = [0]*len(fig_objects)
@@ -481,7 +566,7 @@ def label_subfig(info, figures, cap_regions, table_box):
         #            if for_tr_graph[fig_no]==0:
         #                for cap in cap_box:
         #                    dis = bbox_distance(fig_objects[fig_no], cap)
-        #                    if dis < 6 * info['row_height']:
+        #                    if dis < 6 * info.row_height:
         #                        cap_box.append(fig_objects[fig_no])
         #                        for_tr_graph[fig_no] = 1
         #                        increase = increase +1
@@ -497,20 +582,10 @@ def label_subfig(info, figures, cap_regions, table_box):
                 if labeled_figures[str(i)][0][2] > 20 and labeled_figures[str(i)][0][2] > 20:# Fig Thresh
                     fig_merged.append([labeled_figures[str(i)][0], cap_regions[i][0]])
             else:
-                x0 = []
-                x1 = []
-                y0 = []
-                y1 = []
-                sum_figure_area = 0
-                for each_figure in labeled_figures[str(i)]:
-                    x0.append(each_figure[0])
-                    y0.append(each_figure[1])
-                    x1.append(each_figure[0] + each_figure[2])
-                    y1.append(each_figure[1] + each_figure[3])
-                    sum_figure_area = each_figure[2] * each_figure[3] + sum_figure_area
-                new_fig = [min(x0), min(y0), max(x1)-min(x0),
-                                          max(y1)-min(y0)]
-                # if new_fig[2] > 2*info['row_height'] and new_fig[3] > 2*info['row_height']:
+                group = as_boxes(labeled_figures[str(i)])
+                sum_figure_area = (group[:, 2] * group[:, 3]).sum().item()
+                new_fig = box_union(group)
+                # if new_fig[2] > 2*info.row_height and new_fig[3] > 2*info.row_height:
                 #     fig_merged.append(new_fig)
 
                 if new_fig[2] > 20 and new_fig[3] > 20:# Fig Threshold
@@ -522,7 +597,7 @@ def label_subfig(info, figures, cap_regions, table_box):
 
     return fig_merged
 
-def evaluation(prefigures, cap_regions, html_file_path, info, html_boxes):
+def evaluation(prefigures, cap_regions, html_file_path, info, document, metrics=NULL_METRICS):
 
     fig_cap_pair = prefigures
     figures = {}
@@ -532,21 +607,12 @@ def evaluation(prefigures, cap_regions, html_file_path, info, html_boxes):
         captions[page] = []
         for each_figcap in fig_cap_pair[page]:
             new_fig = each_figcap[0]
-            caption_flag = overlap_ratio_based(info['down_bbox'], each_figcap[1])
+            caption_flag = overlap_ratio_based(info.down_bbox, each_figcap[1])
             if caption_flag > 0.8:
                 figcap = each_figcap[0]
-                if info['mess_up'] == False:
-                    for each_page_html in html_boxes:
-                        if each_page_html[0] == int(page[4:-4]):
-                            for element in each_page_html[1]:
-                                in_or_not = overlap_ratio_based(element[0], figcap)
-                                if in_or_not > 0.05:
-                                    new_fig = merge_two_boxes(new_fig, element[0])
-
-                            for element in each_page_html[1]:
-                                in_or_not = bbox_distance(element[0], each_figcap[0])
-                                if in_or_not < info['row_height']/4:
-                                    new_fig = merge_two_boxes(new_fig, element[0])
+                if info.mess_up == False:
+                    if page in document.by_name:
+                        new_fig = merge_text_elements(new_fig, figcap, each_figcap[0], document.named(page), info)
                     figures[page].append([new_fig, []])
                     captions[page].append([])
                 else:
@@ -563,145 +629,39 @@ def evaluation(prefigures, cap_regions, html_file_path, info, html_boxes):
 
 
                 #print fig_cap_pair[page]
-                if info['mess_up'] == False:
-                    for each_page_html in html_boxes:
-                        if each_page_html[0] == int(page[4:-4]):
-
-                            for element in each_page_html[1]:
-                                in_or_not = overlap_ratio_based(element[0], figcap)
-                                if in_or_not > 0.05:
-                                    new_fig = merge_two_boxes(new_fig,element[0])
-
-                            for element in each_page_html[1]:
-                                in_or_not = bbox_distance(element[0], each_figcap[0])
-                                if in_or_not < info['row_height']/4:
-                                    new_fig = merge_two_boxes(new_fig, element[0])
-                            # for caption detection ~~~~~~~~~~~~~~~~~~~~~~~~
-                            cap_detection_flag = 0
-                            cap_text = []
-                            cap_gap = 0.5 * info['row_height']# modify to 0.75 0.5
-                            for element in each_page_html[1]:
-                                if element[0] == cap_box or cap_detection_flag == 1:
-                                    if element[0] == cap_box:
-                                        cap_detection_flag = 1
-                                        cap_text.append(element[1])
-                                        first_line_box = cap_box
-                                        moving_box = cap_box
-                                    else:
-                                        cap_gap = max(min(element[0][1]-first_line_box[1]-first_line_box[3], cap_gap), 3)
-                                        current_gap = element[0][1]-moving_box[1]-moving_box[3]
-                                        #print current_gap
-                                        #print moving_box
-                                        #print element[0]
-                                        if current_gap>=max(0.5 * info['row_height'],cap_gap):# 0.75*info['row_height']
-                                            cap_detection_flag = 0
-                                        elif (element[0][2]-first_line_box[2]>5*info['row_height'] or element[0][3] - first_line_box[3]>1) and current_gap-cap_gap>3:
-                                            cap_detection_flag = 0
-
-                                        if abs(first_line_box[0]-element[0][0])>10*info['row_height'] and cap_detection_flag == 0:
-                                            cap_detection_flag = 1
-                                        elif abs(first_line_box[0]-element[0][0])>10*info['row_height'] and cap_detection_flag == 1:
-                                            cap_detection_flag = 1
-
-                                        elif cap_detection_flag == 1:
-                                            moving_box = element[0]
-                                            cap_box = merge_two_boxes(cap_box, element[0])
-                                            cap_text.append(element[1])
-                                            
-                                    # To determine where to stop
-                    # Finding separate captions
-                            if len(cap_text)==1 and (cap_text[0][-1].isdigit() or cap_text[-1][-1].isdigit()) and len(cap_text[0])<15:
-                                cap_detection_flag = 0
-                                cap_text_cp = cap_text
-                                cap_box_cp = cap_box
-                                cap_text = []
-                                cap_gap = 0.5 * info['row_height']  # modify to 0.75 0.5
-                                next = 0
-                                for element in each_page_html[1]:
-                                    if element[0] == cap_box or cap_detection_flag == 1:
-                                        if next == 0:
-                                            if element[0][1]>cap_box[1] and len(element[1])>30:
-                                                next = 1
-                                                cap_detection_flag = 1
-                                                cap_text.append(element[1])
-                                                first_line_box = element[0]
-                                                moving_box = element[0]
-                                                cap_box = element[0]
-                                            else:
-                                                cap_detection_flag = 1
-
-                                        else:
-                                            cap_gap = max(
-                                                min(element[0][1] - first_line_box[1] - first_line_box[3], cap_gap), 3)
-                                            current_gap = element[0][1] - moving_box[1] - moving_box[3]
-                                            #print current_gap
-                                            #print moving_box
-                                            #print element[0]
-                                            if current_gap >= max(0.5 * info['row_height'],cap_gap):  # 0.75*info['row_height']
-                                                cap_detection_flag = 0
-                                            elif (element[0][2] - first_line_box[2] > 5 * info['row_height'] or
-                                                              element[0][3] - first_line_box[3] > 1) and current_gap - cap_gap > 3:
-                                                cap_detection_flag = 0
-
-                                            if abs(first_line_box[0] - element[0][0]) > 10 * info[
-                                                'row_height'] and cap_detection_flag == 0:
-                                                cap_detection_flag = 1
-                                            elif abs(first_line_box[0] - element[0][0]) > 10 * info[
-                                                'row_height'] and cap_detection_flag == 1:
-                                                cap_detection_flag = 1
-
-                                            elif cap_detection_flag == 1:
-                                                moving_box = element[0]
-                                                cap_box = merge_two_boxes(cap_box, element[0])
-                                                cap_text.append(element[1])
-                                                
-                                distance_before = bbox_distance(new_fig, cap_box_cp)
-                                distance_now = bbox_distance(new_fig, cap_box)
-                                # if distance_now > 2*distance_before + 2*cap_box_cp[3]: No distance control is better
-                                #     cap_box = cap_box_cp
-                                #     cap_text = cap_text_cp
-
-                            figures[page].append([new_fig, [cap_box, cap_text]])
-
-                            captions[page].append([cap_box, cap_text])
+                if info.mess_up == False:
+                    if page in document.by_name:
+                        page_doc = document.named(page)
+                        new_fig = merge_text_elements(new_fig, figcap, each_figcap[0], page_doc, info)
+                        # for caption detection ~~~~~~~~~~~~~~~~~~~~~~~~
+                        cap_gap = 0.5 * info.row_height# modify to 0.75 0.5
+                        cap_box, cap_text = caption_walk(page_doc, cap_box, cap_gap, info)
+                        metrics.count('caption_walks')
+                        # Finding separate captions
+                        if len(cap_text)==1 and (cap_text[0][-1].isdigit() or cap_text[-1][-1].isdigit()) and len(cap_text[0])<15:
+                            cap_text_cp = cap_text
+                            cap_box_cp = cap_box
+                            cap_gap = 0.5 * info.row_height  # modify to 0.75 0.5
+                            cap_box, cap_text = separate_caption_walk(page_doc, cap_box, cap_gap, info)
+                            metrics.count('caption_walks')
+                            distance_before = bbox_distance(new_fig, cap_box_cp)
+                            distance_now = bbox_distance(new_fig, cap_box)
+                            # if distance_now > 2*distance_before + 2*cap_box_cp[3]: No distance control is better
+                            #     cap_box = cap_box_cp
+                            #     cap_text = cap_text_cp
+
+                        figures[page].append([new_fig, [cap_box, cap_text]])
+
+                        captions[page].append([cap_box, cap_text])
                 else:
 
-                    for each_page_html in html_boxes:
-                        if each_page_html[0] == int(page[4:-4]):
-                            cap_detection_flag = 0
-                            cap_text = []
-                            cap_gap = info['row_height']
-                            for element in each_page_html[1]:
-                                if element[0] == cap_box or cap_detection_flag == 1:
-                                    if element[0] == cap_box:
-                                        cap_detection_flag = 1
-                                        cap_text.append(element[1])
-                                        first_line_box = cap_box
-                                        moving_box = cap_box
-                                    else:
-                                        cap_gap = max(min(element[0][1]-first_line_box[1]-first_line_box[3], cap_gap), 3)
-                                        current_gap = element[0][1]-moving_box[1]-moving_box[3]
-                                        #print current_gap
-                                        #print moving_box
-                                        #print element[0]
-                                        if current_gap>=max(0.5 * info['row_height'],cap_gap):# 0.75*info['row_height']
-                                            cap_detection_flag = 0
-                                        elif (element[0][2]-first_line_box[2]>5*info['row_height'] or element[0][3] - first_line_box[3]>1) and current_gap-cap_gap>3:
-                                            cap_detection_flag = 0
-
-                                        if abs(first_line_box[0]-element[0][0])>10*info['row_height'] and cap_detection_flag == 0:
-                                            cap_detection_flag = 1
-                                        elif abs(first_line_box[0]-element[0][0])>10*info['row_height'] and cap_detection_flag == 1:
-                                            cap_detection_flag = 1
-
-                                        elif cap_detection_flag == 1:
-                                            moving_box = element[0]
-                                            cap_box = merge_two_boxes(cap_box, element[0])
-                                            cap_text.append(element[1])
-                                            if first_line_box[2]-element[0][2]>5*info['row_height'] and element[1].endswith('.'):
-                                                cap_detection_flag = 0
-                            captions[page].append([cap_box, cap_text])
-                            figures[page].append([each_figcap[0], [cap_box, cap_text]])
+                    if page in document.by_name:
+                        cap_gap = info.row_height
+                        cap_box, cap_text = caption_walk(document.named(page), cap_box, cap_gap, info,
+                                                         sentence_stop=True)
+                        metrics.count('caption_walks')
+                        captions[page].append([cap_box, cap_text])
+                        figures[page].append([each_figcap[0], [cap_box, cap_text]])
 
     #
     # for page in figures:
@@ -710,9 +670,9 @@ def evaluation(prefigures, cap_regions, html_file_path, info, html_boxes):
     #         img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     #         png_size = img.shape
     #         if png_size[0] > png_size[1]:
-    #             png_ratio = float(png_size[0]) / info['page_height']
+    #             png_ratio = float(png_size[0]) / info.page_height
     #         else:
-    #             png_ratio = float(png_size[0]) / info['page_width']
+    #             png_ratio = float(png_size[0]) / info.page_width
     #         bbox_no = 0
     #         while bbox_no < len(figures[page]):
     #             each_bbox = figures[page][bbox_no]
@@ -732,6 +692,96 @@ def evaluation(prefigures, cap_regions, html_file_path, info, html_boxes):
 
     return figures, captions
 
+def caption_walk(page, cap_box, cap_gap, info, sentence_stop=False):
+    # Grow a caption from its first line: start at the first element whose box is cap_box
+    # and take the following elements in html order until the line gap or line size changes.
+    # Elements more than 10 rows to the side (the other column) are passed over.
+    # Stopped walks restart only at an element equal to the grown cap_box, found in the page index.
+    elements = page.elements
+    cap_text = []
+    cap_detection_flag = 0
+    position = page.find(cap_box)
+    while position is not None:
+        element = elements[position]
+        if element[0] == tuple(cap_box):
+            cap_detection_flag = 1
+            cap_text.append(element[1])
+            first_line_box = cap_box
+            moving_box = cap_box
+        else:
+            cap_detection_flag, moving_box, cap_box, cap_gap = caption_step(
+                element, cap_detection_flag, first_line_box, moving_box, cap_box, cap_gap, cap_text, info,
+                sentence_stop)
+        position = position + 1
+        if cap_detection_flag == 0:
+            position = page.find(cap_box, position)
+        elif position == len(elements):
+            position = None
+    return cap_box, cap_text
+
+def separate_caption_walk(page, cap_box, cap_gap, info):
+    # cap_box is only a label line ('Figure 3'): the caption starts at the first long line
+    # below it, and grows from there like caption_walk
+    elements = page.elements
+    cap_text = []
+    cap_detection_flag = 0
+    position = page.find(cap_box)
+    if position is not None:
+        position = page.next_long_line(position, cap_box[1])
+    while position is not None:
+        element = elements[position]
+        if len(cap_text) == 0:
+            cap_detection_flag = 1
+            cap_text.append(element[1])
+            first_line_box = element[0]
+            moving_box = element[0]
+            cap_box = list(element[0])
+        else:
+            cap_detection_flag, moving_box, cap_box, cap_gap = caption_step(
+                element, cap_detection_flag, first_line_box, moving_box, cap_box, cap_gap, cap_text, info)
+        position = position + 1
+        if cap_detection_flag == 0:
+            position = page.find(cap_box, position)
+        elif position == len(elements):
+            position = None
+    return cap_box, cap_text
+
+def caption_step(element, cap_detection_flag, first_line_box, moving_box, cap_box, cap_gap, cap_text, info,
+                 sentence_stop=False):
+    # One element of a caption walk; appends to cap_text and returns the new walk state
+    cap_gap = max(min(element[0][1]-first_line_box[1]-first_line_box[3], cap_gap), 3)
+    current_gap = element[0][1]-moving_box[1]-moving_box[3]
+    if current_gap>=max(0.5 * info.row_height,cap_gap):# 0.75*info.row_height
+        cap_detection_flag = 0
+    elif (element[0][2]-first_line_box[2]>5*info.row_height or element[0][3] - first_line_box[3]>1) and current_gap-cap_gap>3:
+        cap_detection_flag = 0
+
+    if abs(first_line_box[0]-element[0][0])>10*info.row_height:
+        cap_detection_flag = 1
+    elif cap_detection_flag == 1:
+        moving_box = element[0]
+        cap_box = merge_two_boxes(cap_box, element[0])
+        cap_text.append(element[1])
+        if sentence_stop and first_line_box[2]-element[0][2]>5*info.row_height and element[1].endswith('.'):
+            cap_detection_flag = 0
+    return cap_detection_flag, moving_box, cap_box, cap_gap
+
+def merge_text_elements(new_fig, figcap, fig, page, info):
+    # Grow new_fig by the text elements of the page inside figcap or touching the figure
+    if len(page.elements) == 0:
+        return new_fig
+    element_boxes = page.boxes
+    inside = overlap_ratio_matrix(element_boxes, [figcap])[:, 0] > 0.05
+    near = bbox_distance_matrix(element_boxes, [fig])[:, 0] < info.row_height/4
+    if element_boxes.dtype.kind != 'f':
+        if (inside | near).any():
+            new_fig = merge_two_boxes(new_fig, box_union(element_boxes[inside | near]))
+    else:
+        # Fractional boxes (browser layout): x + w rounds differently in one union, merge in html order
+        for position in list(np.flatnonzero(inside)) + list(np.flatnonzero(near)):
+            new_fig = merge_two_boxes(new_fig, page.elements[position][0])
+    return new_fig
+
 def check_region(info, figures, captions):
     final_figures = figures
     final_captions = captions
@@ -740,41 +790,41 @@ def check_region(info, figures, captions):
             if len(each_figure[1])>0:
                 caption_overlap_ratio = overlap_ratio_based(each_figure[1][0], each_figure[0])
 
-                if (each_figure[1][0][0]+each_figure[1][0][2]) > info['right_bbox'][0]:
-                    each_figure[1][0][2] = info['right_bbox'][0]- each_figure[1][0][0]
+                if (each_figure[1][0][0]+each_figure[1][0][2]) > info.right_bbox[0]:
+                    each_figure[1][0][2] = info.right_bbox[0]- each_figure[1][0][0]
                 # for two column documents
-                if each_figure[0][2] > 1.5 *info['row_width'] and each_figure[1][0][1] > each_figure[0][1] + each_figure[0][3] \
+                if each_figure[0][2] > 1.5 *info.row_width and each_figure[1][0][1] > each_figure[0][1] + each_figure[0][3] \
                     and each_figure[1][0][0] + each_figure[1][0][2]< each_figure[0][0]+ each_figure[0][2]/2 \
-                    and each_figure[1][0][3] >3*info['row_height']:
-                    each_figure[1][0][2] = 2*each_figure[1][0][2] + 2*info['row_height']
+                    and each_figure[1][0][3] >3*info.row_height:
+                    each_figure[1][0][2] = 2*each_figure[1][0][2] + 2*info.row_height
 
                 if caption_overlap_ratio > 0.8:
                 # spliting caption box and the figure box
                 # top caption
-                    if each_figure[1][0][1]>=each_figure[0][1] and (each_figure[1][0][1]-each_figure[0][1])<2*info['row_height']\
+                    if each_figure[1][0][1]>=each_figure[0][1] and (each_figure[1][0][1]-each_figure[0][1])<2*info.row_height\
                         and each_figure[1][0][0]<each_figure[0][0]+each_figure[0][2]/2 and each_figure[1][0][0] +each_figure[1][0][2]>each_figure[0][0]+each_figure[0][2]/2 \
-                        and each_figure[0][1]+each_figure[0][3]-each_figure[1][0][1]-each_figure[1][0][3] > 5*info['row_height']:
+                        and each_figure[0][1]+each_figure[0][3]-each_figure[1][0][1]-each_figure[1][0][3] > 5*info.row_height:
                         each_figure[0] = [each_figure[0][0], each_figure[1][0][1]+each_figure[1][0][3],
                                           each_figure[0][2], each_figure[0][1]+each_figure[0][3]-each_figure[1][0][1]-each_figure[1][0][3]]
                 # down caption
-                    elif each_figure[0][1]+each_figure[0][3]>=each_figure[1][0][1]+each_figure[1][0][3] and (each_figure[0][1]+each_figure[0][3]-each_figure[1][0][1]-each_figure[1][0][3]) < 2 * info['row_height'] \
+                    elif each_figure[0][1]+each_figure[0][3]>=each_figure[1][0][1]+each_figure[1][0][3] and (each_figure[0][1]+each_figure[0][3]-each_figure[1][0][1]-each_figure[1][0][3]) < 2 * info.row_height \
                             and each_figure[1][0][0] < each_figure[0][0] + each_figure[0][2] / 2 and \
                             each_figure[1][0][0] + each_figure[1][0][2] > each_figure[0][0] + each_figure[0][2] / 2 \
-                            and each_figure[0][1] + each_figure[0][3] - each_figure[1][0][1] > 5 * info['row_height']:
+                            and each_figure[0][1] + each_figure[0][3] - each_figure[1][0][1] > 5 * info.row_height:
                         each_figure[0] = [each_figure[0][0], each_figure[0][1],
                                               each_figure[0][2],
                                               each_figure[0][1] + each_figure[0][3] - each_figure[1][0][1]]
                 # right caption
-                    elif each_figure[1][0][0]+ each_figure[1][0][2]<= each_figure[0][0] + each_figure[0][2] and (each_figure[0][0] + each_figure[0][2] - each_figure[1][0][0]- each_figure[1][0][2]) < 2 * info['row_height'] \
+                    elif each_figure[1][0][0]+ each_figure[1][0][2]<= each_figure[0][0] + each_figure[0][2] and (each_figure[0][0] + each_figure[0][2] - each_figure[1][0][0]- each_figure[1][0][2]) < 2 * info.row_height \
                              and each_figure[1][0][0] > each_figure[0][0] + each_figure[0][2]/2 \
-                            and each_figure[1][0][0] - each_figure[0][0] > 5 * info['row_height']:
+                            and each_figure[1][0][0] - each_figure[0][0] > 5 * info.row_height:
                         each_figure[0] = [each_figure[0][0], each_figure[0][1],
                                           each_figure[1][0][0] - each_figure[0][0],
                                           each_figure[0][3]]
                 # left caption
-                    elif each_figure[1][0][0] >= each_figure[0][0] and (each_figure[1][0][0] - each_figure[0][0]) < 2 *info['row_height'] \
+                    elif each_figure[1][0][0] >= each_figure[0][0] and (each_figure[1][0][0] - each_figure[0][0]) < 2 *info.row_height \
                         and each_figure[1][0][0] + each_figure[1][0][2]< each_figure[0][0] + each_figure[0][2] / 2\
-                        and each_figure[0][0]+each_figure[0][2] - each_figure[1][0][0] > 5 * info['row_height']:
+                        and each_figure[0][0]+each_figure[0][2] - each_figure[1][0][0] > 5 * info.row_height:
                         each_figure[0] = [each_figure[1][0][0], each_figure[0][1],
                                       each_figure[0][0]+each_figure[0][2] - each_figure[1][0][0],
                                       each_figure[0][3]]
@@ -801,7 +851,7 @@ def merge_boxes(figures, cap_regions, table_box, info):
         for j in range(len(check_box)):
             for k in range(len(check_box)):
                 if j ==k:
-                    dis_matrix[j][k] = 10*info['row_height']
+                    dis_matrix[j][k] = 10*info.row_height
                 else:
                     dis_matrix[j][k] = manhattan_dist(check_box[j], check_box[k])
         dis_matrix = min(dis_matrix)
@@ -853,6 +903,13 @@ def overlap_ratio_based(box1, box2):
         overlap_ratio = float(SI) / box1_area
     return overlap_ratio
 
+def overlaps_any(box, boxes, index, thresh):
+    # True if overlap_ratio_based(box, other) > thresh for any of boxes (indexed by a BoxGrid)
+    for box_id in index.candidates(box):
+        if overlap_ratio_based(box, boxes[box_id]) > thresh:
+            return True
+    return False
+
 def bbox_distance(bbox1, bbox2):
     x1 = bbox1[0]
     y1 = bbox1[1]